@@ -0,0 +1,10 @@
+""" Performance benchmarks for eddie.
+
+    Run them from the repository root with:
+
+        $ python -m benchmarks --output benchmark.json
+
+    Every benchmark reports p50/p99 latency, throughput and peak memory, the
+    results are written as JSON so that a later run can be compared against
+    them (see `--baseline`).
+"""
@@ -0,0 +1,59 @@
+""" Command line entry point of the benchmark suite.
+
+    Example usage:
+
+        $ python -m benchmarks --output current.json
+        $ python -m benchmarks --baseline current.json --tolerance 0.3
+
+    When a baseline is given the exit status is 1 if any benchmark regressed,
+    so the command can be used to fail a CI job.
+"""
+
+from __future__ import absolute_import, print_function
+import argparse
+import sys
+
+from .harness import compare, format_table, load_results, write_results
+from .suite import BENCHMARKS
+
+
+def main(argv=None):
+    """ Parses the command line, runs the benchmarks and reports. """
+    parser = argparse.ArgumentParser(prog='python -m benchmarks')
+    parser.add_argument('names', nargs='*',
+                        help='benchmarks to run (default: all)')
+    parser.add_argument('-n', '--iterations', type=int, default=2000)
+    parser.add_argument('-o', '--output',
+                        help='write the results as JSON to this file')
+    parser.add_argument('-b', '--baseline',
+                        help='JSON results to compare against')
+    parser.add_argument('-t', '--tolerance', type=float, default=0.2,
+                        help='allowed slowdown before failing (0.2 = 20%%)')
+    args = parser.parse_args(argv)
+
+    selected = [
+        function for function in BENCHMARKS
+        if not args.names or function.__name__ in args.names
+    ]
+
+    results = {}
+    for function in selected:
+        print('running %s...' % function.__name__, file=sys.stderr)
+        results[function.__name__] = function(args.iterations)
+
+    print(format_table(results))
+
+    if args.output:
+        write_results(results, args.output)
+
+    if args.baseline:
+        regressions = compare(results, load_results(args.baseline),
+                              args.tolerance)
+        for regression in regressions:
+            print('REGRESSION ' + regression)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,419 @@
+""" Local stand-ins for the Telegram Bot API and the Twitter REST/stream API,
+    implementing only the calls used by `TelegramEndpoint` and
+    `TwitterEndpoint`.
+
+    They are real HTTP servers listening on loopback, so the endpoints go
+    through the whole HTTP stack and stream parsing of their libraries.
+    Incoming traffic can be replayed at a configurable rate and the replies
+    sent by the bot are recorded with their timestamps.
+
+    Example usage:
+
+        >>> service = FakeTelegramService()
+        >>> service.start()
+        >>> ep = TelegramEndpoint(token='123:ABC', base_url=service.base_url)
+        >>> bot.add_endpoint(ep)
+        >>> bot.run()
+        >>> service.replay(['hello'] * 1000, rate=200)
+        >>> service.wait_sent(1000)
+
+    Twitter is only reachable with HTTPS by `tweepy`, so `FakeTwitterService`
+    needs a certificate (see `make_certificate`) and the client must trust it
+    (i.e. setting the `REQUESTS_CA_BUNDLE` environment variable).
+"""
+
+from __future__ import absolute_import, division
+import json
+import os
+import ssl
+import subprocess
+from collections import deque
+from threading import Condition, Lock, Thread
+from time import sleep, time
+
+try:  # Python 3
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs, urlparse
+except ImportError:  # Python 2
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs, urlparse
+
+
+def make_certificate(directory):
+    """ Creates a self-signed certificate for `localhost` in `directory`
+        using the `openssl` command, returns the path of the PEM file
+        containing both the key and the certificate.
+    """
+    path = os.path.join(directory, 'localhost.pem')
+    subprocess.check_call([
+        'openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes',
+        '-days', '1', '-subj', '/CN=localhost',
+        '-addext', 'subjectAltName=DNS:localhost',
+        '-keyout', path, '-out', path,
+    ], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    return path
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def handle_error(self, request, client_address):
+        """ Clients dropping connections are expected, don't log them. """
+        pass
+
+
+class _FakeServiceHandler(BaseHTTPRequestHandler, object):
+    """ Passes every request to the `route` method of the service. """
+
+    protocol_version = 'HTTP/1.1'
+    # headers and body are written separately: with keep-alive connections
+    # Nagle's algorithm would delay the body until the client's delayed ACK
+    disable_nagle_algorithm = True
+
+    def _handle(self):
+        url = urlparse(self.path)
+        params = dict(
+            (key, values[-1]) for key, values in parse_qs(url.query).items()
+        )
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        content_type = self.headers.get('Content-Type') or ''
+        if body and 'json' in content_type:
+            params.update(json.loads(body.decode('UTF-8')))
+        elif body:
+            params.update(
+                (key, values[-1])
+                for key, values in parse_qs(body.decode('UTF-8')).items()
+            )
+        self.server.service.route(self, url.path, params)
+
+    do_GET = _handle
+    do_POST = _handle
+
+    def send_json(self, status, payload):
+        """ Replies with `payload` encoded as JSON. """
+        body = json.dumps(payload).encode('UTF-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format_, *args):
+        pass
+
+
+class _FakeService(object):
+    """ Base class of the stand-ins: the HTTP server, the replay of the
+        incoming traffic, the rate limiting and the recording of the
+        messages sent by the bot.
+    """
+
+    def __init__(self, send_rate_limit=None, certfile=None):
+        self._httpd = _ThreadingHTTPServer(('localhost', 0),
+                                           _FakeServiceHandler)
+        self._httpd.service = self
+        if certfile is not None:
+            self._httpd.socket = ssl.wrap_socket(
+                self._httpd.socket, certfile=certfile, server_side=True)
+        self.port = self._httpd.server_address[1]
+        self._thread = Thread(target=self._httpd.serve_forever)
+        self._thread.daemon = True
+
+        self._send_rate_limit = send_rate_limit
+        self._send_times = deque()
+        self._lock = Lock()
+        self._sent_condition = Condition(self._lock)
+
+        self.pushed = []
+        self.sent = []
+        self.rate_limited = 0
+        self.running = False
+
+    def start(self):
+        """ Starts serving requests in a background thread. """
+        self.running = True
+        self._thread.start()
+
+    def stop(self):
+        """ Stops the server, closing the listening socket. """
+        self.running = False
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def route(self, handler, path, params):
+        """ Answers the request, implemented by every service. """
+        raise NotImplementedError
+
+    def push_message(self, text, user_id):
+        """ Makes the service deliver a new message from `user_id` to the bot,
+            implemented by every service.
+        """
+        raise NotImplementedError
+
+    def replay(self, texts, rate=None, user_id=1000):
+        """ Pushes all the `texts` as messages from `user_id`, in a background
+            thread, at `rate` messages per second (as fast as possible if
+            `None`). Returns the thread.
+        """
+        def push_all():
+            "thread target"
+            start = time()
+            for count, text in enumerate(texts):
+                if rate:
+                    delay = start + count / rate - time()
+                    if delay > 0:
+                        sleep(delay)
+                self.push_message(text, user_id)
+
+        thread = Thread(target=push_all)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def _record_push(self):
+        self.pushed.append(time())
+
+    def _record_send(self, user_id, text):
+        """ Records a message sent by the bot, returns False if it exceeds the
+            rate limit and must be rejected.
+        """
+        now = time()
+        with self._lock:
+            if self._send_rate_limit is not None:
+                while self._send_times and self._send_times[0] < now - 1:
+                    self._send_times.popleft()
+                if len(self._send_times) >= self._send_rate_limit:
+                    self.rate_limited += 1
+                    return False
+                self._send_times.append(now)
+            self.sent.append((user_id, text, now))
+            self._sent_condition.notify_all()
+        return True
+
+    def wait_sent(self, count, timeout=30):
+        """ Waits until the bot sent at least `count` messages, returns False
+            if it did not happen within `timeout` seconds.
+        """
+        deadline = time() + timeout
+        with self._lock:
+            while len(self.sent) < count:
+                remaining = deadline - time()
+                if remaining <= 0:
+                    return False
+                self._sent_condition.wait(remaining)
+        return True
+
+    def latencies(self):
+        """ Seconds between every pushed message and the matching reply,
+            assuming one reply per message, in order.
+        """
+        return [
+            sent[2] - pushed for pushed, sent in zip(self.pushed, self.sent)
+        ]
+
+
+class FakeTelegramService(_FakeService):
+    """ Stand-in for the Telegram Bot API: long polling with `getUpdates` and
+        `sendMessage`. Point `TelegramEndpoint` to it using `base_url`.
+    """
+
+    def __init__(self, poll_timeout=0.5, **kwargs):
+        super(FakeTelegramService, self).__init__(**kwargs)
+        self._poll_timeout = poll_timeout
+        self._updates = []
+        self._update_id = 0
+        self._updates_condition = Condition(Lock())
+
+    @property
+    def base_url(self):
+        """ The `base_url` to give to `TelegramEndpoint` """
+        return 'http://localhost:%d/bot' % self.port
+
+    def push_message(self, text, user_id):
+        with self._updates_condition:
+            self._update_id += 1
+            self._updates.append({
+                'update_id': self._update_id,
+                'message': {
+                    'message_id': self._update_id,
+                    'from': {'id': user_id, 'first_name': 'user'},
+                    'chat': {'id': user_id, 'type': 'private'},
+                    'date': int(time()),
+                    'text': text,
+                },
+            })
+            self._record_push()
+            self._updates_condition.notify_all()
+
+    def route(self, handler, path, params):
+        method = path.rsplit('/', 1)[-1]
+        if method == 'getUpdates':
+            handler.send_json(200, {'ok': True,
+                                    'result': self._get_updates(params)})
+        elif method == 'sendMessage':
+            chat_id = int(params['chat_id'])
+            if not self._record_send(chat_id, params['text']):
+                handler.send_json(429, {
+                    'ok': False, 'error_code': 429,
+                    'description': 'Too Many Requests: retry after 1',
+                    'parameters': {'retry_after': 1},
+                })
+                return
+            handler.send_json(200, {'ok': True, 'result': {
+                'message_id': len(self.sent),
+                'chat': {'id': chat_id, 'type': 'private'},
+                'date': int(time()),
+                'text': params['text'],
+            }})
+        elif method == 'getMe':
+            handler.send_json(200, {'ok': True, 'result': {
+                'id': 1, 'first_name': 'eddie', 'username': 'eddie_bot',
+            }})
+        elif method in ('setWebhook', 'deleteWebhook'):
+            handler.send_json(200, {'ok': True, 'result': True})
+        else:
+            handler.send_json(404, {'ok': False, 'error_code': 404,
+                                    'description': 'Not Found'})
+
+    def _get_updates(self, params):
+        """ Long polling: waits for updates newer than `offset`, at most for
+            `poll_timeout` seconds.
+        """
+        offset = int(params.get('offset') or 0)
+        limit = int(params.get('limit') or 100)
+        deadline = time() + min(float(params.get('timeout') or 0),
+                                self._poll_timeout)
+        with self._updates_condition:
+            # updates older than offset are confirmed, forget them
+            self._updates = [
+                update for update in self._updates
+                if update['update_id'] >= offset
+            ]
+            while not self._updates and self.running:
+                remaining = deadline - time()
+                if remaining <= 0:
+                    break
+                self._updates_condition.wait(remaining)
+            return self._updates[:limit]
+
+
+class FakeTwitterService(_FakeService):
+    """ Stand-in for the Twitter REST API and the user stream.
+
+        Point `TwitterEndpoint` to it using `api_host` and `stream_host`
+        (both `service.host`).
+
+        `tweepy` reads the stream in blocks of `chunk_size` bytes, so after
+        every burst of events the stream is padded with keep-alive newlines,
+        otherwise the last events would wait for the next ones.
+    """
+
+    bot_user = {'id': 1, 'id_str': '1', 'screen_name': 'eddie',
+                'name': 'eddie'}
+
+    def __init__(self, certfile, keep_alive=1.0, padding=512, **kwargs):
+        super(FakeTwitterService, self).__init__(certfile=certfile, **kwargs)
+        self._keep_alive = keep_alive
+        self._padding = b'\r\n' * padding
+        self._events = []
+        self._events_condition = Condition(Lock())
+        self._dm_id = 0
+        self.streams = 0
+        self.followers = []
+        self.friends = []
+
+    @property
+    def host(self):
+        """ The `api_host` and `stream_host` to give to `TwitterEndpoint` """
+        return 'localhost:%d' % self.port
+
+    def push_event(self, event):
+        """ Sends a raw `event` to the connected streams. """
+        with self._events_condition:
+            self._events.append(event)
+            self._events_condition.notify_all()
+
+    def push_message(self, text, user_id):
+        self._dm_id += 1
+        direct_message = {
+            'id': self._dm_id,
+            'id_str': str(self._dm_id),
+            'text': text,
+            'sender': {'id': user_id, 'screen_name': 'user%d' % user_id},
+            'sender_id': user_id,
+            'recipient': self.bot_user,
+            'recipient_id': self.bot_user['id'],
+        }
+        self._record_push()
+        self.push_event({'direct_message': direct_message})
+
+    def push_follower(self, user_id):
+        """ A new user follows the bot. """
+        self.followers.append(user_id)
+        self.push_event({
+            'event': 'follow',
+            'source': {'id': user_id, 'screen_name': 'user%d' % user_id},
+            'target': self.bot_user,
+        })
+
+    def route(self, handler, path, params):
+        if path == '/1.1/user.json':
+            self._stream(handler)
+        elif path == '/1.1/direct_messages/new.json':
+            user_id = int(params['user_id'])
+            if not self._record_send(user_id, params['text']):
+                handler.send_json(429, {'errors': [
+                    {'code': 88, 'message': 'Rate limit exceeded'}]})
+                return
+            handler.send_json(200, {'id': len(self.sent),
+                                    'text': params['text'],
+                                    'recipient_id': user_id})
+        elif path in ('/1.1/account/verify_credentials.json',
+                      '/1.1/users/show.json'):
+            handler.send_json(200, self.bot_user)
+        elif path == '/1.1/followers/ids.json':
+            handler.send_json(200, {'ids': self.followers, 'next_cursor': 0,
+                                    'previous_cursor': 0})
+        elif path == '/1.1/friends/ids.json':
+            handler.send_json(200, {'ids': self.friends, 'next_cursor': 0,
+                                    'previous_cursor': 0})
+        elif path == '/1.1/friendships/create.json':
+            self.friends.append(int(params['user_id']))
+            handler.send_json(200, {'id': int(params['user_id'])})
+        else:
+            handler.send_json(404, {'errors': [
+                {'code': 34, 'message': 'Sorry, that page does not exist'}]})
+
+    def _stream(self, handler):
+        """ Writes the events as a length delimited stream, until the client
+            disconnects or the service stops.
+        """
+        handler.close_connection = True
+        handler.send_response(200)
+        handler.send_header('Content-Type', 'application/json')
+        handler.send_header('Connection', 'close')
+        handler.end_headers()
+
+        sent = len(self._events)  # only the events arriving from now on
+        self.streams += 1
+        try:
+            while self.running:
+                with self._events_condition:
+                    if len(self._events) == sent:
+                        self._events_condition.wait(self._keep_alive)
+                    events = self._events[sent:]
+                    sent += len(events)
+                for event in events:
+                    data = json.dumps(event).encode('UTF-8')
+                    handler.wfile.write(str(len(data)).encode('ascii') +
+                                        b'\r\n' + data)
+                handler.wfile.write(self._padding if events else b'\r\n')
+                handler.wfile.flush()
+        except (IOError, OSError):
+            pass  # client disconnected
+        finally:
+            self.streams -= 1
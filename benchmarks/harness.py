@@ -0,0 +1,139 @@
+""" Measuring and reporting utilities used by the benchmark suite.
+
+    The results are plain dictionaries, so they can be dumped as JSON and
+    compared with the ones of a previous run to spot regressions.
+"""
+
+from __future__ import absolute_import, division
+import json
+import platform
+from time import time
+
+try:  # Python 3
+    from time import perf_counter as clock
+    import tracemalloc
+except ImportError:  # Python 2
+    from time import time as clock
+    tracemalloc = None
+
+import eddie
+
+
+# metrics where a higher value is worse
+_LOWER_IS_BETTER = ('p50_ms', 'p99_ms')
+# metrics where a lower value is worse
+_HIGHER_IS_BETTER = ('throughput',)
+
+
+def percentile(sorted_samples, fraction):
+    """ Returns the sample below which `fraction` (0..1) of the already sorted
+        `sorted_samples` fall, using the nearest-rank method.
+    """
+    if not sorted_samples:
+        return 0.0
+    index = int(round(fraction * (len(sorted_samples) - 1)))
+    return sorted_samples[index]
+
+
+def measure(operation, iterations, warmup=100, memory_iterations=1000):
+    """ Calls `operation()` `iterations` times timing every call, then returns
+        a dictionary with the latency percentiles (milliseconds), the
+        throughput (calls per second) and the peak memory (KiB) allocated by
+        the calls.
+
+        Memory is traced in a separate, shorter, pass because `tracemalloc`
+        slows down every allocation and would distort the latencies.
+    """
+    for _ in range(warmup):
+        operation()
+
+    latencies = []
+    start = clock()
+    for _ in range(iterations):
+        call_start = clock()
+        operation()
+        latencies.append(clock() - call_start)
+    elapsed = clock() - start
+
+    peak_memory = None
+    if tracemalloc is not None:
+        tracemalloc.start()
+        for _ in range(min(iterations, memory_iterations)):
+            operation()
+        peak_memory = tracemalloc.get_traced_memory()[1] / 1024.0
+        tracemalloc.stop()
+
+    return summarize(latencies, elapsed, peak_memory)
+
+
+def summarize(latencies, elapsed, peak_memory=None):
+    """ Builds the result of a benchmark given the `latencies` of every
+        operation and the total `elapsed` time, both in seconds.
+    """
+    latencies = sorted(latencies)
+    return {
+        'iterations': len(latencies),
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'mean_ms': sum(latencies) / max(len(latencies), 1) * 1000,
+        'throughput': len(latencies) / elapsed,
+        'peak_memory_kb': peak_memory,
+    }
+
+
+def write_results(results, path):
+    """ Writes the results to `path` as JSON, adding some information about
+        the environment they were collected in.
+    """
+    document = {
+        'meta': {
+            'eddie': eddie.__version__,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'timestamp': time(),
+        },
+        'results': results,
+    }
+    with open(path, 'w') as output_file:
+        json.dump(document, output_file, indent=2, sort_keys=True)
+
+
+def load_results(path):
+    """ Reads the results written by `write_results`. """
+    with open(path) as input_file:
+        return json.load(input_file)['results']
+
+
+def compare(results, baseline, tolerance=0.2):
+    """ Compares `results` with `baseline` and returns the list of the
+        regressions found, as human readable strings.
+
+        A metric is a regression when it is worse than the baseline by more
+        than `tolerance` (0.2 means 20%). Benchmarks missing from one of the
+        two runs are ignored.
+    """
+    regressions = []
+    for name in sorted(set(results) & set(baseline)):
+        current, previous = results[name], baseline[name]
+        for metric in _LOWER_IS_BETTER:
+            if current[metric] > previous[metric] * (1 + tolerance):
+                regressions.append('%s: %s %.3f -> %.3f' % (
+                    name, metric, previous[metric], current[metric]))
+        for metric in _HIGHER_IS_BETTER:
+            if current[metric] < previous[metric] * (1 - tolerance):
+                regressions.append('%s: %s %.1f -> %.1f' % (
+                    name, metric, previous[metric], current[metric]))
+    return regressions
+
+
+def format_table(results):
+    """ Returns the results as a text table, one benchmark per line. """
+    lines = ['%-28s %10s %10s %12s %12s' % (
+        'benchmark', 'p50 ms', 'p99 ms', 'ops/s', 'peak KiB')]
+    for name in sorted(results):
+        result = results[name]
+        peak_memory = result['peak_memory_kb']
+        lines.append('%-28s %10.3f %10.3f %12.1f %12s' % (
+            name, result['p50_ms'], result['p99_ms'], result['throughput'],
+            '-' if peak_memory is None else '%.1f' % peak_memory))
+    return '\n'.join(lines)
@@ -0,0 +1,566 @@
+""" The benchmarks: every function decorated with `@benchmark` receives the
+    number of iterations to run and returns the result of
+    `benchmarks.harness.measure`.
+
+    The whole message path is covered: `Bot.process` alone, the HTTP endpoint
+    over loopback and the Telegram/Twitter endpoints fed with fake updates
+    and fake API clients, so no network service is needed. The `*_service`
+    benchmarks use instead the local stand-in servers of
+    `benchmarks.fake_services`, measuring end-to-end latency and throughput
+    through the real HTTP stack of the endpoints' libraries.
+"""
+
+from __future__ import absolute_import
+import io
+import json
+import os
+import shutil
+import socket
+import tempfile
+from collections import namedtuple
+from time import sleep
+
+try:  # Python 3
+    from http.client import HTTPConnection
+    from urllib.parse import urlencode
+except ImportError:  # Python 2
+    from httplib import HTTPConnection
+    from urllib import urlencode
+
+import tweepy
+
+from eddie import faq
+from eddie.bot import Bot, command
+from eddie.broadcast import Broadcast
+from eddie.conversation_log import ConversationLog, JsonlWriter
+from eddie.endpoints import (
+    HttpEndpoint, RouterEndpoint, TelegramEndpoint, TwitterEndpoint
+)
+from eddie.endpoints.http import _HttpHandler, compile_routes
+from eddie.endpoints.twitter import MyStreamListener
+from eddie.flow import Flow
+from eddie.message import Message
+from eddie.scheduler import Scheduler
+
+from .fake_services import (
+    FakeTelegramService, FakeTwitterService, make_certificate
+)
+from .harness import clock, measure, summarize, tracemalloc
+
+
+BENCHMARKS = []
+
+
+def benchmark(function):
+    """ Decorator registering `function` in the list of benchmarks. """
+    BENCHMARKS.append(function)
+    return function
+
+
+class EchoBot(Bot):
+    "Echo bot with a command, the bot used by all the benchmarks"
+
+    def default_response(self, in_message):
+        return in_message
+
+    @command
+    def start(self):
+        "start command"
+        return 'Welcome!'
+
+
+def free_port():
+    """ Returns a TCP port nobody is listening on. """
+    sock = socket.socket()
+    sock.bind(('localhost', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+@benchmark
+def bot_process_default(iterations):
+    "Bot.process with a message handled by default_response"
+    bot = EchoBot()
+    return measure(lambda: bot.process('hello there'), iterations)
+
+
+@benchmark
+def bot_process_command(iterations):
+    "Bot.process with a command"
+    bot = EchoBot()
+    return measure(lambda: bot.process('/start'), iterations)
+
+
+@benchmark
+def bot_process_rate_limited(iterations):
+    "Bot.process checking the rate limit of 10000 different users"
+    bot = EchoBot()
+    bot.set_rate_limit(1000, max_keys=1000)
+    counter = [0]
+
+    def process():
+        "a message from the next user"
+        counter[0] += 1
+        bot.process('hello there', user=counter[0] % 10000)
+
+    return measure(process, iterations)
+
+
+@benchmark
+def bot_process_message(iterations, retained=100000):
+    "Bot.process with a Message, as the endpoints call it"
+    bot = EchoBot()
+    bot.set_rate_limit(1000, max_keys=1000)
+    counter = [0]
+
+    def process():
+        "a message from the next user"
+        counter[0] += 1
+        bot.process(Message('hello there', user=counter[0] % 10000,
+                            endpoint=bot))
+
+    # memory held by the messages themselves, scaled to a million of them
+    memory_per_million = None
+    if tracemalloc is not None:
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        messages = [Message('hello there', user=index, endpoint=bot)
+                    for index in range(retained)]
+        memory_per_million = (tracemalloc.get_traced_memory()[0] - before) \
+            * (1000000 / retained) / 2 ** 20
+        tracemalloc.stop()
+        del messages
+
+    result = measure(process, iterations)
+    result['memory_per_million_mb'] = memory_per_million
+    return result
+
+
+@benchmark
+def bot_process_flow(iterations, users=10000, retained=100000):
+    "Bot.process with 10000 users going around a three states flow"
+    bot = EchoBot()
+    survey = Flow('survey')
+    survey.state('first', 'First?', otherwise='second')
+    survey.state('second', 'Second?', otherwise='third')
+    survey.state('third', 'Third?', otherwise='first')
+    bot.add_flow(survey)
+    for user in range(users):
+        bot.process('/survey', user=user)
+    counter = [0]
+
+    def process():
+        "an answer of the next user"
+        counter[0] += 1
+        bot.process('an answer', user=counter[0] % users)
+
+    # memory held by the sessions, scaled to a million of them
+    memory_per_million = None
+    if tracemalloc is not None:
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        for user in range(users, users + retained):
+            bot.process('/survey', user=user)
+        memory_per_million = (tracemalloc.get_traced_memory()[0] - before) \
+            * (1000000 / retained) / 2 ** 20
+        tracemalloc.stop()
+
+    result = measure(process, iterations)
+    result['memory_per_million_sessions_mb'] = memory_per_million
+    return result
+
+
+@benchmark
+def bot_process_logged(iterations):
+    "Bot.process with a ConversationLog writing to a temporary JSONL file"
+    directory = tempfile.mkdtemp()
+    log = ConversationLog(JsonlWriter(os.path.join(directory, 'log.jsonl')))
+    bot = EchoBot()
+    bot.add_middleware(log)
+    try:
+        return measure(lambda: bot.process('hello there'), iterations)
+    finally:
+        log.close()
+        shutil.rmtree(directory)
+
+
+class NullEndpoint(object):
+    "Endpoint discarding the messages sent, after `delay` seconds"
+
+    def __init__(self, delay=0):
+        self.delay = delay
+
+    def set_bot(self, bot):
+        "nothing to register"
+        pass
+
+    def send_message(self, user_id, text):
+        "discards the message"
+        if self.delay:
+            sleep(self.delay)
+
+
+@benchmark
+def scheduler_timers(iterations, pending=100000):
+    "Scheduler.schedule with 100000 timers pending, fired in batches"
+    bot = EchoBot()
+    bot.add_endpoint(NullEndpoint())
+    scheduler = Scheduler(bot, workers=0)
+
+    # memory held by the timers, scaled to a million of them
+    memory_per_million = None
+    if tracemalloc is not None:
+        tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0] if tracemalloc else 0
+    for index in range(pending):
+        scheduler.schedule('NullEndpoint', index, 'Reminder', at=index)
+    if tracemalloc is not None:
+        memory_per_million = (tracemalloc.get_traced_memory()[0] - before) \
+            * (1000000 / pending) / 2 ** 20
+        tracemalloc.stop()
+    counter = [pending]
+
+    def schedule():
+        "a timer due after the pending ones"
+        counter[0] += 1
+        scheduler.schedule('NullEndpoint', counter[0], 'Reminder',
+                           at=counter[0])
+
+    result = measure(schedule, iterations)
+    start = clock()
+    fired = 0
+    while fired < pending:
+        fired += scheduler.run_pending(now=pending)
+    result['fired_per_second'] = fired / (clock() - start)
+    result['memory_per_million_mb'] = memory_per_million
+    return result
+
+
+@benchmark
+def broadcast(iterations, audience=1000):
+    "Broadcast to 1000 users of an endpoint taking 0.1 ms per send"
+    bot = EchoBot()
+    endpoint = NullEndpoint(delay=0.0001)
+    bot.add_endpoint(endpoint)
+    reports = []
+
+    def send():
+        "one broadcast"
+        reports.append(Broadcast(bot, 'News!', range(audience), endpoint,
+                                 parallelism=8).run())
+
+    # a call is a whole broadcast
+    result = measure(send, max(iterations // audience, 1), warmup=1,
+                     memory_iterations=1)
+    result['delivered_per_second'] = \
+        sum(report['delivered'] for report in reports) / \
+        sum(report['seconds'] for report in reports)
+    return result
+
+
+@benchmark
+def http_loopback(iterations):
+    "GET /process on a HttpEndpoint listening on loopback"
+    bot = EchoBot()
+    endpoint = HttpEndpoint(port=free_port())
+    bot.add_endpoint(endpoint)
+    bot.run()
+
+    path = '/process?' + urlencode({'in_message': 'hello there'})
+
+    def request():
+        "one request, the endpoint closes the connection after each reply"
+        conn = HTTPConnection(endpoint.host, endpoint.port)
+        conn.request('GET', path)
+        conn.getresponse().read()
+        conn.close()
+
+    try:
+        return measure(request, iterations)
+    finally:
+        bot.stop()
+
+
+@benchmark
+def router_tenants(iterations, tenants=200):
+    "GET /<bot>/process on a RouterEndpoint serving 200 bots"
+    router = RouterEndpoint(port=0)
+
+    # memory allocated by adding a bot, router entry and compiled bot
+    if tracemalloc is not None:
+        tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0] if tracemalloc else 0
+    for index in range(tenants):
+        router.add_bot('bot%d' % index, EchoBot())
+    memory_per_bot = None
+    if tracemalloc is not None:
+        memory_per_bot = (
+            tracemalloc.get_traced_memory()[0] - before) / tenants / 1024.0
+        tracemalloc.stop()
+
+    router.run()
+    paths = ['/bot%d/process?%s' % (index, urlencode({'in_message': 'hi'}))
+             for index in range(tenants)]
+    counter = [0]
+
+    def request():
+        "one request to the next bot"
+        counter[0] += 1
+        conn = HTTPConnection(router.host, router.port)
+        conn.request('GET', paths[counter[0] % tenants])
+        conn.getresponse().read()
+        conn.close()
+
+    try:
+        result = measure(request, iterations)
+    finally:
+        router.stop()
+    result['memory_per_bot_kb'] = memory_per_bot
+    return result
+
+
+def _dispatch_benchmark(commands):
+    """ Returns a benchmark of `_HttpHandler.dispatch` for a bot with
+        `commands` commands, without sockets: the handler writes to memory.
+    """
+    def dispatch(iterations):
+        bot_class = type('ManyCommandsBot', (EchoBot,), dict(
+            ('command%d' % index, command(lambda self: 'ok'))
+            for index in range(commands)
+        ))
+        server = namedtuple('Server', 'bot endpoint routes')(
+            bot_class(), None, compile_routes(bot_class()))
+        handler = _HttpHandler.__new__(_HttpHandler)
+        handler.server = server
+        handler.client_address = ('127.0.0.1', 0)
+        handler.request_version = 'HTTP/1.0'
+        handler.requestline = 'GET / HTTP/1.0'
+        handler.log_request = lambda *args: None
+        paths = ['/process?in_message=hello', '/command%d' % (commands - 1),
+                 '/healthz', '/missing']
+
+        def request():
+            "dispatches the requests and discards the responses"
+            for path in paths:
+                handler.path = path
+                handler.wfile = io.BytesIO()
+                handler.dispatch('GET')
+
+        return measure(request, iterations)
+
+    dispatch.__name__ = 'http_dispatch_%d_routes' % commands
+    dispatch.__doc__ = ('_HttpHandler.dispatch of 4 requests, with %d bot '
+                        'commands' % commands)
+    return benchmark(dispatch)
+
+
+_dispatch_benchmark(10)
+_dispatch_benchmark(1000)
+
+
+if faq.numpy is not None:
+    @benchmark
+    def faq_answer(iterations, entries=10000):
+        "FaqResponder.answer with 10000 questions"
+        responder = faq.FaqResponder()
+        responder.extend(
+            ('how do I configure feature number %d of the product?' % index,
+             'answer %d' % index)
+            for index in range(entries)
+        )
+        return measure(
+            lambda: responder.answer('configure feature 1234 please'),
+            iterations)
+
+
+_TelegramMessage = namedtuple('_TelegramMessage',
+                              'text chat_id from_user reply_text')
+_TelegramUpdate = namedtuple('_TelegramUpdate', 'update_id effective_message')
+
+
+@benchmark
+def telegram_message(iterations):
+    "TelegramEndpoint message handler, replying through a fake update"
+    bot = EchoBot()
+    # reply in the calling thread, to time the whole path
+    endpoint = TelegramEndpoint(token='123:ABC', workers=0)
+    bot.add_endpoint(endpoint)
+
+    replies = []
+    update = _TelegramUpdate(
+        1, _TelegramMessage('hello there', 2, None, replies.append))
+
+    def handle():
+        "handles the update and discards the reply"
+        endpoint.default_message_handler(None, update)
+        del replies[:]
+
+    return measure(handle, iterations)
+
+
+class _FakeTwitterApi(object):
+    """ Stand-in for `tweepy.API` implementing just the calls used by
+        `TwitterEndpoint` when processing a direct message.
+    """
+
+    _Me = namedtuple('_Me', 'id')
+
+    def __init__(self):
+        self.sent = 0
+
+    def verify_credentials(self):
+        "the bot's own user"
+        return self._Me(id=1)
+
+    def send_direct_message(self, text, user_id):
+        "counts the messages sent"
+        self.sent += 1
+
+
+@benchmark
+def twitter_direct_message(iterations):
+    "TwitterEndpoint stream listener parsing and answering direct messages"
+    bot = EchoBot()
+    endpoint = TwitterEndpoint(
+        consumer_key='', consumer_secret='',
+        access_token='', access_token_secret='',
+        workers=0  # reply in the calling thread, to time the whole path
+    )
+    endpoint._api = _FakeTwitterApi()
+    bot.add_endpoint(endpoint)
+
+    listener = MyStreamListener()
+    listener.set_endpoint(endpoint)
+    counter = [0]
+
+    def receive():
+        "feeds the listener a new direct message"
+        counter[0] += 1
+        listener.on_data(json.dumps({'direct_message': {
+            'id': counter[0],
+            'text': 'hello there',
+            'sender': {'id': 2, 'screen_name': 'greenkey'},
+        }}))
+
+    return measure(receive, iterations)
+
+
+_TWEET = json.dumps({
+    'id': 850006245121695744,
+    'text': 'a tweet the bot is not interested in, ' * 5,
+    'user': {'id': 2, 'screen_name': 'greenkey', 'followers_count': 10},
+    'entities': {'hashtags': [], 'urls': [], 'user_mentions': []},
+    'retweet_count': 0,
+})
+
+
+@benchmark
+def twitter_ignored_event(iterations):
+    "TwitterEndpoint stream listener discarding an event it does not use"
+    endpoint = TwitterEndpoint(
+        consumer_key='', consumer_secret='',
+        access_token='', access_token_secret=''
+    )
+    listener = MyStreamListener()
+    listener.set_endpoint(endpoint)
+    return measure(lambda: listener.on_data(_TWEET), iterations)
+
+
+class _DownTwitterApi(_FakeTwitterApi):
+    """ `_FakeTwitterApi` timing out every DM after `delay` seconds. """
+
+    def __init__(self, delay):
+        super(_DownTwitterApi, self).__init__()
+        self.delay = delay
+
+    def send_direct_message(self, text, user_id):
+        "waits, then fails"
+        self.sent += 1
+        sleep(self.delay)
+        raise tweepy.TweepError('Read timed out.')
+
+
+@benchmark
+def twitter_degraded(iterations):
+    "TwitterEndpoint.send_message with Twitter timing out after 50 ms"
+    endpoint = TwitterEndpoint(
+        consumer_key='', consumer_secret='',
+        access_token='', access_token_secret=''
+    )
+    endpoint._api = api = _DownTwitterApi(delay=0.05)
+
+    def send():
+        "a DM, failing"
+        try:
+            endpoint.send_message(2, 'hello there')
+        except Exception:  # pylint: disable=broad-except
+            pass
+
+    result = measure(send, iterations)
+    # the calls that waited for the timeout, the others failed right away
+    result['calls_to_twitter'] = api.sent
+    return result
+
+
+def _replay_through(service, iterations):
+    """ Replays `iterations` messages through a fake service as fast as
+        possible and waits for all the replies.
+    """
+    start = clock()
+    service.replay(['hello there'] * iterations)
+    if not service.wait_sent(iterations):
+        raise RuntimeError('only %d/%d replies received' % (
+            len(service.sent), iterations))
+    return summarize(service.latencies(), clock() - start)
+
+
+@benchmark
+def telegram_service(iterations):
+    "TelegramEndpoint long polling a local fake Bot API server"
+    iterations = max(iterations // 10, 1)
+    service = FakeTelegramService()
+    service.start()
+
+    bot = EchoBot()
+    bot.add_endpoint(TelegramEndpoint(token='123:ABC',
+                                      base_url=service.base_url))
+    bot.run()
+    try:
+        return _replay_through(service, iterations)
+    finally:
+        bot.stop()
+        service.stop()
+
+
+@benchmark
+def twitter_service(iterations):
+    "TwitterEndpoint reading the stream of a local fake Twitter server"
+    iterations = max(iterations // 10, 1)
+    directory = tempfile.mkdtemp()
+    certfile = make_certificate(directory)
+    service = FakeTwitterService(certfile=certfile)
+    service.start()
+
+    bot = EchoBot()
+    endpoint = TwitterEndpoint(
+        consumer_key='key', consumer_secret='secret',
+        access_token='token', access_token_secret='token_secret',
+        api_host=service.host, stream_host=service.host
+    )
+    bot.add_endpoint(endpoint)
+    ca_bundle = os.environ.get('REQUESTS_CA_BUNDLE')
+    os.environ['REQUESTS_CA_BUNDLE'] = certfile
+    try:
+        bot.run()
+        while not service.streams:
+            sleep(0.1)
+        return _replay_through(service, iterations)
+    finally:
+        bot.stop()
+        service.stop()
+        if ca_bundle is None:
+            del os.environ['REQUESTS_CA_BUNDLE']
+        else:
+            os.environ['REQUESTS_CA_BUNDLE'] = ca_bundle
+        shutil.rmtree(directory)
@@ -1,3 +1,6 @@
 import sys
 
-collect_ignore = ["setup.py"]
+collect_ignore = ["setup.py", "benchmarks"]
+
+if sys.version_info < (3, 5):
+    collect_ignore.append("tests/async_test.py")
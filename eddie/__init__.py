@@ -4,6 +4,21 @@
 
     * bot, the Bot class itself, used to create your bot
     * endpoints, the classes to connect to bot services
+    * message, the messages received by the endpoints
+    * flow, the multi-step conversations
+    * scheduler, the messages sent at a given time
+    * broadcast, the messages sent to a whole audience
+    * pool, the thread pool processing messages in background
+    * outbound, the background delivery of the replies
+    * metrics, counters and timings
+    * connection, the pooled http client shared by the endpoints
+    * replay, the command line tool replaying conversation logs
+    * conversation_log, the structured log of the processed messages
+    * ratelimit, the rate limits of the users
+    * profiling, the profiler of the slow messages
+    * faq, answers from a list of frequently asked questions
+    * singleflight, the sharing of identical executions in progress
+    * resilience, the circuit breakers and bulkheads of the outbound calls
 """
 
 __author__ = """Lorenzo Mele"""
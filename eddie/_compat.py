@@ -0,0 +1,28 @@
+""" Python 2 and 3 compatibility helpers shared by the modules of eddie. """
+
+from __future__ import absolute_import
+import os
+
+try:  # Python 2
+    string_types = basestring  # noqa: F821 pylint: disable=undefined-variable
+except NameError:  # Python 3
+    string_types = str
+
+try:  # Python 2
+    text_type = unicode  # noqa: F821 pylint: disable=undefined-variable
+except NameError:  # Python 3
+    text_type = str
+
+try:  # Python 3
+    from time import monotonic as clock
+    from time import perf_counter as perf_clock
+except ImportError:  # Python 2
+    from time import time as clock, time as perf_clock
+
+# atomic, replacing the destination on Windows too (Python 3.3+)
+replace = getattr(os, 'replace', os.rename)
+
+
+def json_text(value):
+    """ `json.dumps` returns `str`, bytes on Python 2. """
+    return value.decode('utf-8') if isinstance(value, bytes) else value
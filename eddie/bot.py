@@ -1,5 +1,29 @@
 """A library to easily build chatbots."""
 
+from __future__ import absolute_import
+import sys
+import threading
+
+from .broadcast import Broadcast
+from .flow import NOT_IN_FLOW, FlowEngine, SessionStore
+from .message import Message
+from .metrics import Metrics
+from .pool import WorkerPool
+from .profiling import SlowMessageProfiler
+from .ratelimit import RateLimiter
+from .scheduler import Scheduler
+from .singleflight import SingleFlight
+
+try:  # Python 3.4+
+    import asyncio
+except ImportError:  # Python 2
+    asyncio = None
+
+try:  # Python 3.4+
+    from importlib import reload as reload_module
+except ImportError:  # Python 2, 3.3
+    from imp import reload as reload_module
+
 
 class Bot(object):
     """ The main class to create your bots.
@@ -29,9 +53,41 @@ class Bot(object):
 
     """
 
+    timeout_response = "Sorry, I can't answer right now."
+    rate_limited_response = "You are sending too many messages, slow down."
+
     def __init__(self):
         self.command_prepend = "/"
         self.endpoints = []
+        self.middlewares = []
+        self.flows = []
+        self.sessions = SessionStore()
+        self.metrics = Metrics()
+        self.profiler = None
+        self.scheduler = None
+        self._single_flight = SingleFlight(self.metrics)
+        self._timeout = None
+        self._rate_limits = {}
+        self._commands = {}
+        self._default_handler = None
+        self._flow_engine = None
+        self._handler = None
+
+    @property
+    def timeout(self):
+        """ Seconds the commands and `default_response` have to answer, the
+            `@command(timeout=...)` ones excluded. None (the default) means
+            no deadline.
+
+            When the deadline passes `timeout_response` is returned in place
+            of the reply and `timeouts` is incremented in `self.metrics`.
+        """
+        return self._timeout
+
+    @timeout.setter
+    def timeout(self, value):
+        self._timeout = value
+        self._handler = None
 
     @property
     def command_names(self):
@@ -62,17 +118,178 @@ class Bot(object):
         """
         pass
 
-    def process(self, in_message):
+    def process(self, in_message, user=None, endpoint=None):
         """ This methos is called to process every message sent to the bot.
 
-            The only purpose is to understand if it's a command or not and
-            then to pass the message to the right method.
+            The message goes through the middlewares (see `add_middleware`),
+            then the bot understands if it's a command or not and passes the
+            message to the right method.
+
+            `in_message` is the text of the message or an
+            `eddie.message.Message`, as the endpoints pass it: the
+            middlewares and the handlers receive its text.
+
+            `user` and `endpoint` identify the sender (the ones of the
+            `Message` by default), for the rate limits (see
+            `set_rate_limit`): a message over the limits is answered with
+            `rate_limited_response` before reaching any handler.
+        """
+        if isinstance(in_message, Message):
+            if user is None:
+                user = in_message.user
+            if endpoint is None:
+                endpoint = in_message.endpoint
+            in_message = in_message.text
+
+        if self._rate_limits and user is not None and \
+                not self._admit(in_message, (user, endpoint)):
+            self.metrics.incr('rate_limited')
+            return self.rate_limited_response
+
+        handler = self._handler
+        if handler is None:
+            handler = self.compile()
+        return handler(in_message, (user, endpoint))
+
+    def set_rate_limit(self, rate, burst=None, command=None,
+                       max_keys=100000):
+        """ Limits the messages of every user (on every endpoint) to `rate`
+            per second, with bursts of `burst` messages. With `command` the
+            limit applies only to that command, on top of the limit for all
+            the messages.
+
+            Example usage:
+
+                >>> bot.set_rate_limit(1, burst=5)  # all the messages
+                >>> bot.set_rate_limit(0.1, command='report')
+
+            See `eddie.ratelimit.RateLimiter` for `max_keys`.
+        """
+        self._rate_limits[command] = RateLimiter(rate, burst, max_keys)
+
+    def _admit(self, in_message, sender):
+        """ Returns true if the message of `sender` is within the limits.
+            A message rejected by one limit takes no token from the other.
+        """
+        per_command = None
+        if in_message.startswith(self.command_prepend):
+            per_command = self._rate_limits.get(
+                in_message[len(self.command_prepend):])
+            if per_command is not None and not per_command.allow(sender):
+                return False
+        limiter = self._rate_limits.get(None)
+        if limiter is None or limiter.allow(sender):
+            return True
+        if per_command is not None:
+            per_command.refund(sender)
+        return False
+
+    def add_flow(self, flow):
+        """ Adds a dialogue flow (see `eddie.flow.Flow`) to the bot: the
+            command of the flow starts it, then the messages of the user go
+            through the flow until its end, before the commands and
+            `default_response`.
+
+            Example usage:
+
+                >>> survey = Flow('survey')
+                >>> survey.state('rating', 'From 1 to 5?', otherwise='done')
+                >>> survey.state('done', 'Thank you!')
+                >>> bot.add_flow(survey)
+                >>> bot.process('/survey', user=42)
+                'From 1 to 5?'
+
+            The flows need to know the sender: messages without `user` (see
+            `process`) don't take part in them. The state of every user is
+            kept in `self.sessions`.
+        """
+        self.flows.append(flow)
+        self._handler = None
+
+    def add_middleware(self, middleware):
+        """ Adds a middleware to the bot, middlewares are called in the order
+            they are added for every message processed by the bot.
+
+            A middleware is a callable receiving the bot, the message and the
+            next handler of the chain: it can change the message before
+            passing it on, change the reply or answer by itself without
+            calling the next handler at all (short-circuit).
+
+            Example usage:
+
+                >>> def lower(bot, in_message, next_handler):
+                ...     return next_handler(in_message.lower())
+                ...
+                >>> bot.add_middleware(lower)
+
+            See `Middleware` for a base class with pre and post processing
+            hooks. Coroutine functions (`async def`) can be used too, they
+            receive a `next_handler` returning an awaitable.
         """
-        if (in_message.startswith(self.command_prepend) and
-                in_message[1:] in self.command_names):
-            command_handler = getattr(self, in_message[1:])
-            return command_handler()
-        return self.default_response(in_message)
+        self.middlewares.append(middleware)
+        self._handler = None
+
+    def enable_profiling(self, threshold=0.5, keep=20, sample_rate=0.1):
+        """ Keeps track of the `keep` messages taking more than `threshold`
+            seconds, profiling a `sample_rate` fraction of all the messages.
+
+            Returns the `eddie.profiling.SlowMessageProfiler`, also available
+            as `self.profiler`, see it for the details. It's the first
+            middleware, so the time of the whole chain is measured.
+        """
+        self.profiler = SlowMessageProfiler(threshold, keep, sample_rate)
+        self.middlewares.insert(0, self.profiler)
+        self._handler = None
+        return self.profiler
+
+    def enable_scheduler(self, filename=None, batch_size=256):
+        """ Lets the bot send messages by itself, at a given time, through
+            its endpoints: reminders, digests...
+
+            Returns the `eddie.scheduler.Scheduler`, also available as
+            `self.scheduler`, see it for the details. The timers are kept in
+            `filename`, if given, so they survive a restart. The scheduler
+            runs with the bot (see `run` and `stop`).
+        """
+        self.scheduler = Scheduler(self, filename, batch_size)
+        return self.scheduler
+
+    def compile(self):
+        """ Builds the call chain used by `process`: the middlewares, the
+            table of the commands and the tables of the flows.
+
+            This is done when adding endpoints and running the bot, so the
+            work is not repeated for every message, or by the first message
+            processed.
+        """
+        commands = {}
+        for name in self.command_names:
+            method = getattr(self, name)
+            timeout = getattr(method, 'timeout', None)
+            handler = _with_deadline(
+                self, method, self.timeout if timeout is None else timeout)
+            if getattr(method, 'cacheable', False):
+                handler = _single_flight(self, handler, name)
+            commands[name] = handler
+        default_handler = _with_deadline(self, self.default_response,
+                                         self.timeout)
+        if getattr(self.default_response, 'cacheable', False):
+            default_handler = _single_flight(self, default_handler)
+        # the tables are bound to the chain: a chain being replaced (see
+        # `reload`) keeps using its own
+        handler = _dispatcher(self.command_prepend, commands, default_handler)
+        flow_engine = None
+        if self.flows:
+            flow_engine = FlowEngine(self.flows, self.sessions,
+                                     self.command_prepend)
+            handler = _flow_dispatcher(self, flow_engine, handler)
+        for middleware in reversed(self.middlewares):
+            handler = _chain(self, middleware, handler)
+        self._commands = commands
+        self._default_handler = default_handler
+        self._flow_engine = flow_engine
+        self._handler = handler
+        return handler
 
     def add_endpoint(self, endpoint):
         """ Adds and endpoint to your bot object.
@@ -96,11 +313,97 @@ class Bot(object):
         """
         endpoint.set_bot(self)
         self.endpoints.append(endpoint)
+        self.compile()
+
+    def broadcast(self, message, audience, endpoint=None, parallelism=8,
+                  rate=None, checkpoint=None):
+        """ Sends `message` to every recipient of `audience`, an iterable of
+            `(endpoint, user_id)` (or of user ids, all on `endpoint`), read
+            lazily as the messages are sent.
+
+            Example usage:
+
+                >>> bot.broadcast('New version!', chat_ids(), telegram,
+                ...               rate=30, checkpoint='announcement.json')
+                {'delivered': 12000, 'failed': 3, 'skipped': 0,
+                 'seconds': 400.2, 'delivered_per_second': 29.98}
+
+            Every endpoint sends with `parallelism` threads and at most
+            `rate` messages per second. See `eddie.broadcast.Broadcast` for
+            the details and `checkpoint`.
+        """
+        return Broadcast(self, message, audience, endpoint, parallelism, rate,
+                         checkpoint).run()
+
+    def get_endpoint(self, name):
+        """ Returns the endpoint of the bot whose class is named `name` (i.e.
+            `'TelegramEndpoint'`), None if there is none.
+        """
+        for endpoint in self.endpoints:
+            if type(endpoint).__name__ == name:
+                return endpoint
+        return None
+
+    def reload(self, bot=None):
+        """ Puts new code behind the running endpoints, without stopping
+            them: no connection is closed.
+
+            `bot` can be:
+
+            * None (default), the module of the bot's class is imported again
+              and an instance of the new version of its class takes the place
+              of this bot
+            * a class, an instance of it takes the place of this bot
+            * an instance, it takes the place of this bot, with its
+              endpoints (and scheduler, if it has none)
+
+            Example usage:
+
+                >>> import mybot
+                >>> bot = mybot.MyBot()
+                >>> bot.add_endpoint(TelegramEndpoint(token='123:ABC'))
+                >>> bot.run()
+                ... # mybot.py changes
+                >>> bot = bot.reload()
+
+            The new call chain is built before replacing the old one, at
+            once: the messages being processed finish with the old code (and
+            the old instance), the next ones use the new one. With a class
+            the instance is created without calling `__init__`, sharing the
+            state of this bot (middlewares, rate limits, sessions,
+            metrics...), with an instance the state is the one of the
+            instance.
+
+            Returns the bot now behind the endpoints.
+        """
+        if bot is None:
+            cls = type(self)
+            module = reload_module(sys.modules[cls.__module__])
+            bot = getattr(module, cls.__name__)
+
+        if isinstance(bot, type):
+            bot = bot.__new__(bot)
+            bot.__dict__.update(self.__dict__)
+        if bot is not self:
+            bot.endpoints, self.endpoints = self.endpoints, []
+            if self.scheduler is not None and \
+                    bot.scheduler in (None, self.scheduler):
+                bot.scheduler, self.scheduler = self.scheduler, None
+                bot.scheduler.bot = bot
+
+        bot.compile()
+        for endpoint in bot.endpoints:
+            endpoint.set_bot(bot)
+        bot.metrics.incr('reloads')
+        return bot
 
     def run(self):
         """ Call the endpoint's run method, to start receving messages and
             process them.
         """
+        self.compile()
+        if self.scheduler is not None:
+            self.scheduler.start()
         for endpoint in self.endpoints:
             endpoint.run()
 
@@ -109,10 +412,12 @@ class Bot(object):
         """
         for endpoint in self.endpoints:
             endpoint.stop()
+        if self.scheduler is not None:
+            self.scheduler.stop()
 
 
 # decorator
-def command(method):
+def command(method=None, timeout=None):
     """ This is a decorator, put `@command` on top of the methods you want to
         set as command of your bot.
 
@@ -122,11 +427,285 @@ def command(method):
             ...     @command
             ...     def hello(self):
             ...             return "hello!"
+            ...     @command(timeout=5)
+            ...     def report(self):
+            ...             return build_a_slow_report()
             ...
             >>> bot = MyBot()
             >>> bot.process("/hello") # the default command prepend is "/"
             'hello!'
 
+        `timeout` is the deadline of the command in seconds, overriding the
+        one of the bot (see `Bot.timeout`).
     """
-    method.is_command = True
+    def decorator(method):
+        "marks the method as command"
+        method.is_command = True
+        method.timeout = timeout
+        return method
+
+    if method is None:
+        return decorator
+    return decorator(method)
+
+
+# decorator
+def cacheable(method):
+    """ Put `@cacheable` on top of the commands (or of `default_response`)
+        that give the same reply to the same message: the identical messages
+        processed at the same time are answered with a single execution.
+
+        Example usage:
+
+            >>> class MyBot(Bot):
+            ...     @command
+            ...     @cacheable
+            ...     def start(self):
+            ...             return load_welcome_message()
+            ...
+
+        The saved executions are counted in `bot.metrics` (see
+        `eddie.singleflight.SingleFlight`).
+    """
+    method.cacheable = True
     return method
+
+
+class Middleware(object):
+    """ Base class for middlewares with pre and post processing hooks,
+        redefine `before` and/or `after`.
+
+        Example usage:
+
+            >>> class Strip(Middleware):
+            ...     def before(self, bot, in_message):
+            ...         return in_message.strip()
+            ...
+            >>> bot.add_middleware(Strip())
+
+        To answer without calling the rest of the chain, redefine `__call__`.
+    """
+
+    def before(self, bot, in_message):
+        """ Called with the incoming message, returns the message to pass to
+            the next handler.
+        """
+        return in_message
+
+    def after(self, bot, in_message, out_message):
+        """ Called with the reply of the next handler, returns the reply to
+            give back.
+        """
+        return out_message
+
+    def __call__(self, bot, in_message, next_handler):
+        in_message = self.before(bot, in_message)
+        return self.after(bot, in_message, next_handler(in_message))
+
+
+def _is_coroutine_function(function):
+    """ Returns true if `function` (or its `__call__`) is defined with
+        `async def`.
+    """
+    if asyncio is None:
+        return False
+    return (asyncio.iscoroutinefunction(function) or
+            asyncio.iscoroutinefunction(getattr(function, '__call__', None)))
+
+
+_loops = threading.local()
+
+
+def _run_coroutine(coroutine):
+    """ Runs `coroutine` to completion in the event loop of the current
+        thread, creating it if needed.
+
+        If the loop is already running (an async middleware calling a sync
+        one calling an async one) the coroutine runs in a new thread.
+    """
+    loop = getattr(_loops, 'loop', None)
+    if loop is None:
+        loop = _loops.loop = asyncio.new_event_loop()
+    if not loop.is_running():
+        return loop.run_until_complete(coroutine)
+
+    result = []
+    thread = threading.Thread(
+        target=lambda: result.append(_run_coroutine(coroutine)))
+    thread.start()
+    thread.join()
+    return result[0]
+
+
+class _DeadlineRunner(object):
+    """ Runs the calls with a deadline in the threads of a pool while one
+        is free, in a new thread otherwise: the calls hung past their
+        deadline keep their threads busy, but can't starve the others.
+    """
+
+    def __init__(self, workers=16):
+        self._pool = WorkerPool(workers=workers, name='eddie-deadline')
+        self._idle = workers
+        self._lock = threading.Lock()
+
+    def run(self, bot, call, function, args):
+        "executes `call.run(function, args)` in another thread"
+        with self._lock:
+            pooled = self._idle > 0
+            if pooled:
+                self._idle -= 1
+        if pooled:
+            self._pool.submit(self._run_pooled, call, function, args)
+            return
+        bot.metrics.incr('deadline_threads')
+        thread = threading.Thread(target=call.run, args=(function, args),
+                                  name='eddie-deadline-extra')
+        thread.daemon = True
+        thread.start()
+
+    def _run_pooled(self, call, function, args):
+        "runs the call in a worker, then marks it idle again"
+        try:
+            call.run(function, args)
+        finally:
+            with self._lock:
+                self._idle += 1
+
+
+_deadline_runner = _DeadlineRunner()
+
+
+class _Call(object):
+    """ A call executed in another thread, `done` is set when it returns. """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = self.error = None
+
+    def run(self, function, args):
+        "executes the call"
+        try:
+            self.result = function(*args)
+        except Exception as error:  # pylint: disable=broad-except
+            self.error = error
+        self.done.set()
+
+
+def _with_deadline(bot, function, timeout):
+    """ Returns a callable calling `function` and answering with
+        `bot.timeout_response` if it doesn't return within `timeout` seconds.
+
+        Sync functions run in the threads of a shared pool (a function
+        passing its deadline keeps a thread busy until it returns, when all
+        of them are busy the call gets a new thread, counted in the
+        `deadline_threads` metric), coroutine functions are awaited with
+        `asyncio.wait_for`.
+    """
+    if _is_coroutine_function(function):
+        if timeout is None:
+            return lambda *args: _run_coroutine(function(*args))
+
+        def wait_coroutine(*args):
+            "runs the coroutine with a deadline"
+            try:
+                return _run_coroutine(
+                    asyncio.wait_for(function(*args), timeout))
+            except asyncio.TimeoutError:
+                bot.metrics.incr('timeouts')
+                return bot.timeout_response
+        return wait_coroutine
+
+    if timeout is None:
+        return function
+
+    def wait_call(*args):
+        "runs the function in another thread with a deadline"
+        call = _Call()
+        _deadline_runner.run(bot, call, function, args)
+        if not call.done.wait(timeout):
+            bot.metrics.incr('timeouts')
+            return bot.timeout_response
+        if call.error is not None:
+            raise call.error
+        return call.result
+    return wait_call
+
+
+def _single_flight(bot, function, command_name=None):
+    """ Returns a callable sharing the executions of `function` for the same
+        command (`command_name`) or, for `default_response`, message.
+    """
+    if command_name is not None:
+        key = ('command', command_name)
+        return lambda: bot._single_flight.do(key, function)
+    return lambda in_message: bot._single_flight.do(
+        ('default', in_message), function, in_message)
+
+
+def _dispatcher(command_prepend, commands, default_handler):
+    """ Returns the last step of the call chain: passing the message to the
+        command in `commands` or to `default_handler`.
+    """
+    def dispatch(in_message, sender=None):  # pylint: disable=unused-argument
+        "calls the command or the default handler"
+        if in_message.startswith(command_prepend):
+            command_handler = commands.get(in_message[len(command_prepend):])
+            if command_handler is not None:
+                return command_handler()
+        return default_handler(in_message)
+    return dispatch
+
+
+def _flow_dispatcher(bot, flow_engine, next_handler):
+    """ Returns the last step of the call chain of a bot with flows: passing
+        the message to the flow of the sender, if any, or to `next_handler`.
+    """
+    def dispatch(in_message, sender=None):
+        "calls the flow engine or the next handler"
+        user, endpoint = sender or (None, None)
+        if user is not None:
+            out_message = flow_engine.handle(bot, user, endpoint, in_message)
+            if out_message is not NOT_IN_FLOW:
+                return out_message
+        return next_handler(in_message, sender)
+    return dispatch
+
+
+def _chain(bot, middleware, next_handler):
+    """ Returns the handler calling `middleware` with `next_handler` as the
+        rest of the chain.
+
+        The handlers of the chain receive the message and its sender, a
+        `(user, endpoint)` pair: the middlewares see only the message, the
+        sender is passed on along the chain (even if a middleware runs it in
+        another thread) for the flows at its end.
+
+        The handlers of async middlewares have a `coroutine` attribute, so
+        that consecutive async middlewares await each other in the same loop.
+    """
+    if not _is_coroutine_function(middleware):
+        def handler(in_message, sender=None):
+            "calls the middleware"
+            return middleware(bot, in_message,
+                              lambda message: next_handler(message, sender))
+        return handler
+
+    next_coroutine = getattr(next_handler, 'coroutine', None)
+    if next_coroutine is None:
+        def next_coroutine(in_message, sender=None):
+            "the rest of the chain, as an already completed future"
+            future = asyncio.Future()
+            future.set_result(next_handler(in_message, sender))
+            return future
+
+    def coroutine(in_message, sender=None):
+        "the awaitable result of the middleware"
+        return middleware(bot, in_message,
+                          lambda message: next_coroutine(message, sender))
+
+    def handler(in_message, sender=None):
+        "runs the async middleware"
+        return _run_coroutine(coroutine(in_message, sender))
+
+    handler.coroutine = coroutine
+    return handler
@@ -0,0 +1,214 @@
+""" Broadcasts: the same message sent to a whole audience (every follower,
+    every chat...) through the endpoints of a bot.
+"""
+
+from __future__ import absolute_import, division
+import io
+import json
+import logging
+import os
+from itertools import islice
+from threading import Lock, Thread
+from time import sleep
+
+try:  # Python 3
+    from queue import Queue
+except ImportError:  # Python 2
+    from Queue import Queue
+
+from ._compat import json_text, perf_clock, replace, string_types
+from .ratelimit import RateLimiter
+from .resilience import BulkheadFullError, CircuitOpenError
+
+_STOP = object()
+
+
+class Broadcast(object):
+    """ Sends `message` to every recipient of `audience` through the
+        endpoints of `bot` (their `send_message(user_id, text)`).
+
+        `audience` is an iterable of `(endpoint, user_id)`, or of user ids
+        if `endpoint` is given, where the endpoint is an endpoint of the bot
+        or the name of its class. It's consumed lazily: recipients are read
+        from it only as fast as they are sent, so it can be a generator
+        reading a file or a database cursor.
+
+        Every endpoint sends with `parallelism` threads, at most `rate`
+        messages per second if given. A send rejected by the bulkhead of the
+        endpoint (see `eddie.resilience.Bulkhead`), busy with more calls than
+        it allows, is tried again: it was not made. So is a send rejected by
+        its open circuit (see `eddie.resilience.CircuitBreaker`), once the
+        circuit lets the calls through again.
+
+        Example usage:
+
+            >>> def followers():
+            ...     for row in database.execute('SELECT chat_id FROM chats'):
+            ...         yield row[0]
+            ...
+            >>> report = Broadcast(bot, 'New version!', followers(),
+            ...                    endpoint=telegram, rate=30,
+            ...                    checkpoint='broadcast.json').run()
+            >>> report['delivered_per_second']
+            29.7
+
+        With `checkpoint` the number of recipients done, sent or failed, is
+        written to that file every `checkpoint_interval` seconds: running
+        the same broadcast again, with an audience in the same order, skips
+        them.
+
+        Sent messages and errors are counted in `bot.metrics`
+        (`broadcast_delivered` and `broadcast_failed`), together with the
+        sends tried again (`broadcast_retried`).
+    """
+
+    def __init__(self, bot, message, audience, endpoint=None, parallelism=8,
+                 rate=None, checkpoint=None, checkpoint_interval=1.0):
+        self.bot = bot
+        self.message = message
+        self.audience = audience
+        self.endpoint = endpoint
+        self.parallelism = parallelism
+        self.rate = rate
+        self.checkpoint = checkpoint
+        self.checkpoint_interval = checkpoint_interval
+        self.delivered = self.failed = 0
+        # every recipient before `offset` is done, the ones after it in
+        # `_done` too
+        self.offset = 0
+        self._done = set()
+        self._lock = Lock()
+
+    def run(self):
+        """ Sends the message to the whole audience, then returns a report:
+            `delivered` and `failed` messages, `skipped` recipients (done in
+            a previous run), `seconds` and `delivered_per_second`.
+        """
+        skipped = self.offset = self._read_checkpoint()
+        recipients = islice(enumerate(self.audience), skipped, None)
+        lanes = {}  # endpoint -> (queue, threads)
+        start = last_checkpoint = perf_clock()
+        try:
+            for index, recipient in recipients:
+                if self.endpoint is None:
+                    endpoint, user_id = recipient
+                else:
+                    endpoint, user_id = self.endpoint, recipient
+                lane = lanes.get(endpoint)
+                if lane is None:
+                    lane = lanes[endpoint] = self._start_lane(endpoint)
+                if lane is False:
+                    self._finish(index, False)
+                else:
+                    # waits when the threads are behind: the audience is
+                    # read only as fast as it's sent
+                    lane[0].put((index, user_id))
+                if self.checkpoint is not None:
+                    now = perf_clock()
+                    if now - last_checkpoint >= self.checkpoint_interval:
+                        self._write_checkpoint()
+                        last_checkpoint = now
+        finally:
+            for lane in lanes.values():
+                if lane is not False:
+                    for _ in lane[1]:
+                        lane[0].put(_STOP)
+            for lane in lanes.values():
+                if lane is not False:
+                    for thread in lane[1]:
+                        thread.join()
+            if self.checkpoint is not None:
+                self._write_checkpoint()
+
+        seconds = perf_clock() - start
+        return {
+            'delivered': self.delivered,
+            'failed': self.failed,
+            'skipped': skipped,
+            'seconds': seconds,
+            'delivered_per_second':
+                self.delivered / seconds if seconds else 0.0,
+        }
+
+    def _start_lane(self, endpoint):
+        """ Starts the threads sending through `endpoint`, returns their
+            queue and the threads, False if the endpoint is unknown.
+        """
+        if isinstance(endpoint, string_types):
+            name, endpoint = endpoint, self.bot.get_endpoint(endpoint)
+            if endpoint is None:
+                logging.error("No endpoint %s for the broadcast", name)
+                return False
+        queue = Queue(maxsize=2 * self.parallelism)
+        limiter = None
+        if self.rate:
+            limiter = RateLimiter(self.rate, burst=1)
+        threads = []
+        for index in range(self.parallelism):
+            thread = Thread(target=self._send_loop,
+                            args=(endpoint, queue, limiter),
+                            name='eddie-broadcast-%d' % index)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        return queue, threads
+
+    def _send_loop(self, endpoint, queue, limiter):
+        """ Thread target: sends the message to the queued recipients. """
+        while True:
+            item = queue.get()
+            if item is _STOP:
+                return
+            index, user_id = item
+            if limiter is not None:
+                while not limiter.allow(None):
+                    sleep(1.0 / self.rate)
+            while True:
+                try:
+                    endpoint.send_message(user_id, self.message)
+                except BulkheadFullError:
+                    # the other threads keep the endpoint busy
+                    self.bot.metrics.incr('broadcast_retried')
+                    continue
+                except CircuitOpenError as error:
+                    # the service is down: waiting for it
+                    self.bot.metrics.incr('broadcast_retried')
+                    sleep(error.retry_after)
+                    continue
+                except Exception:  # pylint: disable=broad-except
+                    logging.exception("Error broadcasting to %s", user_id)
+                    self._finish(index, False)
+                else:
+                    self._finish(index, True)
+                break
+
+    def _finish(self, index, delivered):
+        """ Marks the recipient `index` as done. """
+        with self._lock:
+            if delivered:
+                self.delivered += 1
+            else:
+                self.failed += 1
+            self._done.add(index)
+            while self.offset in self._done:
+                self._done.remove(self.offset)
+                self.offset += 1
+        self.bot.metrics.incr(
+            'broadcast_delivered' if delivered else 'broadcast_failed')
+
+    def _read_checkpoint(self):
+        """ Returns the number of recipients done in a previous run. """
+        if self.checkpoint is None or not os.path.exists(self.checkpoint):
+            return 0
+        with io.open(self.checkpoint, encoding='utf-8') as checkpoint:
+            return json.loads(checkpoint.read())['offset']
+
+    def _write_checkpoint(self):
+        """ Writes the number of recipients done (atomically). """
+        with self._lock:
+            state = {'offset': self.offset, 'delivered': self.delivered,
+                     'failed': self.failed}
+        temporary = self.checkpoint + '.tmp'
+        with io.open(temporary, 'w', encoding='utf-8') as checkpoint:
+            checkpoint.write(json_text(json.dumps(state)))
+        replace(temporary, self.checkpoint)
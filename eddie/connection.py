@@ -0,0 +1,246 @@
+""" A pooled HTTP client shared by the endpoints for their outbound calls.
+
+    Connections are kept alive and reused, and their number is bounded per
+    host: with many bots in one process the sockets opened towards a service
+    do not grow with the number of bots.
+"""
+
+from __future__ import absolute_import
+from collections import namedtuple
+from contextlib import contextmanager
+from threading import Condition, Lock
+import errno
+import select
+import socket
+
+try:  # Python 3
+    from http.client import (
+        HTTPConnection, HTTPSConnection, HTTPException, RemoteDisconnected
+    )
+    from urllib.parse import urlsplit
+except ImportError:  # Python 2
+    from httplib import HTTPConnection, HTTPSConnection, HTTPException
+    from httplib import BadStatusLine as RemoteDisconnected
+    from urlparse import urlsplit
+
+from ._compat import clock
+
+
+Response = namedtuple('Response', 'status headers body')
+
+
+class PoolTimeout(socket.timeout):
+    """ Raised when no connection slot of a host gets free in time. """
+
+
+# sent again on a new connection if the server closed the reused one
+# without answering: repeating them has no further effect
+_IDEMPOTENT_METHODS = frozenset(
+    ['GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS', 'TRACE'])
+_RESET_ERRNOS = frozenset([errno.EPIPE, errno.ECONNRESET, errno.ECONNABORTED])
+
+
+def _is_reset(error):
+    """ Returns true if `error` is the peer closing or resetting the
+        connection (never a timeout).
+    """
+    if isinstance(error, socket.timeout):
+        return False
+    return isinstance(error, RemoteDisconnected) or (
+        isinstance(error, socket.error) and error.errno in _RESET_ERRNOS)
+
+
+def _is_dropped(connection):
+    """ Returns true if the idle `connection` was closed meanwhile: a
+        kept-alive socket with something to read (the end of the stream)
+        before a request is sent.
+    """
+    sock = connection.sock
+    if sock is None:
+        return False  # connects again by itself
+    try:
+        return sock.fileno() < 0 or bool(select.select([sock], [], [], 0)[0])
+    except (ValueError, socket.error):
+        return True
+
+
+class _HostPool(object):
+    """ The idle connections to a host and the slots limiting the ones in
+        use.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.idle = []
+        self.in_use = 0
+        self.lock = Lock()
+        self.freed = Condition(self.lock)  # notified when a slot is free
+
+
+class HttpClient(object):
+    """ HTTP client keeping alive at most `max_per_host` connections for
+        every host, requests waiting for a free connection when all of them
+        are in use. `timeout` (seconds) is used for connecting and reading,
+        unless a different one is passed to `request`, and is the longest
+        wait for a free connection (`slot_timeout`, by default), after which
+        `PoolTimeout` is raised.
+
+        Example usage:
+
+            >>> client = HttpClient(max_per_host=4, timeout=5)
+            >>> response = client.request('GET', 'http://localhost:8000/')
+            >>> response.status, response.body
+            (200, b'...')
+
+        Use `default_client()` to get the client shared by all the endpoints.
+        The slots are meant for short calls: a long poll holding one would
+        starve the others, it needs a client of its own.
+    """
+
+    def __init__(self, max_per_host=10, timeout=10.0, slot_timeout=None):
+        self.max_per_host = max_per_host
+        self.timeout = timeout
+        self.slot_timeout = timeout if slot_timeout is None else slot_timeout
+        self._pools = {}
+        self._lock = Lock()
+
+    def _pool(self, key):
+        pool = self._pools.get(key)
+        if pool is None:
+            with self._lock:
+                pool = self._pools.setdefault(
+                    key, _HostPool(self.max_per_host))
+        return pool
+
+    @contextmanager
+    def slot(self, host, scheme='https'):
+        """ Context manager holding one of the connection slots of `host`,
+            to bound the calls made by libraries managing their own
+            connections.
+        """
+        pool = self._pool((scheme, host))
+        with pool.lock:
+            deadline = None
+            while pool.in_use >= pool.size:
+                now = clock()
+                if deadline is None:
+                    deadline = now + self.slot_timeout
+                if now >= deadline:
+                    raise PoolTimeout(
+                        "No free connection to %s in %.1f s" %
+                        (host, self.slot_timeout))
+                pool.freed.wait(deadline - now)
+            pool.in_use += 1
+        try:
+            yield
+        finally:
+            with pool.lock:
+                pool.in_use -= 1
+                pool.freed.notify()
+
+    def request(self, method, url, body=None, headers=None, timeout=None):
+        """ Sends the request and reads the whole response, returning a
+            `Response` with `status`, `headers` (dict) and `body` (bytes).
+
+            The idle connections closed by the server are discarded before
+            being used. A request is sent again, once, on a new connection
+            only if a reused one was closed or reset before any byte of the
+            response arrived, and only if it wasn't sent yet or its method is
+            idempotent: a POST that may have reached the server, or a
+            request timing out, is never repeated. The other errors
+            (`socket.error`, `HTTPException`) are raised.
+        """
+        parts = urlsplit(url)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        timeout = self.timeout if timeout is None else timeout
+
+        pool = self._pool((parts.scheme, parts.netloc))
+        with self.slot(parts.netloc, parts.scheme):
+            connection = None
+            with pool.lock:
+                while pool.idle and connection is None:
+                    connection = pool.idle.pop()
+                    if _is_dropped(connection):
+                        connection.close()
+                        connection = None
+            while True:
+                reused = connection is not None
+                if not reused:
+                    connection_class = (
+                        HTTPSConnection if parts.scheme == 'https'
+                        else HTTPConnection)
+                    connection = connection_class(parts.netloc,
+                                                  timeout=timeout)
+                sent = False
+                try:
+                    self._send(connection, method, path, body, headers or {},
+                               timeout)
+                    sent = True
+                    response = self._receive(connection)
+                    break
+                except (socket.error, HTTPException) as error:
+                    connection.close()
+                    if not (reused and _is_reset(error) and (
+                            not sent or method in _IDEMPOTENT_METHODS)):
+                        raise
+                    connection = None  # stale keep-alive connection
+
+            if response.will_close:
+                connection.close()
+            else:
+                with pool.lock:
+                    pool.idle.append(connection)
+
+        return Response(response.status, dict(response.getheaders()),
+                        response.body)
+
+    @staticmethod
+    def _send(connection, method, path, body, headers, timeout):
+        connection.timeout = timeout
+        if connection.sock is not None:
+            connection.sock.settimeout(timeout)
+        connection.request(method, path, body, headers)
+
+    @staticmethod
+    def _receive(connection):
+        response = connection.getresponse()
+        response.body = response.read()
+        return response
+
+    def stats(self):
+        """ Returns, for every `scheme://host`, the connections in use and
+            the idle ones.
+        """
+        with self._lock:
+            pools = list(self._pools.items())
+        return dict(
+            ('%s://%s' % key, {'in_use': pool.in_use, 'idle': len(pool.idle)})
+            for key, pool in pools
+        )
+
+    def close(self):
+        """ Closes all the idle connections. """
+        with self._lock:
+            pools = list(self._pools.values())
+        for pool in pools:
+            with pool.lock:
+                idle, pool.idle = pool.idle, []
+            for connection in idle:
+                connection.close()
+
+
+_default_client = None
+_default_client_lock = Lock()
+
+
+def default_client():
+    """ Returns the `HttpClient` shared by all the endpoints of the process.
+    """
+    global _default_client  # pylint: disable=global-statement
+    if _default_client is None:
+        with _default_client_lock:
+            if _default_client is None:
+                _default_client = HttpClient()
+    return _default_client
@@ -0,0 +1,216 @@
+""" Structured log of the conversations: a middleware recording every
+    message processed, with its reply and latency, written in background to
+    rotating JSONL or SQLite files.
+"""
+
+from __future__ import absolute_import
+import io
+import json
+import logging
+import os
+import sqlite3
+from collections import deque
+from threading import Event, Lock, Thread
+from time import time
+
+from ._compat import json_text, perf_clock
+from .bot import Middleware
+from .metrics import Metrics
+
+
+def _rotate(filename, backup_count):
+    """ Renames `filename` to `filename.1`, `filename.1` to `filename.2` and
+        so on, removing the files beyond `backup_count`.
+    """
+    for index in range(backup_count - 1, 0, -1):
+        source = '%s.%d' % (filename, index)
+        if os.path.exists(source):
+            os.rename(source, '%s.%d' % (filename, index + 1))
+    if backup_count:
+        os.rename(filename, filename + '.1')
+    else:
+        os.remove(filename)
+
+
+class JsonlWriter(object):
+    """ Writes the events as JSON lines to `filename`, rotating the file when
+        it exceeds `max_bytes` (never if 0) and keeping `backup_count` old
+        files (`filename.1`, `filename.2`...).
+    """
+
+    def __init__(self, filename, max_bytes=0, backup_count=5):
+        self.filename = filename
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self._file = None
+
+    def write(self, events):
+        """ Appends a batch of events (dictionaries). """
+        if self._file is None:
+            self._file = io.open(self.filename, 'a', encoding='utf-8')
+        elif self.max_bytes and self._file.tell() >= self.max_bytes:
+            self.close()
+            _rotate(self.filename, self.backup_count)
+            self._file = io.open(self.filename, 'a', encoding='utf-8')
+        self._file.write(u''.join(
+            json_text(json.dumps(event)) + u'\n' for event in events))
+        self._file.flush()
+
+    def close(self):
+        """ Closes the file. """
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class SqliteWriter(object):
+    """ Writes the events to the `events` table of the SQLite database
+        `filename`, rotating it like `JsonlWriter` does.
+    """
+
+    _COLUMNS = ('time', 'bot', 'in_message', 'out_message', 'latency',
+                'error')
+
+    def __init__(self, filename, max_bytes=0, backup_count=5):
+        self.filename = filename
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self._connection = None
+
+    def write(self, events):
+        """ Inserts a batch of events (dictionaries), in a transaction. """
+        if self._connection is not None and self.max_bytes and \
+                os.path.getsize(self.filename) >= self.max_bytes:
+            self.close()
+            _rotate(self.filename, self.backup_count)
+        if self._connection is None:
+            # created by the writer thread and used only by it
+            self._connection = sqlite3.connect(self.filename)
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS events ('
+                'time REAL, bot TEXT, in_message TEXT, out_message TEXT, '
+                'latency REAL, error TEXT)')
+        with self._connection:
+            self._connection.executemany(
+                'INSERT INTO events VALUES (?, ?, ?, ?, ?, ?)',
+                [tuple(event.get(column) for column in self._COLUMNS)
+                 for event in events])
+
+    def close(self):
+        """ Closes the database. """
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+
+class ConversationLog(Middleware):
+    """ Middleware recording every message processed by the bot.
+
+        The request path only appends a tuple to a queue (a `deque`, no
+        locks involved): a background thread checks the queue every
+        `flush_interval` seconds, turns the tuples into events and passes
+        them to `writer` in batches of at most `batch_size`.
+
+        Example usage:
+
+            >>> log = ConversationLog(JsonlWriter('conversations.jsonl',
+            ...                                   max_bytes=2 ** 26))
+            >>> bot.add_middleware(log)
+            ...
+            >>> log.close()  # writes the events still in the queue
+
+        Every event has `time`, `bot` (class name), `in_message`,
+        `out_message`, `latency` (seconds) and, if the bot raised an
+        exception, `error`.
+
+        When the queue holds `max_queue` events new ones are dropped, and
+        counted in `log.metrics`, rather than slowing down the bot.
+    """
+
+    def __init__(self, writer, batch_size=256, flush_interval=0.1,
+                 max_queue=100000):
+        self.writer = writer
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue = max_queue
+        self.metrics = Metrics()
+        self._queue = deque()
+        self._thread = None
+        self._lock = Lock()
+        self._stop = Event()
+
+    def __call__(self, bot, in_message, next_handler):
+        start = perf_clock()
+        try:
+            out_message = next_handler(in_message)
+        except Exception as error:
+            self._put((time(), bot, in_message, None, perf_clock() - start,
+                       error))
+            raise
+        self._put((time(), bot, in_message, out_message, perf_clock() - start,
+                   None))
+        return out_message
+
+    def _put(self, record):
+        if self._thread is None:
+            self._start()
+        if len(self._queue) < self.max_queue:
+            self._queue.append(record)
+        else:
+            self.metrics.incr('dropped')
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                self._stop.clear()
+                self._thread = Thread(target=self._write_loop,
+                                      name='eddie-conversation-log')
+                self._thread.daemon = True
+                self._thread.start()
+
+    def _write_loop(self):
+        """ Thread target: writes the queued events until `close`. """
+        queue = self._queue
+        while True:
+            stop = self._stop.wait(self.flush_interval)
+            while queue:
+                records = []
+                while queue and len(records) < self.batch_size:
+                    records.append(queue.popleft())
+                self._write(records)
+            if stop:
+                # the writer is used only by this thread (SQLite requires it)
+                self.writer.close()
+                return
+
+    def _write(self, records):
+        events = []
+        for timestamp, bot, in_message, out_message, latency, error in \
+                records:
+            event = {
+                'time': timestamp,
+                'bot': type(bot).__name__,
+                'in_message': in_message,
+                'out_message': out_message,
+                'latency': latency,
+            }
+            if error is not None:
+                event['error'] = repr(error)
+            events.append(event)
+        try:
+            self.writer.write(events)
+        except Exception:  # pylint: disable=broad-except
+            self.metrics.incr('write_errors')
+            logging.exception("Error writing the conversation log")
+            return
+        self.metrics.incr('written', len(events))
+
+    def close(self):
+        """ Writes the queued events, then stops the thread and closes the
+            writer.
+        """
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._stop.set()
+            thread.join()
@@ -7,3 +7,4 @@
 from .http import HttpEndpoint
 from .telegram import TelegramEndpoint
 from .twitter import TwitterEndpoint
+from .router import RouterEndpoint
@@ -5,8 +5,8 @@ from __future__ import absolute_import
 from threading import Thread
 from time import sleep
 from socket import error as socket_error
-from http.client import HTTPConnection
 import logging
+import mimetypes
 import os
 from cgi import escape as escape_html
 
@@ -17,58 +17,253 @@ except ImportError:  # specific imports for Python 2
     from urlparse import parse_qs
     from SocketServer import TCPServer as HTTPServer
     from SimpleHTTPServer import SimpleHTTPRequestHandler as BaseHTTPRequestHandler
-    ConnectionRefusedError = socket_error
     HTTPServer.allow_reuse_address = True
 import json
+from time import time
 
+from .._compat import text_type
+from ..message import Message
 
-class _HttpHandler(BaseHTTPRequestHandler, object):
+
+def format_output(output_text):
+    """ Returns the dictionary sent as JSON to answer a message: the reply
+        as text (`out_message`) and as html (`out_message_html`).
+    """
+    return {
+        "out_message": output_text,
+        "out_message_html": output_text.replace(
+            '&', '&amp;').replace(
+            '<', '&lt;').replace(
+            '>', '&gt;').replace(
+            '\n', '<br />')
+    }
+
+
+def endpoints_health(bot):
+    """ Returns the `health()` of every endpoint of `bot`, by class name. """
+    endpoints = {}
+    for endpoint in bot.endpoints:
+        name = type(endpoint).__name__
+        if name in endpoints:
+            name = "%s-%d" % (name, len(endpoints))
+        endpoints[name] = endpoint.health()
+    return endpoints
+
+
+_STATIC_DIRECTORY = os.path.join(os.path.dirname(__file__), 'http')
+_static_files = {}
+
+
+def _static_file(filename):
+    """ Returns content and type of a file in the `http` directory, read
+        only the first time.
+    """
+    static = _static_files.get(filename)
+    if static is None:
+        with open(os.path.join(_STATIC_DIRECTORY, filename), 'rb') as static:
+            content = static.read()
+        content_type = mimetypes.guess_type(filename)[0] or \
+            'application/octet-stream'
+        static = _static_files[filename] = (content, content_type)
+    return static
+
+
+class _BodyReader(object):
+    """ Mixin of the request handlers reading bounded bodies: the server
+        has the limit, `max_body_size`.
+    """
+    chunk_size = 16 * 1024
+
+    def read_body(self):
+        """ Returns the body of the request, reading it in chunks.
+
+            Bodies declaring more than `max_body_size` bytes are rejected
+            with 413 before reading them, the ones without a length with 411:
+            this method answers with the error and returns None.
+        """
+        if "chunked" in self.headers.get("Transfer-Encoding", "").lower():
+            self.send_error(411)
+            return None
+        try:
+            length = int(self.headers["Content-Length"])
+        except (KeyError, TypeError, ValueError):
+            self.send_error(411)
+            return None
+        if length > self.server.max_body_size:
+            # the body is not read, so the connection can't be reused
+            self.close_connection = True
+            self.send_error(413)
+            return None
+
+        chunks = []
+        while length > 0:
+            chunk = self.rfile.read(min(length, self.chunk_size))
+            if not chunk:
+                self.send_error(400, "Incomplete body")
+                return None
+            chunks.append(chunk)
+            length -= len(chunk)
+        return b"".join(chunks)
+
+
+class _HttpHandler(_BodyReader, BaseHTTPRequestHandler, object):
     """ Derived class of BaseHTTPRequestHandler, to handle the http requests
         of the HttpEndpoint http server.
     """
     bot = None
+    endpoint = None
+
+    # routes answered without the bot, path -> method name
+    admin_routes = {
+        "/healthz": "healthz",
+        "/readyz": "readyz",
+        "/stats": "stats",
+        "/debug/slow": "debug_slow",
+    }
+    _healthy = json.dumps({"status": "ok"}).encode("UTF-8")
 
     def do_GET(self):
-        """ Process GET requests.
+        """ Process GET requests, see `dispatch`. """
+        self.dispatch("GET")
+
+    def do_POST(self):
+        """ Process POST requests, see `dispatch`. """
+        self.dispatch("POST")
 
-            This method will process the requests in this form:
+    def dispatch(self, method):
+        """ Finds the route of the request in the table built by
+            `compile_routes`, see `route`.
 
-                `/command?parameter1=value1&...`
+            The messages are processed with requests in this form:
 
-            It will use `in_message` parameter as the input message and reply
-            with a JSON containing `out_message` propery:
+                `/process?in_message=hello`
+
+            and the reply is a JSON containing `out_message` propery:
 
                 `{"out_message": "hello"}`
+
+            The `admin_routes` are answered without calling the bot:
+            `/healthz`, `/readyz` and `/stats` report the status of the
+            endpoints, `/debug/slow` the slowest messages, if the bot has
+            profiling enabled (see `Bot.enable_profiling`).
         """
-        try:
-            function, params = self.path.split("?")
-            function, params = function[1:], parse_qs(params)
-            self.send_response(200)
+        path, _, self.query = self.path.partition("?")
+        self.bot = self.server.bot
+        self.endpoint = self.server.endpoint
+        self.route(self.server.routes, path, method)
+
+    def route(self, routes, path, method):
+        """ Calls the function of `path` and `method` in the table `routes`,
+            answering 404 for unknown paths and 405 for methods not allowed.
+        """
+        route = routes.get(path)
+        if route is None:
+            self.send_error(404)
+            return
+        target = route.get(method)
+        if target is None:
+            self.send_response(405)
+            self.send_header("Allow", ", ".join(sorted(route)))
+            self.send_header("Content-Length", "0")
             self.end_headers()
-            output_text = self.server.bot.process(
-                "".join(params["in_message"])
-            )
-            output = {
-                "out_message": output_text,
-                "out_message_html": output_text.replace(
-                    '&', '&amp;').replace(
-                    '<', '&lt;').replace(
-                    '>', '&gt;').replace(
-                    '\n', '<br />')
-            }
-            self.wfile.write(json.dumps(output).encode("UTF-8"))
-        except ValueError:
-            # if no command is specified, serve the default html
-            filename = os.path.join(
-                os.path.dirname(__file__),
-                'http',
-                'index.html'
-            )
-            with open(filename, 'r') as template_file:
-                self.send_response(200)
-                self.end_headers()
-                output = template_file.read()
-            self.wfile.write(output.encode("UTF-8"))
+            return
+        function, args = target
+        function(self, *args)
+
+    def process_query(self):
+        """ Processes the `in_message` parameter of the query string. """
+        params = parse_qs(self.query)
+        if "in_message" not in params:
+            self.send_error(400, "Missing in_message")
+            return
+        self.reply("".join(params["in_message"]))
+
+    def process_body(self):
+        """ Processes the message sent with POST: the `in_message` field of
+            a JSON object or of a form, or the whole body if it's plain text.
+        """
+        body = self.read_body()
+        if body is None:
+            return
+        content_type = self.headers.get("Content-Type", "")
+        content_type = content_type.split(";")[0].strip().lower()
+        try:
+            body = body.decode("UTF-8")
+            if content_type == "application/json":
+                in_message = json.loads(body)["in_message"]
+            elif content_type == "text/plain":
+                in_message = body
+            else:
+                in_message = "".join(parse_qs(body)["in_message"])
+            if not isinstance(in_message, text_type):
+                raise TypeError(in_message)
+        except (ValueError, KeyError, TypeError):
+            self.send_error(400, "Missing or invalid in_message")
+            return
+        self.reply(in_message)
+
+    def command(self, name):
+        """ Runs the bot's command `name`. """
+        self.reply(self.bot.command_prepend + name)
+
+    def reply(self, in_message):
+        """ Sends the bot's reply to `in_message` as JSON. """
+        output_text = self.bot.process(Message(
+            in_message,
+            user=self.client_address[0],
+            endpoint=self.endpoint
+        ))
+        self.send_json(200, json.dumps(format_output(output_text or ""))
+                       .encode("UTF-8"))
+
+    def static_file(self, filename):
+        """ Sends one of the files in the `http` directory. """
+        content, content_type = _static_file(filename)
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def send_json(self, status, output):
+        """ Sends the response with the JSON `output` (bytes). """
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(output)))
+        self.end_headers()
+        self.wfile.write(output)
+
+    def healthz(self):
+        """ Liveness: the server is answering. """
+        self.send_json(200, self._healthy)
+
+    def readyz(self):
+        """ Readiness: all the endpoints of the bot are running, 503 if some
+            are not.
+        """
+        endpoints = endpoints_health(self.bot)
+        ready = all(health["alive"] for health in endpoints.values())
+        self.send_json(200 if ready else 503, json.dumps({
+            "ready": ready,
+            "endpoints": endpoints,
+        }).encode("UTF-8"))
+
+    def stats(self):
+        """ The status of the endpoints and the metrics of the bot. """
+        self.send_json(200, json.dumps({
+            "uptime": time() - self.server.started,
+            "endpoints": endpoints_health(self.bot),
+            "metrics": self.bot.metrics.snapshot(),
+        }).encode("UTF-8"))
+
+    def debug_slow(self):
+        """ Replies with the JSON list of the traces of the slowest messages.
+        """
+        profiler = self.bot.profiler
+        if profiler is None:
+            self.send_error(404, "Profiling not enabled")
+            return
+        self.send_json(200, json.dumps(profiler.traces()).encode("UTF-8"))
 
     def log_message(self, format_, *args):
         """ Redefinition of the `log_message` method to use `logging` library.
@@ -76,6 +271,33 @@ class _HttpHandler(BaseHTTPRequestHandler, object):
         logging.debug(format_, *args)
 
 
+def compile_routes(bot):
+    """ Returns the route table of the http server of `bot`: a dictionary
+        `path -> {method: (handler function, arguments)}`, so that finding a
+        route costs the same no matter how many routes there are.
+
+        Besides `/process` and the admin routes, every file of the `http`
+        directory is served at `/<file name>` (the page to chat with the bot
+        at `/` too) and every command of the bot at `/<command>`.
+    """
+    routes = {
+        "/process": {
+            "GET": (_HttpHandler.process_query, ()),
+            "POST": (_HttpHandler.process_body, ()),
+        },
+        "/": {"GET": (_HttpHandler.static_file, ("index.html",))},
+    }
+    for path, method_name in _HttpHandler.admin_routes.items():
+        routes[path] = {"GET": (getattr(_HttpHandler, method_name), ())}
+    for filename in os.listdir(_STATIC_DIRECTORY):
+        routes.setdefault(
+            "/" + filename, {"GET": (_HttpHandler.static_file, (filename,))})
+    for name in bot.command_names:
+        routes.setdefault(
+            "/" + name, {"GET": (_HttpHandler.command, (name,))})
+    return routes
+
+
 class HttpEndpoint(object):
     """ Http endpoint for a eddie bot, use this to give your bot some REST
         API.
@@ -89,6 +311,10 @@ class HttpEndpoint(object):
         Then you can send message to the bot using simple GET requests:
         `http://localhost:8000/process?in_message=hello`
 
+        or POST requests to `/process`, with a JSON
+        (`{"in_message": "hello"}`), form or plain text body of at most
+        `max_body_size` bytes.
+
         Note: default port is 8000, if it is already used, `HttpEndpoint` will
         use the first free port after 8000 (8001, 8002...).
 
@@ -97,8 +323,9 @@ class HttpEndpoint(object):
     """
 
     _host = "localhost"
+    poll_interval = 0.1
 
-    def __init__(self, port=8000):
+    def __init__(self, port=8000, max_body_size=64 * 1024):
         self.bot = None
         self._port = port
 
@@ -109,6 +336,9 @@ class HttpEndpoint(object):
             )
         except (OSError, socket_error) as error:
             raise error
+        self._httpd.endpoint = self
+        self._httpd.started = time()
+        self._httpd.max_body_size = max_body_size
 
         self._http_on = False
         self._http_thread = Thread(target=self.serve_loop)
@@ -133,17 +363,26 @@ class HttpEndpoint(object):
         """
         self.bot = bot
         self._httpd.bot = bot
+        self._httpd.routes = compile_routes(bot)
+
+    def health(self):
+        """ Returns whether the server is running (`alive`) and the number of
+            messages waiting to be processed (`queue_depth`).
+        """
+        return {
+            "alive": self._http_on and self._http_thread.is_alive(),
+            "queue_depth": 0,
+        }
 
     def serve_loop(self):
         """ Strats an infinite loop to process http requests.
 
-            The loop ends when the `self._http_on` will be false (set `True` by
-            `self.run` and `False` by `self.stop`)
+            The loop ends when `self.stop` is called, it checks every
+            `poll_interval` seconds if it has to stop, so stopping doesn't
+            need to send a request to wake up the server.
         """
         try:
-            while self._http_on:
-                logging.debug("Ready for a new HTTP request...")
-                self._httpd.handle_request()
+            self._httpd.serve_forever(poll_interval=self.poll_interval)
         except socket_error:
             pass
 
@@ -157,17 +396,8 @@ class HttpEndpoint(object):
 
     def stop(self):
         """Stops the webserver."""
-        self._http_on = False
-
-        conn = HTTPConnection(
-            self._host + ":" + str(self._port)
-        )
-        try:
-            conn.request("GET", "/shutdown")
-        except ConnectionRefusedError:
-            pass
-        conn.close()
-        while self._http_thread.is_alive():
-            sleep(0.5)
-            self._httpd.server_close()
-            self._httpd.socket.close()
+        if self._http_on:
+            self._http_on = False
+            self._httpd.shutdown()
+            self._http_thread.join()
+        self._httpd.server_close()
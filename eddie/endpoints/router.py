@@ -0,0 +1,230 @@
+""" Router endpoint: many bots served by one http server, for multi-tenant
+    deployments.
+"""
+
+from __future__ import absolute_import
+from threading import Thread
+from time import time
+import json
+import logging
+
+try:  # specific imports for Python 3
+    from http.server import HTTPServer
+except ImportError:  # specific imports for Python 2
+    from BaseHTTPServer import HTTPServer
+
+from .._compat import text_type
+from ..message import Message
+from ..pool import WorkerPool
+from .http import _HttpHandler, compile_routes
+
+
+def _update_message(update):
+    """ Returns text, sender and chat of the message of a webhook update,
+        None if it has no text. Raises ValueError if the update isn't shaped
+        like a Telegram one.
+    """
+    if not isinstance(update, dict):
+        raise ValueError("The update is not an object")
+    message = update.get('message')
+    if not message:
+        return None
+    if not isinstance(message, dict):
+        raise ValueError("The message is not an object")
+    text = message.get('text')
+    if text is None:
+        return None
+    chat = message.get('chat')
+    sender = message.get('from') or {}
+    if not isinstance(text, text_type) or not isinstance(chat, dict) or \
+            'id' not in chat or not isinstance(sender, dict):
+        raise ValueError("Invalid message")
+    return text, sender.get('id', chat['id']), chat['id']
+
+
+class _PooledHTTPServer(HTTPServer, object):
+    """ HTTP server handling the requests in the threads of a `WorkerPool`
+        instead of the accepting thread (or of a new thread per request).
+    """
+
+    allow_reuse_address = True
+
+    def __init__(self, address, handler_class, router):
+        super(_PooledHTTPServer, self).__init__(address, handler_class)
+        self.router = router
+
+    def process_request(self, request, client_address):
+        self.router.pool.submit(self._process_request, request,
+                                client_address)
+
+    def _process_request(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:  # pylint: disable=broad-except
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+
+class _RouterHandler(_HttpHandler):
+    """ `_HttpHandler` passing the requests to the `RouterEndpoint` of the
+        server, which finds the bot and its routes.
+    """
+
+    def dispatch(self, method):
+        """ See `RouterEndpoint.handle`. """
+        self.server.router.handle(self, method)
+
+    def telegram_update(self, bot):
+        """ Processes a webhook update, answering with a `sendMessage` in the
+            body of the response.
+        """
+        body = self.read_body()
+        if body is None:
+            return
+        try:
+            message = _update_message(json.loads(body.decode('UTF-8')))
+        except ValueError:
+            self.send_error(400, "Invalid update")
+            return
+        if message is None:
+            self.send_json(200, b'')
+            return
+        text, user, chat_id = message
+        out_message = bot.process(Message(
+            text, user=user, chat=chat_id, endpoint=self.endpoint))
+        if not out_message:
+            self.send_json(200, b'')
+            return
+        self.send_json(200, json.dumps({
+            'method': 'sendMessage',
+            'chat_id': chat_id,
+            'text': out_message,
+        }).encode('UTF-8'))
+
+
+class RouterEndpoint(object):
+    """ Serves many bots behind a single http server: one port, one
+        accepting thread and a pool of `workers` threads shared by all the
+        bots, so adding a bot costs just an entry in a dictionary.
+
+        Example usage:
+
+            >>> router = RouterEndpoint(port=8000)
+            >>> router.add_bot('shop', ShopBot())
+            >>> router.add_bot('support', SupportBot())
+            >>> router.add_telegram_bot('123:ABC', ShopBot())
+            >>> router.run()
+
+        The bots added by name answer like `HttpEndpoint` does, with the same
+        routes under their own path:
+        `http://localhost:8000/shop/process?in_message=hello`.
+
+        The bots added by Telegram token receive the updates of the Telegram
+        webhook `https://<public address>/telegram/<token>` (register it with
+        `setWebhook`) and answer inside the response to the webhook, so no
+        further request to the Bot API is needed.
+
+        The webhook bodies larger than `max_body_size` bytes are rejected
+        with 413, as `HttpEndpoint` does, and the ones that aren't Telegram
+        updates with 400.
+
+        Note: unlike `HttpEndpoint`, the router doesn't look for a free port,
+        pass `port=0` to let the system choose one.
+    """
+
+    _host = "localhost"
+
+    def __init__(self, port=8000, workers=8, max_body_size=64 * 1024):
+        self._bots = {}  # name -> (bot, routes)
+        # '/telegram/<token>' -> {'POST': (function, (bot,))}
+        self._telegram_routes = {}
+        self.pool = WorkerPool(workers, name='eddie-router')
+        self._httpd = _PooledHTTPServer((self._host, port), _RouterHandler,
+                                        self)
+        self._httpd.max_body_size = max_body_size
+        self._httpd.started = time()
+        self._port = self._httpd.server_address[1]
+        self._http_on = False
+        self._http_thread = Thread(target=self._httpd.serve_forever,
+                                   kwargs={'poll_interval': 0.1},
+                                   name='eddie-router')
+        self._http_thread.daemon = True
+
+    @property
+    def host(self):
+        """ host getter """
+        return self._host
+
+    @property
+    def port(self):
+        """ port getter """
+        return self._port
+
+    @property
+    def bots(self):
+        """ The bots served by name. """
+        return dict((name, bot) for name, (bot, _) in self._bots.items())
+
+    def add_bot(self, name, bot):
+        """ Serves `bot` on the `/<name>/` path. """
+        if '/' in name:
+            raise ValueError("Bot names can't contain '/'")
+        bot.compile()
+        self._bots[name] = (bot, compile_routes(bot))
+
+    def remove_bot(self, name):
+        """ Stops serving the bot added as `name`. """
+        del self._bots[name]
+
+    def add_telegram_bot(self, token, bot):
+        """ Passes to `bot` the updates of the Telegram webhook of `token`.
+        """
+        bot.compile()
+        self._telegram_routes['/telegram/' + token] = {
+            'POST': (_RouterHandler.telegram_update, (bot,))
+        }
+
+    def remove_telegram_bot(self, token):
+        """ Stops passing the updates of `token` to its bot. """
+        del self._telegram_routes['/telegram/' + token]
+
+    def run(self):
+        """ Starts the webserver. """
+        self._http_on = True
+        self._http_thread.start()
+        logging.info("Starting router on port %d", self._port)
+
+    def stop(self):
+        """ Stops the webserver, after the requests being processed. """
+        if self._http_on:
+            self._http_on = False
+            self._httpd.shutdown()
+            self._http_thread.join()
+        self.pool.stop()
+        self._httpd.server_close()
+
+    def handle(self, handler, method):
+        """ Dispatches the request received by `handler`: `/<name>/<path>`
+            goes to the `<path>` route of the bot added as `name`, the
+            webhook updates to the Telegram bot of their token.
+        """
+        path, _, handler.query = handler.path.partition('?')
+        handler.endpoint = self
+        if path in self._telegram_routes:
+            handler.route(self._telegram_routes, path, method)
+            return
+
+        name, slash, bot_path = path[1:].partition('/')
+        bot, routes = self._bots.get(name, (None, None))
+        if bot is None:
+            handler.send_error(404)
+        elif not slash:
+            # the page calls the API with a path relative to its own
+            handler.send_response(301)
+            handler.send_header('Location', path + '/')
+            handler.send_header('Content-Length', '0')
+            handler.end_headers()
+        else:
+            handler.bot = bot
+            handler.route(routes, '/' + bot_path, method)
@@ -5,7 +5,260 @@
 """
 
 from __future__ import absolute_import
-from telegram.ext import Updater, MessageHandler, CommandHandler, Filters
+import io
+import json
+import logging
+import os
+import socket
+from collections import OrderedDict
+from threading import Lock
+from time import sleep
+
+try:  # Python 3
+    from http.client import HTTPException
+except ImportError:  # Python 2
+    from httplib import HTTPException
+
+from telegram import Bot as TelegramBot
+from telegram.error import (
+    BadRequest, ChatMigrated, InvalidToken, NetworkError, RetryAfter,
+    TelegramError, TimedOut, Unauthorized
+)
+from telegram import Update
+from telegram.ext import (
+    Updater, MessageHandler, CommandHandler, Filters, TypeHandler
+)
+from telegram.ext.dispatcher import DEFAULT_GROUP
+from telegram.utils.request import Request
+
+from .._compat import clock, json_text, replace
+from ..connection import HttpClient, default_client
+from ..message import Message
+from ..metrics import Metrics
+from ..outbound import Outbox
+from ..pool import WorkerPool
+from ..resilience import OutboundGuard
+
+
+def _is_outage(error):
+    """ Returns true if `error` means that the Bot API is in trouble, not
+        that the single call was wrong (i.e. a message to a chat which
+        blocked the bot).
+    """
+    return not isinstance(error, (BadRequest, Unauthorized, ChatMigrated))
+
+
+class _PooledRequest(Request):
+    """ `telegram.utils.request.Request` sending the Bot API calls through an
+        `eddie.connection.HttpClient` instead of its own connection pool.
+
+        The long polls (`getUpdates`) use a connection of their own, kept
+        alive: holding a slot of the shared client for the whole poll, the
+        polls of a few bots would leave no connection for the sends.
+    """
+
+    def __init__(self, http_client):
+        super(_PooledRequest, self).__init__()
+        self._http_client = http_client
+        self._poll_client = HttpClient(max_per_host=1)
+
+    def stop(self):
+        """ Closes the connection of the long polls. """
+        self._poll_client.close()
+
+    def _request_wrapper(self, method, url, body=None, headers=None,
+                         timeout=None):
+        """ Sends the request, returns the body of the response or raises
+            the same `TelegramError`s of the original implementation.
+        """
+        client = self._http_client
+        if url.endswith('/getUpdates'):
+            client = self._poll_client
+        try:
+            response = client.request(
+                method, url, body=body, headers=headers,
+                timeout=getattr(timeout, 'read_timeout', None)
+            )
+        except socket.timeout:
+            raise TimedOut()
+        except (socket.error, HTTPException) as error:
+            raise NetworkError('HTTP error {0}'.format(error))
+
+        if 200 <= response.status <= 299:
+            return response.body
+
+        try:
+            message = self._parse(response.body)
+        except ValueError:
+            raise NetworkError('Unknown HTTPError {0}'.format(response.status))
+
+        if response.status in (401, 403):
+            raise Unauthorized(message)
+        elif response.status == 400:
+            raise BadRequest(message)
+        elif response.status == 404:
+            raise InvalidToken()
+        elif response.status == 502:
+            raise NetworkError('Bad Gateway')
+        raise NetworkError('{0} ({1})'.format(message, response.status))
+
+
+class _UpdateOffsets(object):
+    """ Tracks the updates fetched and processed, possibly out of order:
+        `offset` is the id of the first update not processed yet (every
+        update before it has been processed), `fetch_offset` the one after
+        the last update fetched, the offset of the next poll.
+
+        With `filename` the updates fetched and not processed yet are kept
+        in that file, written before the next poll confirms them to
+        Telegram, so that the updates queued when the bot stops or crashes
+        are processed at the restart (see `restore`). The progress of the
+        processing is written at most every `write_interval` seconds, and
+        by `flush`: after a crash a few updates may be processed again.
+    """
+
+    def __init__(self, filename=None, write_interval=1.0):
+        self.filename = filename
+        self.write_interval = write_interval
+        self.offset = self.fetch_offset = 0
+        self._saved = []  # the updates not processed, read from the file
+        if filename is not None and os.path.exists(filename):
+            self._load()
+        # update id -> update, None once processed, in order
+        self._pending = OrderedDict()
+        self._lock = Lock()
+        self._changes = self._written = 0
+        self._write_at = 0.0
+        self._file_lock = Lock()
+
+    def _load(self):
+        """ Reads the offsets and the updates not processed from the file.
+        """
+        with io.open(self.filename, encoding='utf-8') as offset_file:
+            state = json.loads(offset_file.read().strip() or '0')
+        if isinstance(state, int):  # only the offset, older versions
+            state = {'offset': state, 'fetch_offset': state}
+        self.offset = state['offset']
+        self.fetch_offset = state['fetch_offset']
+        self._saved = state.get('updates', [])
+
+    def restore(self, bot):
+        """ Returns the updates not processed when the file was written,
+            once.
+        """
+        saved, self._saved = self._saved, []
+        return [Update.de_json(data, bot) for data in saved]
+
+    def fetched(self, updates):
+        """ Records the updates fetched, writing them to the file, and
+            returns the ones not fetched before.
+        """
+        with self._lock:
+            fresh = []
+            for update in updates:
+                update_id = update.update_id
+                if update_id >= self.offset and \
+                        update_id not in self._pending:
+                    self._pending[update_id] = update
+                    fresh.append(update)
+                self.fetch_offset = max(self.fetch_offset, update_id + 1)
+            if fresh:
+                self._changes += 1
+        if fresh:
+            self.flush()
+        return fresh
+
+    def finish(self, update_id):
+        """ Records an update processed, writes the progress if due. """
+        with self._lock:
+            if self._pending.get(update_id) is None:
+                return
+            self._pending[update_id] = None
+            while self._pending:
+                first = next(iter(self._pending))
+                if self._pending[first] is not None:
+                    break
+                del self._pending[first]
+                self.offset = first + 1
+            self._changes += 1
+            now = clock()
+            due = self.filename is not None and now >= self._write_at
+            if due:
+                self._write_at = now + self.write_interval
+        if due:
+            self.flush()
+
+    def flush(self):
+        """ Writes the offsets and the updates not processed to the file,
+            if they changed since last time.
+        """
+        if self.filename is None:
+            return
+        with self._file_lock:
+            with self._lock:
+                changes = self._changes
+                if changes == self._written:
+                    return
+                state = {
+                    'offset': self.offset,
+                    'fetch_offset': self.fetch_offset,
+                    'updates': [update.to_dict()
+                                for update in self._pending.values()
+                                if update is not None],
+                }
+            temporary = self.filename + '.tmp'
+            with io.open(temporary, 'w', encoding='utf-8') as offset_file:
+                offset_file.write(json_text(json.dumps(state)))
+            replace(temporary, self.filename)
+            self._written = changes
+
+
+class _Updater(Updater):
+    """ `telegram.ext.Updater` keeping track of the updates fetched (see
+        `_UpdateOffsets`): the updates not processed at the last stop are
+        queued first, the ones fetched again are dropped.
+
+        It replaces the polling loop of `Updater`, relying on its internals
+        (`_bootstrap`, `_increase_poll_interval` and, for the health of the
+        endpoint, `__threads`) as of python-telegram-bot 6.0, the version
+        pinned in requirements.txt.
+    """
+
+    def __init__(self, offsets, **kwargs):
+        super(_Updater, self).__init__(**kwargs)
+        self.offsets = offsets
+        self.last_update_id = offsets.fetch_offset
+
+    def _start_polling(self, poll_interval, timeout, read_latency,
+                       bootstrap_retries, clean, allowed_updates):
+        """ Thread target: polls the updates, until `stop`. """
+        interval = poll_interval
+        self._bootstrap(bootstrap_retries, clean=clean, webhook_url='',
+                        allowed_updates=None)
+        for update in self.offsets.fetched(self.offsets.restore(self.bot)):
+            self.update_queue.put(update)
+        while self.running:
+            self.last_update_id = self.offsets.fetch_offset
+            try:
+                updates = self.bot.getUpdates(
+                    self.last_update_id, timeout=timeout,
+                    read_latency=read_latency,
+                    allowed_updates=allowed_updates)
+            except RetryAfter as error:
+                logging.info("%s", error)
+                interval = 0.5 + error.retry_after
+            except TelegramError as error:
+                logging.error("Error while getting the updates: %s", error)
+                # for the error handlers of the dispatcher
+                self.update_queue.put(error)
+                interval = self._increase_poll_interval(interval)
+            else:
+                if not self.running:
+                    break  # not confirmed: fetched again at the restart
+                for update in self.offsets.fetched(updates):
+                    self.update_queue.put(update)
+                interval = poll_interval
+            sleep(interval)
 
 
 class TelegramEndpoint(object):
@@ -23,12 +276,56 @@ class TelegramEndpoint(object):
             >>> bot.add_endpoint(ep)
             >>> bot.run()
 
+        `base_url` can be used to connect to a different Bot API server (i.e.
+        a local one for testing) instead of `https://api.telegram.org/bot`.
+
+        With a `coalesce_window` (seconds) the replies are sent in background
+        and the ones to the same chat within the window are joined in a
+        single message (see `eddie.outbound.Outbox`).
+
+        All the calls to the Bot API go through `http_client`, by default
+        the one shared by all the endpoints (see `eddie.connection`).
+
+        The messages are processed by `workers` threads: the ones of the
+        same chat one at a time, in order, the ones of different chats in
+        parallel. With `offset_file` the updates fetched and not processed
+        yet are kept in that file, together with the position in the
+        updates, so a restart (`bot.stop()`, or a crash, then `bot.run()` in
+        a new process) skips the updates already processed and doesn't lose
+        the queued ones.
+
+        The messages are sent by at most `max_concurrent_calls` threads at
+        the same time (see `eddie.resilience.Bulkhead`) and, after
+        `failure_threshold` consecutive sends failed because of the Bot API,
+        they fail right away for `reset_timeout` seconds (see
+        `eddie.resilience.CircuitBreaker`). The changes of the circuit are
+        counted in `self.metrics`.
+
     """
 
-    def __init__(self, token):
-        self._telegram = Updater(token)
+    def __init__(self, token, base_url=None, coalesce_window=None,
+                 http_client=None, workers=4, offset_file=None,
+                 max_concurrent_calls=4, failure_threshold=5,
+                 reset_timeout=30.0):
+        self._request = _PooledRequest(http_client or default_client())
+        self._offsets = _UpdateOffsets(offset_file)
+        self._telegram = _Updater(
+            self._offsets,
+            bot=TelegramBot(token, base_url, request=self._request)
+        )
+        self._workers = WorkerPool(workers, name='eddie-telegram')
+        self.metrics = Metrics()
+        self._guard = OutboundGuard(
+            'telegram', max_concurrent_calls,
+            failure_threshold=failure_threshold, reset_timeout=reset_timeout,
+            is_failure=_is_outage, metrics=self.metrics)
         self._token = token
         self._bot = None
+        self._handlers = None
+        self._outbox = None
+        if coalesce_window:
+            self._outbox = Outbox(self.send_message, coalesce_window,
+                                  name='eddie-telegram-outbox')
 
     def set_bot(self, bot):
         """ Sets the main bot, the bot must be an instance of
@@ -40,34 +337,82 @@ class TelegramEndpoint(object):
             The commands will be handled by
             `TelegramEndpoint.default_command_handler`, all the other messages
             will be handled by `TelegramEndpoint.default_message_handler`.
+
+            Called again (see `Bot.reload`) it replaces the handlers, while
+            polling.
         """
         self._bot = bot
+        dispatcher = self._telegram.dispatcher
 
-        self._telegram.dispatcher.add_handler(
-            MessageHandler(
-                Filters.text,
-                self.default_message_handler
-            )
-        )
-
+        handlers = [MessageHandler(
+            Filters.text,
+            self.default_message_handler
+        )]
         for command in self._bot.command_names:
-            self._telegram.dispatcher.add_handler(
-                CommandHandler(
-                    command,
-                    self.default_command_handler
-                )
-            )
+            handlers.append(CommandHandler(
+                command,
+                self.default_command_handler
+            ))
+        # the updates no other handler of the group took
+        handlers.append(TypeHandler(Update, self._ignored))
+
+        if self._handlers is None:
+            for handler in handlers:
+                dispatcher.add_handler(handler)
+        else:
+            # replaced at once: an update being dispatched keeps the old list
+            dispatcher.handlers[DEFAULT_GROUP] = [
+                handler for handler in dispatcher.handlers[DEFAULT_GROUP]
+                if handler not in self._handlers
+            ] + handlers
+        self._handlers = handlers
 
     def run(self):
         """Starts polling to get the messages."""
         self._telegram.start_polling()
 
     def stop(self):
-        """ Stops polling for new messages.
+        """Stops polling for new messages."""
+        self._telegram.stop()
+        self._request.stop()
+        self._workers.stop()
+        if self._outbox is not None:
+            self._outbox.stop()
+        self._offsets.flush()
 
-            Currently this does nothing (TODO)
+    def health(self):
+        """ Returns whether the polling is running (`alive`), the number of
+            updates and replies waiting to be processed (`queue_depth`) and
+            the state of the circuit of the sends (`circuit`).
         """
-        pass
+        # the private threads list of `telegram.ext.Updater`, see `_Updater`
+        threads = getattr(self._telegram, '_Updater__threads', ())
+        queue_depth = self._telegram.update_queue.qsize() + \
+            self._workers.queue_depth
+        if self._outbox is not None:
+            queue_depth += self._outbox.queue_depth
+        return {
+            'alive': bool(self._telegram.running) and
+                     all(thread.is_alive() for thread in threads),
+            'queue_depth': queue_depth,
+            'circuit': self._guard.breaker.state,
+        }
+
+    def send_message(self, user_id, text):
+        """ Sends `text` to the chat with id `user_id`. """
+        self._guard.call(self._telegram.bot.send_message, chat_id=user_id,
+                         text=text)
+
+    def _reply(self, update, text):
+        """ Replies to the message in `update`, through the outbox if any. """
+        if self._outbox is None:
+            self._guard.call(update.effective_message.reply_text, text)
+        else:
+            self._outbox.deliver(update.effective_message.chat_id, text)
+
+    def _ignored(self, bot, update):
+        """ Called for the updates not handled: they're processed. """
+        self._offsets.finish(update.update_id)
 
     def default_message_handler(self, bot, update):
         """ This is the method that will be called for every new message that
@@ -76,8 +421,7 @@ class TelegramEndpoint(object):
             The input parameters (`bot` and `update`) are default parameters
             used by telegram.
         """
-        in_message = update.message.text
-        update.message.reply_text(self._bot.default_response(in_message))
+        self._submit(update)
 
     def default_command_handler(self, bot, update):
         """ All the commands will pass through this method. It will use the
@@ -86,6 +430,33 @@ class TelegramEndpoint(object):
             The input parameters (`bot` and `update`) are default parameters
             used by telegram.
         """
-        command = update.message.text[1:]
-        command_handler = self._bot.__getattribute__(command)
-        update.message.reply_text(command_handler())
+        self._submit(update)
+
+    def _submit(self, update):
+        """ Leaves the message in `update` to the workers, the ones of the
+            same chat in order. An update not submitted is processed.
+        """
+        submitted = False
+        try:
+            self._workers.submit_keyed(update.effective_message.chat_id,
+                                       self._handle, update)
+            submitted = True
+        finally:
+            if not submitted:
+                self._offsets.finish(update.update_id)
+
+    def _handle(self, update):
+        """ Replies to the message in `update` (in a worker). """
+        try:
+            self._reply(update, self._process(update))
+        finally:
+            self._offsets.finish(update.update_id)
+
+    def _process(self, update):
+        """ Returns the bot's reply to the message in `update`. """
+        message = update.effective_message
+        sender = message.from_user
+        return self._bot.process(Message(
+            message.text,
+            user=message.chat_id if sender is None else sender.id,
+            chat=message.chat_id, endpoint=self))
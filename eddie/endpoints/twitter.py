@@ -5,33 +5,105 @@
 """
 
 from __future__ import absolute_import
-import json
+import logging
+from collections import deque
+from threading import Event, Lock, Thread
 
 import tweepy
 
+try:  # faster parser, if available
+    from ujson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+from .._compat import clock
+from ..connection import default_client
+from ..message import Message
+from ..metrics import Metrics
+from ..outbound import Outbox
+from ..pool import WorkerPool
+from ..resilience import OutboundGuard
+
+# DMs remembered as processed, more than a backfill can fetch again
+_RECENT_DMS = 1024
+
 
 class MyStreamListener(tweepy.StreamListener):
     """ This class will listen for `on_data` events on the twitter stream and
-        then it will dispatch them to the endpoint.the
+        then it will dispatch them to the endpoint.
+
+        Only direct messages and follow events are used: the other events are
+        discarded looking at the raw data, without decoding them, and the
+        processing is left to the endpoint's workers, so that reading the
+        stream never waits for the bot.
     """
 
     def set_endpoint(self, endpoint):
         """ Sets the endpoint instance to use when an event happens """
         self.endpoint = endpoint
 
+    def on_connect(self):
+        """ Called when the stream is (re)connected. """
+        self.endpoint._last_activity = clock()
+        self.endpoint.on_stream_connected()
+
+    def keep_alive(self):
+        """ Called for the keep-alive newlines sent by Twitter. """
+        self.endpoint._last_activity = clock()
+
     def on_data(self, raw_data):
         """ Called when data arrives this method dispatch the event
             to the right endpoint's method.
         """
-        data = json.loads(raw_data)
-
-        if 'direct_message' in data:
-            direct_message = data['direct_message']
-            if direct_message['sender']['id'] != self.endpoint._api.me().id:
+        self.endpoint._last_activity = clock()
+        if '"direct_message"' in raw_data:
+            direct_message = json_loads(raw_data).get('direct_message')
+            if (direct_message and
+                    direct_message['sender']['id'] != self.endpoint.user_id):
                 return self.endpoint.process_new_direct_message(direct_message)
 
-        elif data.get('event', '') == 'follow':
-            return self.endpoint.process_new_follower(data['source'])
+        elif '"follow"' in raw_data:
+            data = json_loads(raw_data)
+            if data.get('event', '') == 'follow':
+                user = data['source']
+                self.endpoint._workers.submit_keyed(
+                    user['id'],
+                    self.endpoint.process_new_follower,
+                    user
+                )
+                return True
+
+
+def _is_outage(error):
+    """ Returns true if `error` means that Twitter is in trouble: no answer,
+        a server error or the rate limit hit, not an error of the single
+        call (i.e. a DM to a user who doesn't follow the bot).
+    """
+    if not isinstance(error, tweepy.TweepError):
+        return True
+    response = error.response
+    return response is None or response.status_code >= 500 or \
+        response.status_code == 429
+
+
+class _Stream(tweepy.Stream):
+    """ A `tweepy.Stream` always connecting to the given host: `userstream`
+        would otherwise overwrite it with the Twitter one.
+    """
+
+    def __init__(self, auth, listener, host, **options):
+        self._host = host
+        super(_Stream, self).__init__(auth, listener, **options)
+
+    @property
+    def host(self):
+        """ host getter """
+        return self._host
+
+    @host.setter
+    def host(self, value):
+        """ ignore the hosts set by `tweepy.Stream` """
+        pass
 
 
 class TwitterEndpoint(object):
@@ -48,21 +120,97 @@ class TwitterEndpoint(object):
             >>> bot.add_endpoint(ep)
             >>> bot.run()
 
+        `api_host` and `stream_host` can be used to connect to different
+        servers (i.e. local ones for testing) instead of `api.twitter.com` and
+        `userstream.twitter.com`.
+
+        The events are processed by `workers` threads, the messages of the
+        same user are answered one at a time, in order.
+
+        With a `coalesce_window` (seconds) the DMs are sent in background and
+        the ones to the same user within the window are joined in a single
+        message (see `eddie.outbound.Outbox`).
+
+        `tweepy` opens its own connections, but the calls to the REST API
+        hold a connection slot of `http_client` (by default the one shared by
+        all the endpoints, see `eddie.connection`), so that their number is
+        bounded.
+
+        The stream is supervised: when it stops, or nothing (not even the
+        keep-alives Twitter sends every 30 seconds) arrives for
+        `stall_timeout` seconds, it's reconnected after a delay starting
+        from `min_backoff` seconds and doubling at every attempt, up to
+        `max_backoff`. After a reconnection the DMs received in the
+        meantime, at most `backfill_count`, are fetched with the REST API
+        and processed, the ones already processed excluded (the last ones
+        processed are remembered). Reconnections, stalls and recovered DMs
+        are counted in `self.metrics`.
+
+        The calls to the REST API wait at most `api_timeout` seconds for an
+        answer and at most `max_concurrent_calls` of them run at the same
+        time (see `eddie.resilience.Bulkhead`), so a slow Twitter keeps busy
+        only a few threads. After `failure_threshold` consecutive calls
+        failed because of Twitter the calls fail right away for
+        `reset_timeout` seconds (see `eddie.resilience.CircuitBreaker`).
+        The changes of the circuit are counted in `self.metrics` too.
+
     """
 
     def __init__(self, consumer_key, consumer_secret,
-                 access_token, access_token_secret,):
+                 access_token, access_token_secret,
+                 api_host=None, stream_host=None, workers=4,
+                 coalesce_window=None, http_client=None, stall_timeout=90.0,
+                 min_backoff=1.0, max_backoff=320.0, backfill_count=50,
+                 api_timeout=10.0, max_concurrent_calls=4,
+                 failure_threshold=5, reset_timeout=30.0):
         self._bot = None
-        self._last_processed_dm = 0
+        self._last_processed_dm = 0  # the newest DM processed
+        self._recent_dms = set()  # ids of the last DMs processed
+        self._recent_dms_order = deque()
+        self._dm_lock = Lock()
         self._polling_should_run = False
         self._polling_is_running = False
+        self._user_id = None
+        self.metrics = Metrics()
+
+        self.stall_timeout = stall_timeout
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.backfill_count = backfill_count
+        self._last_activity = clock()
+        self._connections = 0
+        self._backoff = min_backoff
+        self._supervisor = None
+        self._stopping = Event()
 
         self._auth = tweepy.OAuthHandler(consumer_key, consumer_secret)
         self._auth.set_access_token(access_token, access_token_secret)
 
-        self._api = tweepy.API(self._auth)
-
+        api_options = {'timeout': api_timeout}
+        if api_host is not None:
+            api_options['host'] = api_host
+        self._api = tweepy.API(self._auth, **api_options)
+        self._api_host = api_host or 'api.twitter.com'
+        self._http_client = http_client or default_client()
+        self._guard = OutboundGuard(
+            'twitter', max_concurrent_calls,
+            failure_threshold=failure_threshold, reset_timeout=reset_timeout,
+            is_failure=_is_outage, metrics=self.metrics)
+
+        self._stream_host = stream_host
         self._stream = None
+        self._workers = WorkerPool(workers, name='eddie-twitter')
+        self._outbox = None
+        if coalesce_window:
+            self._outbox = Outbox(self.send_message, coalesce_window,
+                                  name='eddie-twitter-outbox')
+
+    @property
+    def user_id(self):
+        """ The id of the bot's Twitter user, retrieved once. """
+        if self._user_id is None:
+            self._user_id = self._api_call(self._api.verify_credentials).id
+        return self._user_id
 
     def set_bot(self, bot):
         """ Sets the main bot, the bot must be an instance of
@@ -84,7 +232,61 @@ class TwitterEndpoint(object):
         """Make the polling for new DMs stop."""
 
         self._polling_should_run = False
+        self._stopping.set()
+        if self._supervisor is not None:
+            self._supervisor.join()
+            self._supervisor = None
         self._stream.disconnect()
+        self._workers.stop()
+        if self._outbox is not None:
+            self._outbox.stop()
+
+    def health(self):
+        """ Returns whether the stream is connected and not stalled (`alive`),
+            the number of messages waiting to be processed or sent
+            (`queue_depth`) and the state of the circuit of the REST API
+            (`circuit`).
+        """
+        queue_depth = self._workers.queue_depth
+        if self._outbox is not None:
+            queue_depth += self._outbox.queue_depth
+        return {
+            'alive': self._stream_is_alive() and
+                     clock() - self._last_activity < self.stall_timeout,
+            'queue_depth': queue_depth,
+            'circuit': self._guard.breaker.state,
+        }
+
+    def _stream_is_alive(self):
+        """ Returns true if the stream's thread is running. """
+        thread = getattr(self._stream, '_thread', None)
+        return bool(self._stream is not None and self._stream.running and
+                    thread is not None and thread.is_alive())
+
+    def _api_call(self, function, *args, **kwargs):
+        """ Calls the `tweepy.API` method `function` through the circuit
+            breaker and the bulkhead of the endpoint, holding a connection
+            slot of the http client.
+        """
+        return self._guard.call(self._call_in_slot, function, *args,
+                                **kwargs)
+
+    def _call_in_slot(self, function, *args, **kwargs):
+        "calls `function` holding a connection slot of the http client"
+        with self._http_client.slot(self._api_host):
+            return function(*args, **kwargs)
+
+    def send_message(self, user_id, text):
+        """ Sends `text` to the user with id `user_id` as a DM. """
+        self._api_call(self._api.send_direct_message,
+                       text=text, user_id=user_id)
+
+    def _deliver(self, user_id, text):
+        """ Sends the DM, through the outbox if any. """
+        if self._outbox is None:
+            self.send_message(user_id, text)
+        else:
+            self._outbox.deliver(user_id, text)
 
     def start_polling(self):
         """ Strats an infinite loop to see if there are new events.
@@ -93,46 +295,153 @@ class TwitterEndpoint(object):
             (set `True` by `self.run` and `False` by `self.stop`)
         """
 
+        self._connect()
+        self._polling_is_running = True
+
+        if self._supervisor is None and self._polling_should_run:
+            self._stopping.clear()
+            self._supervisor = Thread(target=self._supervise,
+                                      name='eddie-twitter-supervisor')
+            self._supervisor.daemon = True
+            self._supervisor.start()
+
+    def _connect(self):
+        """ Opens the stream, read in a thread of its own. """
         stream_listener = MyStreamListener()
         stream_listener.set_endpoint(self)
-        self._stream = tweepy.Stream(
-            auth=self._api.auth,
-            listener=stream_listener
-        )
+        # a read waiting longer than this raises: tweepy reconnects
+        options = {'timeout': self.stall_timeout}
+        if self._stream_host is None:
+            self._stream = tweepy.Stream(
+                auth=self._api.auth,
+                listener=stream_listener,
+                **options
+            )
+        else:
+            self._stream = _Stream(
+                auth=self._api.auth,
+                listener=stream_listener,
+                host=self._stream_host,
+                **options
+            )
 
+        self._last_activity = clock()
         self._stream.userstream(async=True)
 
-        self._polling_is_running = True
+    def _supervise(self):
+        """ Thread target: reconnects the stream when it stops or stalls,
+            until `stop`.
+        """
+        interval = min(self.stall_timeout / 3.0, 5.0)
+        while not self._stopping.wait(interval):
+            stalled = clock() - self._last_activity >= self.stall_timeout
+            if self._stream_is_alive() and not stalled:
+                continue
+            self.metrics.incr('stream_stalls' if stalled else 'stream_drops')
+            delay, self._backoff = \
+                self._backoff, min(self._backoff * 2, self.max_backoff)
+            logging.warning("Twitter stream %s, reconnecting in %.0f s",
+                            'stalled' if stalled else 'stopped', delay)
+            self._stream.disconnect()
+            if self._stopping.wait(delay):
+                return
+            self.metrics.incr('stream_reconnects')
+            self._connect()
+
+    def on_stream_connected(self):
+        """ Called by the stream listener at every connection: after the
+            first one the DMs missed while disconnected are recovered.
+
+            The DMs are recovered from the last one processed before the
+            connection: the stream may deliver newer ones before the backfill
+            runs.
+        """
+        self._backoff = self.min_backoff
+        self._connections += 1
+        if self._connections > 1:
+            with self._dm_lock:
+                since_id = self._last_processed_dm
+            self._workers.submit(self.backfill_direct_messages, since_id)
+
+    def backfill_direct_messages(self, since_id=None):
+        """ Processes the DMs received after `since_id` (default: the last
+            one processed) not processed yet, at most `backfill_count`,
+            fetched with the REST API.
+
+            Nothing is fetched before the first DM processed: the old DMs
+            must not be answered at the first start.
+        """
+        if since_id is None:
+            with self._dm_lock:
+                since_id = self._last_processed_dm
+        if not since_id:
+            return
+        try:
+            direct_messages = self._api_call(
+                self._api.direct_messages, since_id=since_id,
+                count=self.backfill_count, full_text=True)
+        except Exception:  # pylint: disable=broad-except
+            logging.exception("Error fetching the missed DMs")
+            return
+
+        direct_messages = sorted(
+            (getattr(direct_message, '_json', direct_message)
+             for direct_message in direct_messages),
+            key=lambda direct_message: direct_message['id'])
+        for direct_message in direct_messages:
+            if direct_message['sender']['id'] != self.user_id and \
+                    self._accept_direct_message(direct_message):
+                self.metrics.incr('backfilled_messages')
 
     def process_new_direct_message(self, direct_message):
         """ Method called for each new DMs arrived.
+
+            The DM is marked as processed right away, in arrival order, then
+            the reply is left to the workers.
         """
 
-        if direct_message['id'] > self._last_processed_dm:
-            response = self._bot.process(in_message=direct_message['text'])
+        self._accept_direct_message(direct_message)
+        return True
 
-            self._api.send_direct_message(
-                text=response,
-                user_id=direct_message['sender']['id']
-            )
+    def _accept_direct_message(self, direct_message):
+        """ Leaves the reply to the workers if the DM was not processed yet,
+            returns whether it wasn't.
+        """
+        dm_id = direct_message['id']
+        with self._dm_lock:
+            if dm_id in self._recent_dms:
+                return False
+            self._recent_dms.add(dm_id)
+            self._recent_dms_order.append(dm_id)
+            if len(self._recent_dms_order) > _RECENT_DMS:
+                self._recent_dms.discard(self._recent_dms_order.popleft())
+            self._last_processed_dm = max(self._last_processed_dm, dm_id)
+        self._workers.submit_keyed(
+            direct_message['sender']['id'],
+            self.reply_to_direct_message,
+            direct_message
+        )
+        return True
 
-            self._last_processed_dm = direct_message['id']
+    def reply_to_direct_message(self, direct_message):
+        """ Gets the bot's response to the DM and sends it to the sender.
+        """
+        response = self._bot.process(Message(
+            direct_message['text'], user=direct_message['sender']['id'],
+            endpoint=self))
 
-        return True
+        self._deliver(direct_message['sender']['id'], response)
 
     def process_new_follower(self, user):
         """ Follow the user if it isn't already followed.
             This method should be called at startup for all the followers and
             when a new user follow us.
         """
-        already_friends = self._api.friends_ids()
+        already_friends = self._api_call(self._api.friends_ids)
         if user['id'] not in already_friends:
-            self._api.create_friendship(user_id=user['id'])
+            self._api_call(self._api.create_friendship, user_id=user['id'])
 
-            self._api.send_direct_message(
-                text=self._bot.start(),
-                user_id=user['id']
-            )
+            self._deliver(user['id'], self._bot.start())
 
         return True
 
@@ -141,5 +450,5 @@ class TwitterEndpoint(object):
         """
         [
             self.process_new_follower({'id': uid})
-            for uid in self._api.followers_ids()
+            for uid in self._api_call(self._api.followers_ids)
         ]
@@ -0,0 +1,230 @@
+""" Answers to free text messages from a list of frequently asked questions,
+    using `numpy` (optional dependency: `pip install eddie[faq]`).
+"""
+
+from __future__ import absolute_import, division
+import io
+import json
+import os
+import re
+import zlib
+from math import log, sqrt
+from threading import Lock
+
+from ._compat import json_text
+
+try:
+    import numpy
+except ImportError:  # optional dependency
+    numpy = None
+
+
+_NON_WORD = re.compile(r'\W+', re.UNICODE)
+
+
+def _features(text, ngram, dimensions):
+    """ Returns the hashed character n-grams of `text` as two lists, indices
+        and weights (sublinear tf, normalized).
+    """
+    text = u' %s ' % _NON_WORD.sub(u' ', text.lower()).strip()
+    counts = {}
+    for start in range(max(len(text) - ngram + 1, 1)):
+        gram = text[start:start + ngram].encode('utf-8')
+        # crc32 and not hash(): the same on every process, for the snapshots
+        index = zlib.crc32(gram) & (dimensions - 1)
+        counts[index] = counts.get(index, 0) + 1
+    weights = dict(
+        (index, 1 + log(count)) for index, count in counts.items())
+    norm = sqrt(sum(weight * weight for weight in weights.values()))
+    indices = sorted(weights)
+    return indices, [weights[index] / norm for index in indices]
+
+
+class _Matrix(object):
+    """ Sparse matrix, one row per question, in CSR format (`indptr`,
+        `indices`, `data` arrays).
+    """
+
+    def __init__(self, indptr, indices, data):
+        self.indptr = indptr
+        self.indices = indices
+        self.data = data
+
+    @classmethod
+    def from_rows(cls, rows):
+        """ Builds the matrix from a list of `(indices, weights)`. """
+        indptr = numpy.zeros(len(rows) + 1, dtype=numpy.int64)
+        indptr[1:] = numpy.cumsum([len(indices) for indices, _ in rows])
+        indices = numpy.fromiter(
+            (index for row, _ in rows for index in row),
+            dtype=numpy.int32, count=indptr[-1])
+        data = numpy.fromiter(
+            (weight for _, weights in rows for weight in weights),
+            dtype=numpy.float32, count=indptr[-1])
+        return cls(indptr, indices, data)
+
+    def __len__(self):
+        return len(self.indptr) - 1
+
+    def dot(self, vector):
+        """ Returns the dot product of every row with the dense `vector`. """
+        if not len(self):
+            return numpy.zeros(0, dtype=numpy.float32)
+        # every row has at least one element, as reduceat requires
+        return numpy.add.reduceat(self.data * vector[self.indices],
+                                  self.indptr[:-1])
+
+    def concatenate(self, other):
+        """ Returns a new matrix with the rows of `self` and `other`. """
+        return _Matrix(
+            numpy.concatenate(
+                (self.indptr[:-1], other.indptr + self.indptr[-1])),
+            numpy.concatenate((self.indices, other.indices)),
+            numpy.concatenate((self.data, other.data)),
+        )
+
+
+class FaqResponder(object):
+    """ Finds the FAQ entries most similar to a message: the cosine
+        similarity of the hashed character `ngram`s of the texts, computed
+        for all the questions at once with `numpy`.
+
+        Example usage:
+
+            >>> faq = FaqResponder(threshold=0.4)
+            >>> faq.add('How do I reset my password?', 'Go to Settings...')
+            >>> faq.add('What are the opening hours?', 'From 9 to 18.')
+            >>> faq.answer('opening hours?')
+            'From 9 to 18.'
+
+        Use it in `default_response`, or add it as middleware to answer the
+        messages matching a question before they reach the bot:
+
+            >>> bot.add_middleware(faq)
+
+        Questions can be added at any time: they go to a small separate
+        index, merged with the main one when it grows, so adding is cheap.
+
+        `save` writes a snapshot of the index, `load` maps it in memory
+        (`mmap`) instead of reading it: processes loading the same snapshot
+        share a single copy of it.
+    """
+
+    _ARRAYS = ('indptr', 'indices', 'data')
+
+    def __init__(self, threshold=0.5, ngram=3, dimensions=2 ** 16):
+        if numpy is None:
+            raise ImportError('FaqResponder requires numpy')
+        if dimensions & (dimensions - 1):
+            raise ValueError('dimensions must be a power of 2')
+        self.threshold = threshold
+        self.ngram = ngram
+        self.dimensions = dimensions
+        self.questions = []
+        self.answers = []
+        self._matrix = _Matrix.from_rows([])
+        self._pending = []  # rows not yet in a matrix
+        self._delta = _Matrix.from_rows([])  # rows added after the matrix
+        self._delta_rows = []
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self.questions)
+
+    def add(self, question, answer):
+        """ Adds a question and its answer. """
+        row = _features(question, self.ngram, self.dimensions)
+        with self._lock:
+            self.questions.append(question)
+            self.answers.append(answer)
+            self._pending.append(row)
+
+    def extend(self, entries):
+        """ Adds many `(question, answer)` entries. """
+        for question, answer in entries:
+            self.add(question, answer)
+
+    def _matrices(self):
+        """ Returns the up to date matrices: the main one and the delta. """
+        with self._lock:
+            if self._pending:
+                self._delta_rows.extend(self._pending)
+                self._pending = []
+                delta = _Matrix.from_rows(self._delta_rows)
+                if len(self._delta_rows) > max(1024, len(self._matrix) // 10):
+                    self._matrix = self._matrix.concatenate(delta)
+                    self._delta_rows = []
+                    delta = _Matrix.from_rows([])
+                self._delta = delta
+            return self._matrix, self._delta
+
+    def search(self, text, k=3):
+        """ Returns the `k` entries most similar to `text` as a list of
+            `(score, question, answer)`, most similar first.
+        """
+        matrix, delta = self._matrices()
+        indices, weights = _features(text, self.ngram, self.dimensions)
+        vector = numpy.zeros(self.dimensions, dtype=numpy.float32)
+        vector[indices] = weights
+        scores = numpy.concatenate((matrix.dot(vector), delta.dot(vector)))
+
+        k = min(k, len(scores))
+        if not k:
+            return []
+        best = numpy.argpartition(-scores, k - 1)[:k]
+        best = best[numpy.argsort(-scores[best])]
+        return [(float(scores[index]), self.questions[index],
+                 self.answers[index]) for index in best]
+
+    def answer(self, text):
+        """ Returns the answer of the question most similar to `text`, None
+            if the similarity is below `threshold`.
+        """
+        best = self.search(text, k=1)
+        if best and best[0][0] >= self.threshold:
+            return best[0][2]
+        return None
+
+    def __call__(self, bot, in_message, next_handler):
+        """ Middleware: answers the messages matching a question. """
+        answer = self.answer(in_message)
+        if answer is None:
+            return next_handler(in_message)
+        return answer
+
+    def save(self, directory):
+        """ Writes a snapshot of the index in `directory`. """
+        matrix, delta = self._matrices()
+        matrix = matrix.concatenate(delta)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        for name in self._ARRAYS:
+            numpy.save(os.path.join(directory, name + '.npy'),
+                       getattr(matrix, name))
+        with io.open(os.path.join(directory, 'entries.json'), 'w',
+                     encoding='utf-8') as entries:
+            entries.write(json_text(json.dumps({
+                'threshold': self.threshold,
+                'ngram': self.ngram,
+                'dimensions': self.dimensions,
+                'questions': self.questions[:len(matrix)],
+                'answers': self.answers[:len(matrix)],
+            }, ensure_ascii=False)))
+
+    @classmethod
+    def load(cls, directory, mmap=True):
+        """ Loads a snapshot written by `save`, mapping it in memory (read
+            only) if `mmap`.
+        """
+        with io.open(os.path.join(directory, 'entries.json'),
+                     encoding='utf-8') as entries:
+            state = json.loads(entries.read())
+        faq = cls(state['threshold'], state['ngram'], state['dimensions'])
+        faq.questions = state['questions']
+        faq.answers = state['answers']
+        faq._matrix = _Matrix(*[
+            numpy.load(os.path.join(directory, name + '.npy'),
+                       mmap_mode='r' if mmap else None)
+            for name in cls._ARRAYS
+        ])
+        return faq
@@ -0,0 +1,174 @@
+""" Dialogue flows: multi-step conversations (forms, onboarding...) declared
+    as graphs of states and compiled into transition tables.
+"""
+
+from __future__ import absolute_import
+from collections import OrderedDict
+
+
+# returned by `FlowEngine.handle` for the messages of users not in a flow
+NOT_IN_FLOW = object()
+
+
+def _normalize(text):
+    """ The form of the messages and of the transitions compared. """
+    return text.strip().lower()
+
+
+class Flow(object):
+    """ A conversation graph: every state has a prompt, sent to the user
+        entering it, and the transitions to follow with the next message.
+
+        Example usage:
+
+            >>> signup = Flow('signup', anywhere={'/cancel': 'cancelled'})
+            >>> signup.state('name', 'What is your name?',
+            ...              action=save_name, otherwise='confirm')
+            >>> signup.state('confirm', 'Do you confirm? (yes/no)',
+            ...              transitions={'yes': 'done', 'no': 'name'})
+            >>> signup.state('done', 'Welcome aboard!')
+            >>> signup.state('cancelled', 'Ok, maybe later.')
+            >>> bot.add_flow(signup)
+            >>> bot.process('/signup', user=42)
+            'What is your name?'
+
+        The flow starts with the command `command` (default: the name of the
+        flow) in its first state. A message is matched, stripped and
+        lowercase, against the `transitions` of the state of the user, then
+        against the `anywhere` ones of the flow: when nothing matches the
+        user goes to `otherwise` (default: the same state, the prompt is
+        repeated).
+
+        The flow ends entering a state with no transitions and no
+        `otherwise`: its prompt is the last message.
+
+        `action(bot, user, in_message)` is called with every message received
+        in the state (i.e. to save the answers), if it returns the name of a
+        state the user goes there instead (i.e. to ask again an invalid
+        answer). `prompt` can also be a callable `prompt(bot, user)`
+        returning the text.
+    """
+
+    def __init__(self, name, command=None, anywhere=None):
+        self.name = name
+        self.command = command or name
+        self.anywhere = anywhere or {}
+        self.states = OrderedDict()
+
+    def state(self, name, prompt, transitions=None, otherwise=None,
+              action=None):
+        """ Adds the state `name`, the first one added is the initial
+            state.
+        """
+        self.states[name] = (prompt, transitions or {}, otherwise, action)
+        return self
+
+
+class SessionStore(object):
+    """ The state of every user in a flow, a small integer: one dictionary
+        per endpoint mapping the users to their state, so no key object is
+        allocated per message and a session costs a dictionary entry.
+    """
+
+    def __init__(self):
+        self._endpoints = {}
+
+    def __len__(self):
+        return sum(len(sessions) for sessions in self._endpoints.values())
+
+    def get(self, user, endpoint=None):
+        """ Returns the state of `user` on `endpoint`, None if not in a
+            flow.
+        """
+        sessions = self._endpoints.get(endpoint)
+        return None if sessions is None else sessions.get(user)
+
+    def set(self, user, endpoint, state):
+        """ Sets the state of `user` on `endpoint`. """
+        sessions = self._endpoints.get(endpoint)
+        if sessions is None:
+            sessions = self._endpoints[endpoint] = {}
+        sessions[user] = state
+
+    def delete(self, user, endpoint=None):
+        """ Removes `user` on `endpoint` from its flow, if any. """
+        sessions = self._endpoints.get(endpoint)
+        if sessions is not None:
+            sessions.pop(user, None)
+
+
+class FlowEngine(object):
+    """ The flows of a bot compiled into tables indexed by state number:
+        every message of a user in a flow costs a dictionary lookup in the
+        session store and one in the transitions of the state.
+    """
+
+    def __init__(self, flows, sessions, command_prepend='/'):
+        self.sessions = sessions
+        self._starts = {}  # command -> initial state
+        self._prompts = []
+        self._transitions = []  # normalized text -> state
+        self._otherwise = []
+        self._actions = []
+        self._final = []
+        self._names = []  # name -> state, of the flow of the state
+        for flow in flows:
+            self._add(flow, command_prepend)
+
+    def _add(self, flow, command_prepend):
+        "compiles the states of `flow`"
+        if not flow.states:
+            raise ValueError("Flow %r has no states" % flow.name)
+        offset = len(self._prompts)
+        names = dict((name, offset + index)
+                     for index, name in enumerate(flow.states))
+
+        def number(name):
+            "the number of the state `name`"
+            if name not in names:
+                raise ValueError(
+                    "Flow %r has no state %r" % (flow.name, name))
+            return names[name]
+
+        anywhere = dict((_normalize(text), number(name))
+                        for text, name in flow.anywhere.items())
+        for name, (prompt, transitions, otherwise, action) in \
+                flow.states.items():
+            table = dict(anywhere)
+            table.update((_normalize(text), number(target))
+                         for text, target in transitions.items())
+            self._prompts.append(prompt)
+            self._transitions.append(table)
+            self._final.append(not transitions and otherwise is None)
+            self._otherwise.append(
+                names[name] if otherwise is None else number(otherwise))
+            self._actions.append(action)
+            self._names.append(names)
+        self._starts[_normalize(command_prepend + flow.command)] = offset
+
+    def handle(self, bot, user, endpoint, in_message):
+        """ Returns the reply to `in_message` if it starts a flow or `user`
+            is in one, `NOT_IN_FLOW` otherwise.
+        """
+        text = _normalize(in_message)
+        state = self._starts.get(text)
+        if state is None:
+            state = self.sessions.get(user, endpoint)
+            if state is None:
+                return NOT_IN_FLOW
+            target = None
+            action = self._actions[state]
+            if action is not None:
+                target = action(bot, user, in_message)
+            if target is None:
+                state = self._transitions[state].get(
+                    text, self._otherwise[state])
+            else:
+                state = self._names[state][target]
+
+        if self._final[state]:
+            self.sessions.delete(user, endpoint)
+        else:
+            self.sessions.set(user, endpoint, state)
+        prompt = self._prompts[state]
+        return prompt(bot, user) if callable(prompt) else prompt
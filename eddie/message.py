@@ -0,0 +1,42 @@
+""" The messages received by the endpoints, in a single compact shape.
+"""
+
+from __future__ import absolute_import
+from collections import namedtuple
+from time import time
+
+
+class Message(namedtuple('Message', 'text user chat endpoint timestamp')):
+    """ A message received by an endpoint: its `text`, the `user` who sent
+        it, the `chat` it was sent in (the user itself for private chats),
+        the `endpoint` and the `timestamp` (seconds since the epoch) it was
+        received at.
+
+        It's a tuple with no instance dictionary (`__slots__ = ()`): the
+        fields reference the objects the endpoint already has, nothing is
+        copied, and a million messages take the memory of a million tuples
+        of five items.
+
+        Example usage:
+
+            >>> message = Message('/start', user=42, endpoint=endpoint)
+            >>> bot.process(message)
+            'Welcome!'
+
+        `Bot.process` takes the sender from the message, see `sender`.
+    """
+
+    __slots__ = ()
+
+    def __new__(cls, text, user=None, chat=None, endpoint=None,
+                timestamp=None):
+        return tuple.__new__(cls, (
+            text, user, user if chat is None else chat, endpoint,
+            time() if timestamp is None else timestamp))
+
+    @property
+    def sender(self):
+        """ The key identifying the sender, `(user, endpoint)`: the same user
+            id on two different services is two different senders.
+        """
+        return (self.user, self.endpoint)
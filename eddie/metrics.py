@@ -0,0 +1,69 @@
+""" Counters and timings collected by bots and endpoints.
+"""
+
+from __future__ import absolute_import, division
+from collections import deque
+from threading import Lock
+
+
+class Metrics(object):
+    """ Thread-safe counters and timings.
+
+        Only the last `samples` values of every timing are kept, so the
+        memory used does not grow with the traffic.
+
+        Example usage:
+
+            >>> metrics = Metrics()
+            >>> metrics.incr('messages')
+            >>> metrics.observe('latency', 0.012)
+            >>> metrics.snapshot()
+            {'counters': {'messages': 1, 'latency': 1},
+             'timings': {'latency': {'p50': 0.012, 'p99': 0.012}}}
+    """
+
+    def __init__(self, samples=1024):
+        self._samples = samples
+        self._lock = Lock()
+        self.counters = {}
+        self._timings = {}
+
+    def incr(self, name, value=1):
+        """ Increments the counter `name` by `value`. """
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, value):
+        """ Records a `value` for the timing `name` and counts it. """
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + 1
+            timing = self._timings.get(name)
+            if timing is None:
+                timing = self._timings[name] = deque(maxlen=self._samples)
+            timing.append(value)
+
+    def percentile(self, name, fraction):
+        """ Returns the value below which `fraction` (0..1) of the recent
+            values of the timing `name` fall, None if there are no values.
+        """
+        with self._lock:
+            values = sorted(self._timings.get(name, ()))
+        if not values:
+            return None
+        return values[int(round(fraction * (len(values) - 1)))]
+
+    def snapshot(self):
+        """ Returns all the counters and the p50/p99 of all the timings. """
+        with self._lock:
+            counters = dict(self.counters)
+            names = list(self._timings)
+        return {
+            'counters': counters,
+            'timings': dict(
+                (name, {
+                    'p50': self.percentile(name, 0.50),
+                    'p99': self.percentile(name, 0.99),
+                })
+                for name in names
+            ),
+        }
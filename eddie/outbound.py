@@ -0,0 +1,126 @@
+""" Outbound delivery of the replies: the endpoints can use an `Outbox` to
+    send the messages in background, coalescing the ones sent to the same
+    user in a short time.
+"""
+
+from __future__ import absolute_import
+import logging
+from collections import deque
+from threading import Condition, Thread
+from time import time
+
+from .metrics import Metrics
+from .pool import WorkerPool
+
+
+class Outbox(object):
+    """ Delivers messages calling `send(user_id, text)` from a pool of
+        `workers` threads, so that many sends (and connections) proceed in
+        parallel, while the messages to the same user keep their order.
+
+        The messages to the same user queued within `coalesce_window`
+        seconds from the first one are joined with `separator` and sent as a
+        single message.
+
+        Example usage:
+
+            >>> outbox = Outbox(endpoint.send_message, coalesce_window=0.2)
+            >>> outbox.deliver(user_id, 'Hello!')
+            >>> outbox.deliver(user_id, 'How are you?')  # a single message
+
+        Sent messages, coalesced messages and errors are counted in
+        `outbox.metrics`, together with the delivery latency (seconds from
+        queueing to the end of the send).
+    """
+
+    def __init__(self, send, coalesce_window=0.1, separator='\n', workers=4,
+                 name='eddie-outbox'):
+        self._send = send
+        self.coalesce_window = coalesce_window
+        self.separator = separator
+        self.metrics = Metrics()
+        self._pool = WorkerPool(workers, name=name)
+        self._condition = Condition()
+        # user_id -> (queueing time of the first message, texts)
+        self._pending = {}
+        # (deadline, user_id), the window is fixed so it's sorted by deadline
+        self._due = deque()
+        self._flusher = None
+        self._running = False
+
+    @property
+    def queue_depth(self):
+        """ Number of users with messages waiting to be sent. """
+        return len(self._pending) + self._pool.queue_depth
+
+    def deliver(self, user_id, text):
+        """ Queues `text` to be sent to `user_id`. """
+        now = time()
+        if not self.coalesce_window:
+            self._pool.submit_keyed(user_id, self._deliver, user_id, [text],
+                                    now)
+            return
+
+        with self._condition:
+            pending = self._pending.get(user_id)
+            if pending is not None:
+                pending[1].append(text)
+                return
+            self._pending[user_id] = (now, [text])
+            self._due.append((now + self.coalesce_window, user_id))
+            if not self._running:
+                self._start_flusher()
+            self._condition.notify()
+
+    def _start_flusher(self):
+        self._running = True
+        self._flusher = Thread(target=self._flush_loop, name='eddie-flusher')
+        self._flusher.daemon = True
+        self._flusher.start()
+
+    def _flush_loop(self):
+        """ Thread target: sends the messages whose window has expired. """
+        with self._condition:
+            while self._running or self._due:
+                if not self._due:
+                    self._condition.wait()
+                    continue
+                deadline, user_id = self._due[0]
+                delay = deadline - time()
+                if delay > 0 and self._running:
+                    self._condition.wait(delay)
+                    continue
+                self._due.popleft()
+                queued, texts = self._pending.pop(user_id)
+                self._pool.submit_keyed(user_id, self._deliver, user_id,
+                                        texts, queued)
+                self._condition.notify_all()
+
+    def _deliver(self, user_id, texts, queued):
+        try:
+            self._send(user_id, self.separator.join(texts))
+        except Exception:  # pylint: disable=broad-except
+            self.metrics.incr('delivery_errors')
+            logging.exception("Error sending a message to %s", user_id)
+            return
+        self.metrics.incr('delivered')
+        if len(texts) > 1:
+            self.metrics.incr('coalesced', len(texts) - 1)
+        self.metrics.observe('delivery_latency', time() - queued)
+
+    def join(self):
+        """ Waits until all the queued messages have been sent. """
+        with self._condition:
+            while self._pending:
+                self._condition.wait(0.05)
+        self._pool.join()
+
+    def stop(self):
+        """ Sends the queued messages right away, then stops the threads. """
+        with self._condition:
+            self._running = False
+            self._condition.notify_all()
+        if self._flusher is not None:
+            self._flusher.join()
+            self._flusher = None
+        self._pool.stop()
@@ -0,0 +1,138 @@
+""" A minimal thread pool, used to process messages outside of the threads
+    receiving them (http server, streams, polling).
+"""
+
+from __future__ import absolute_import
+import logging
+from collections import deque
+from threading import Lock, Thread
+
+try:  # Python 3
+    from queue import Queue
+except ImportError:  # Python 2
+    from Queue import Queue
+
+
+_STOP = object()
+
+
+class WorkerPool(object):
+    """ A pool of `workers` threads executing the submitted functions.
+
+        The functions submitted with the same key (see `submit_keyed`) are
+        executed one at a time in submission order, while functions with
+        different keys run in parallel: using the user as key, the replies
+        keep the order of the messages.
+
+        With `workers=0` the functions are executed right away in the
+        calling thread.
+
+        Example usage:
+
+            >>> pool = WorkerPool(workers=4)
+            >>> pool.submit(print, 'hello')
+            >>> pool.submit_keyed('user1', print, 'first')
+            >>> pool.submit_keyed('user1', print, 'second')
+            >>> pool.join()  # waits for all the submitted functions
+            >>> pool.stop()
+
+        Threads are started at the first submission.
+    """
+
+    def __init__(self, workers=4, name='eddie-worker'):
+        self.workers = workers
+        self._name = name
+        self._queue = Queue()
+        self._threads = []
+        self._lock = Lock()
+        # key -> tasks waiting for the running one with the same key
+        self._keyed = {}
+
+    @property
+    def queue_depth(self):
+        """ Number of functions waiting for a free worker. """
+        return self._queue.qsize()
+
+    def submit(self, function, *args, **kwargs):
+        """ Executes `function(*args, **kwargs)` in one of the workers. """
+        self._submit((None, function, args, kwargs))
+
+    def submit_keyed(self, key, function, *args, **kwargs):
+        """ Executes `function(*args, **kwargs)` in one of the workers, after
+            all the functions previously submitted with the same `key`.
+        """
+        task = (key, function, args, kwargs)
+        if key is not None and self.workers:
+            with self._lock:
+                if key in self._keyed:
+                    self._keyed[key].append(task)
+                    return
+                self._keyed[key] = deque()
+        self._submit(task)
+
+    def _submit(self, task):
+        if not self.workers:
+            self._run(task)
+            return
+        if not self._threads:
+            self.start()
+        self._queue.put(task)
+
+    def start(self):
+        """ Starts the worker threads, if not running. """
+        with self._lock:
+            if self._threads:
+                return
+            for index in range(self.workers):
+                thread = Thread(
+                    target=self._work,
+                    name='%s-%d' % (self._name, index)
+                )
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def join(self):
+        """ Waits until all the submitted functions have been executed. """
+        self._queue.join()
+
+    def stop(self):
+        """ Waits for the submitted functions, then stops the threads. """
+        self.join()
+        with self._lock:
+            threads, self._threads = self._threads, []
+        for _ in threads:
+            self._queue.put(_STOP)
+        for thread in threads:
+            thread.join()
+
+    def _work(self):
+        """ Thread target: executes the tasks until asked to stop. """
+        while True:
+            task = self._queue.get()
+            try:
+                if task is _STOP:
+                    return
+                self._run(task)
+                if task[0] is not None:
+                    self._next_keyed(task[0])
+            finally:
+                self._queue.task_done()
+
+    def _next_keyed(self, key):
+        """ Queues the next task waiting for `key`, if any. """
+        with self._lock:
+            waiting = self._keyed[key]
+            if not waiting:
+                del self._keyed[key]
+                return
+            task = waiting.popleft()
+        self._queue.put(task)
+
+    @staticmethod
+    def _run(task):
+        _, function, args, kwargs = task
+        try:
+            function(*args, **kwargs)
+        except Exception:  # pylint: disable=broad-except
+            logging.exception("Error executing %r", function)
@@ -0,0 +1,118 @@
+""" Profiling of the slow messages, to find what causes latency spikes.
+"""
+
+from __future__ import absolute_import
+import cProfile
+import heapq
+import pstats
+import random
+import threading
+from itertools import count
+from time import time
+
+try:  # Python 3
+    from io import StringIO
+except ImportError:  # Python 2
+    from StringIO import StringIO
+
+from ._compat import perf_clock
+
+
+# only one cProfile at a time can be active in a thread
+_active = threading.local()
+
+
+class SlowMessageProfiler(object):
+    """ Middleware keeping the `keep` slowest messages processed in more than
+        `threshold` seconds.
+
+        Profiling every message would slow down all of them, so only a random
+        `sample_rate` fraction (0..1) of the messages is run under `cProfile`:
+        the slow ones among these are kept with their profile (the `lines`
+        most expensive functions, by cumulative time), the others with just
+        their duration.
+
+        Example usage:
+
+            >>> profiler = bot.enable_profiling(threshold=0.5, sample_rate=0.1)
+            ...
+            >>> for trace in profiler.traces():
+            ...     print(trace['duration'], trace['in_message'])
+            ...     print(trace['profile'])
+
+        With an `HttpEndpoint` the traces are served at `/debug/slow`.
+    """
+
+    def __init__(self, threshold=0.5, keep=20, sample_rate=0.1, lines=25):
+        self.threshold = threshold
+        self.keep = keep
+        self.sample_rate = sample_rate
+        self.lines = lines
+        self._slowest = []  # min-heap of (duration, sequence, trace)
+        self._sequence = count()
+        self._lock = threading.Lock()
+
+    def __call__(self, bot, in_message, next_handler):
+        if random.random() >= self.sample_rate or \
+                getattr(_active, 'profiling', False):
+            start = perf_clock()
+            try:
+                return next_handler(in_message)
+            finally:
+                duration = perf_clock() - start
+                if duration > self.threshold:
+                    self._record(in_message, duration, None)
+
+        profiler = cProfile.Profile()
+        _active.profiling = True
+        start = perf_clock()
+        profiler.enable()
+        try:
+            return next_handler(in_message)
+        finally:
+            profiler.disable()
+            duration = perf_clock() - start
+            _active.profiling = False
+            if duration > self.threshold:
+                self._record(in_message, duration, profiler)
+
+    def _record(self, in_message, duration, profiler):
+        """ Keeps the trace if it's among the `keep` slowest ones. """
+        with self._lock:
+            if len(self._slowest) >= self.keep and \
+                    duration <= self._slowest[0][0]:
+                return
+
+        trace = {
+            'in_message': in_message,
+            'duration': duration,
+            'time': time(),
+            'thread': threading.current_thread().name,
+            'profile': None,
+        }
+        if profiler is not None:
+            output = StringIO()
+            stats = pstats.Stats(profiler, stream=output)
+            stats.sort_stats('cumulative').print_stats(self.lines)
+            trace['profile'] = output.getvalue()
+
+        item = (duration, next(self._sequence), trace)
+        with self._lock:
+            if len(self._slowest) < self.keep:
+                heapq.heappush(self._slowest, item)
+            else:
+                heapq.heappushpop(self._slowest, item)
+
+    def traces(self):
+        """ Returns the kept traces, slowest first: dictionaries with
+            `in_message`, `duration` (seconds), `time` (timestamp), `thread`
+            and `profile` (text, None if the message was not sampled).
+        """
+        with self._lock:
+            slowest = sorted(self._slowest, reverse=True)
+        return [trace for _, _, trace in slowest]
+
+    def clear(self):
+        """ Forgets all the traces. """
+        with self._lock:
+            self._slowest = []
@@ -0,0 +1,69 @@
+""" Rate limiting of the messages sent to the bots, per user.
+"""
+
+from __future__ import absolute_import, division
+from collections import OrderedDict
+from threading import Lock
+
+from ._compat import clock
+
+
+class RateLimiter(object):
+    """ Token bucket allowing `rate` messages per second, with bursts of at
+        most `burst` messages (default: `rate`, at least 1), for every key.
+
+        The bucket of a key is stored as a single number, the time at which
+        it will be full again (generic cell rate algorithm), in a dictionary
+        bounded to the `max_keys` most recently seen keys: a forgotten key
+        starts again with a full bucket, so memory is bounded and can't be
+        exhausted by many different senders.
+
+        Example usage:
+
+            >>> limiter = RateLimiter(rate=1, burst=3)
+            >>> [limiter.allow('user1') for _ in range(4)]
+            [True, True, True, False]
+            >>> limiter.allow('user2')
+            True
+    """
+
+    def __init__(self, rate, burst=None, max_keys=100000):
+        self.rate = rate
+        self.burst = burst or max(rate, 1)
+        self.max_keys = max_keys
+        self._interval = 1.0 / rate
+        # the debt is rebuilt from timestamps, rounding can push a full
+        # burst a few ulps over the capacity: a millionth of an interval of
+        # slack admits it
+        self._capacity = self._interval * (self.burst + 1e-6)
+        # key -> time at which the bucket is full again, oldest first
+        self._full_at = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._full_at)
+
+    def allow(self, key, cost=1):
+        """ Takes `cost` tokens from the bucket of `key`, returns False
+            (taking nothing) if there aren't enough.
+        """
+        now = clock()
+        with self._lock:
+            # seconds until the bucket is full, after taking the tokens
+            debt = max(self._full_at.pop(key, now) - now, 0) + \
+                self._interval * cost
+            allowed = debt <= self._capacity
+            if not allowed:
+                debt -= self._interval * cost
+            self._full_at[key] = now + debt
+            if len(self._full_at) > self.max_keys:
+                self._full_at.popitem(last=False)
+        return allowed
+
+    def refund(self, key, cost=1):
+        """ Gives back `cost` tokens taken by `allow` from the bucket of
+            `key`, when the message is rejected after all.
+        """
+        with self._lock:
+            if key in self._full_at:
+                self._full_at[key] -= self._interval * cost
@@ -0,0 +1,273 @@
+""" Replays logged conversations through a bot, offline.
+
+    Usage:
+
+        $ python -m eddie.replay mybots.shop:ShopBot log.jsonl -o out.jsonl
+
+    The input is a JSONL file (one message, or one object with the message in
+    the `in_message` field, per line) or a CSV file with an `in_message`
+    column. Every message is passed to `Bot.process` by a pool of processes
+    and the replies are written, in the same order, to the output JSONL file:
+
+        {"offset": 0, "in_message": "hello", "out_message": "Hi!"}
+
+    The log is read and written as a stream, so the memory used does not
+    depend on its size. Use `--resume` to continue an interrupted run from
+    the last message written to the output.
+"""
+
+from __future__ import absolute_import, division, print_function
+import argparse
+import csv
+import importlib
+import io
+import json
+import sys
+from collections import deque
+from itertools import islice
+from multiprocessing import Pool, cpu_count
+from time import time
+
+
+_bot = None
+
+
+def load_bot(spec):
+    """ Returns the bot defined by `spec` (`module:Name`): `Name` can be a
+        bot class, instantiated without arguments, or a bot instance.
+    """
+    module_name, _, name = spec.partition(':')
+    if not name:
+        raise ValueError("The bot must be given as 'module:Name'")
+    bot = getattr(importlib.import_module(module_name), name)
+    if isinstance(bot, type):
+        bot = bot()
+    bot.compile()
+    return bot
+
+
+def _init_worker(spec):
+    """ Pool initializer: loads the bot once per process. """
+    global _bot  # pylint: disable=global-statement
+    _bot = load_bot(spec)
+
+
+def _process_batch(batch):
+    """ Processes a list of `(offset, in_message)`, returning the output
+        records.
+    """
+    results = []
+    for offset, in_message in batch:
+        result = {'offset': offset, 'in_message': in_message}
+        try:
+            result['out_message'] = _bot.process(in_message)
+        except Exception as error:  # pylint: disable=broad-except
+            result['error'] = repr(error)
+        results.append(result)
+    return results
+
+
+def read_messages(filename, input_format='jsonl', field='in_message'):
+    """ Yields the messages of the log `filename`, one at a time. """
+    if input_format == 'csv':
+        if sys.version_info[0] < 3:
+            log_file = open(filename, 'rb')
+        else:
+            log_file = io.open(filename, encoding='utf-8', newline='')
+        with log_file:
+            for row in csv.DictReader(log_file):
+                message = row[field]
+                if isinstance(message, bytes):
+                    message = message.decode('utf-8')
+                yield message
+        return
+
+    with io.open(filename, encoding='utf-8') as log_file:
+        for line in log_file:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            yield record[field] if isinstance(record, dict) else record
+
+
+def resume_offset(filename):
+    """ Returns the offset of the first message missing from the output
+        `filename`, 0 if the file does not exist.
+
+        A last line cut by the interrupted run is removed from the file, so
+        the run continues after the last complete record.
+    """
+    try:
+        output_file = io.open(filename, 'r+b')
+    except IOError:
+        return 0
+    offset = end = position = 0
+    newline = True  # the last complete record ends with a newline
+    with output_file:
+        for line in output_file:
+            position += len(line)
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line.decode('utf-8'))
+            except ValueError:
+                continue
+            offset, end = record['offset'] + 1, position
+            newline = line.endswith(b'\n')
+        if end < position:
+            output_file.seek(end)
+            output_file.truncate()
+        if not newline:
+            output_file.seek(end)
+            output_file.write(b'\n')
+    return offset
+
+
+def _batches(messages, offset, size):
+    """ Yields lists of at most `size` `(offset, message)` pairs, skipping
+        the first `offset` messages.
+    """
+    numbered = islice(enumerate(messages), offset, None)
+    while True:
+        batch = list(islice(numbered, size))
+        if not batch:
+            return
+        yield batch
+
+
+def replay(spec, messages, output, processes=None, offset=0, batch_size=64,
+           progress=None):
+    """ Processes `messages` with the bot of `spec` and writes the results to
+        the `output` file object, as JSON lines.
+
+        The batches of `batch_size` messages are processed by a pool of
+        `processes` processes (all the CPUs if None, in the current process
+        if 0) and at most two batches per process are in flight, so memory
+        stays constant. `progress(count)` is called after every batch.
+
+        Returns the number of messages processed.
+    """
+    count = 0
+    batches = _batches(messages, offset, batch_size)
+
+    def write(results):
+        for result in results:
+            output.write(json.dumps(result) + '\n')
+        output.flush()
+        if progress is not None:
+            progress(count)
+
+    if processes == 0:
+        _init_worker(spec)
+        for batch in batches:
+            count += len(batch)
+            write(_process_batch(batch))
+        return count
+
+    pool = Pool(processes, initializer=_init_worker, initargs=(spec,))
+    try:
+        pending = deque()
+        max_pending = 2 * (processes or cpu_count())
+        for batch in batches:
+            pending.append((len(batch), pool.apply_async(_process_batch,
+                                                          (batch,))))
+            if len(pending) >= max_pending:
+                size, results = pending.popleft()
+                count += size
+                write(results.get())
+        while pending:
+            size, results = pending.popleft()
+            count += size
+            write(results.get())
+    finally:
+        pool.terminate()
+        pool.join()
+    return count
+
+
+class _Progress(object):
+    """ Prints the messages processed and the throughput, at most once per
+        second.
+    """
+
+    def __init__(self, stream=sys.stderr):
+        self.stream = stream
+        self.start = self.last = time()
+
+    def __call__(self, count, final=False):
+        now = time()
+        if not final and now - self.last < 1:
+            return
+        self.last = now
+        self.stream.write('\r%d messages, %.1f msg/s' % (
+            count, count / max(now - self.start, 1e-9)))
+        if final:
+            self.stream.write('\n')
+        self.stream.flush()
+
+
+class _TextWriter(object):
+    """ Wraps a text file accepting the `str` of Python 2 too. """
+
+    def __init__(self, text_file):
+        self._file = text_file
+
+    def write(self, data):
+        if isinstance(data, bytes):
+            data = data.decode('utf-8')
+        self._file.write(data)
+
+    def flush(self):
+        self._file.flush()
+
+
+def main(argv=None):
+    """ Command line entry point. """
+    parser = argparse.ArgumentParser(
+        prog='eddie-replay',
+        description='Replays a conversation log through a bot.')
+    parser.add_argument('bot', help="the bot, as 'module:ClassName'")
+    parser.add_argument('log', help='the log file, JSONL or CSV')
+    parser.add_argument('-o', '--output', required=True,
+                        help='the output file (JSONL)')
+    parser.add_argument('-f', '--format', choices=('jsonl', 'csv'),
+                        help='format of the log (default: from the extension)')
+    parser.add_argument('--field', default='in_message',
+                        help='field (or column) with the message')
+    parser.add_argument('-p', '--processes', type=int, default=None,
+                        help='processes to use, 0 to use none (default: '
+                        'number of CPUs)')
+    parser.add_argument('--batch-size', type=int, default=64)
+    start = parser.add_mutually_exclusive_group()
+    start.add_argument('--offset', type=int, default=0,
+                       help='skip the first OFFSET messages')
+    start.add_argument('--resume', action='store_true',
+                       help='continue from the last message in the output')
+    parser.add_argument('-q', '--quiet', action='store_true',
+                        help="don't show the progress")
+    args = parser.parse_args(argv)
+
+    input_format = args.format or (
+        'csv' if args.log.lower().endswith('.csv') else 'jsonl')
+    offset = resume_offset(args.output) if args.resume else args.offset
+    progress = None if args.quiet else _Progress()
+
+    # the output is appended when resuming, truncated otherwise
+    with io.open(args.output, 'a' if args.resume else 'w',
+                 encoding='utf-8') as output:
+        count = replay(
+            args.bot,
+            read_messages(args.log, input_format, args.field),
+            _TextWriter(output),
+            processes=args.processes,
+            offset=offset,
+            batch_size=args.batch_size,
+            progress=progress,
+        )
+    if progress is not None:
+        progress(count, final=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,223 @@
+""" Protection of the outbound calls of the endpoints from a degraded
+    service: circuit breakers failing fast while the service is down and
+    bulkheads bounding the threads an endpoint can keep waiting on it.
+"""
+
+from __future__ import absolute_import
+import logging
+from threading import Condition, Lock
+
+from ._compat import clock
+from .metrics import Metrics
+
+
+class CircuitOpenError(Exception):
+    """ Raised instead of calling a service whose circuit is open,
+        `retry_after` is the number of seconds before the next call can be
+        let through.
+    """
+
+    def __init__(self, message, retry_after=0.0):
+        super(CircuitOpenError, self).__init__(message)
+        self.retry_after = retry_after
+
+
+class BulkheadFullError(Exception):
+    """ Raised instead of calling a service when all the slots of the
+        bulkhead are taken.
+    """
+
+
+class CircuitBreaker(object):
+    """ Stops calling a service after `failure_threshold` consecutive
+        failures: for `reset_timeout` seconds the calls raise
+        `CircuitOpenError` right away (the circuit is open), then a single
+        trial call is let through (half open), closing the circuit if it
+        succeeds and opening it again if it fails.
+
+        Example usage:
+
+            >>> breaker = CircuitBreaker('twitter', failure_threshold=3)
+            >>> breaker.call(api.send_direct_message, text='Hi', user_id=42)
+
+        `is_failure(error)` tells the errors meaning the service is in
+        trouble (default: all of them) from the ones of a single call (i.e.
+        a message to a user who blocked the bot), which are raised without
+        counting. A `BulkheadFullError` is not a failure either: the call
+        was not made.
+
+        The changes of state are counted in `metrics` (`circuit_open`,
+        `circuit_half_open` and `circuit_closed`), together with the calls
+        rejected (`circuit_rejected`).
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30.0,
+                 is_failure=None, metrics=None):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.is_failure = is_failure or (lambda error: True)
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.state = self.CLOSED
+        self.failures = 0
+        self._opened_at = 0.0
+        self._trial = False  # a trial call is in progress
+        self._lock = Lock()
+
+    def call(self, function, *args, **kwargs):
+        """ Returns `function(*args, **kwargs)` if the circuit lets the call
+            through, raises `CircuitOpenError` otherwise.
+        """
+        self.before()
+        try:
+            result = function(*args, **kwargs)
+        except BulkheadFullError:
+            self.cancel()  # not made, see `OutboundGuard`
+            raise
+        except Exception as error:
+            if self.is_failure(error):
+                self.failure()
+            else:
+                self.success()
+            raise
+        self.success()
+        return result
+
+    def before(self):
+        """ Raises `CircuitOpenError` if the call must not be made. """
+        with self._lock:
+            if self.state == self.OPEN:
+                elapsed = clock() - self._opened_at
+                if elapsed < self.reset_timeout:
+                    self._reject(self.reset_timeout - elapsed)
+                self._change(self.HALF_OPEN)
+            if self.state == self.HALF_OPEN:
+                if self._trial:
+                    # the trial call tells soon whether the service is back
+                    self._reject(min(self.reset_timeout, 1.0))
+                self._trial = True
+
+    def cancel(self):
+        """ Records a call let through by `before` but not made. """
+        with self._lock:
+            self._trial = False
+
+    def success(self):
+        """ Records a call answered by the service. """
+        with self._lock:
+            self.failures = 0
+            self._trial = False
+            if self.state != self.CLOSED:
+                self._change(self.CLOSED)
+
+    def failure(self):
+        """ Records a call failed because of the service. """
+        with self._lock:
+            self.failures += 1
+            self._trial = False
+            if self.state == self.HALF_OPEN or (
+                    self.state == self.CLOSED and
+                    self.failures >= self.failure_threshold):
+                self._opened_at = clock()
+                self._change(self.OPEN)
+                logging.warning("Circuit %s open after %d failures, retrying "
+                                "in %.0f s", self.name, self.failures,
+                                self.reset_timeout)
+
+    def _reject(self, retry_after):
+        "raises `CircuitOpenError`, with the lock held"
+        self.metrics.incr('circuit_rejected')
+        raise CircuitOpenError("Circuit %s is open" % self.name, retry_after)
+
+    def _change(self, state):
+        "moves to `state`, with the lock held"
+        self.state = state
+        self.metrics.incr('circuit_' + state)
+
+
+class Bulkhead(object):
+    """ Lets at most `max_concurrent` calls to a service run at the same
+        time: a call waits at most `max_wait` seconds for a free slot, then
+        raises `BulkheadFullError`. A slow service keeps busy only the
+        threads of its bulkhead, the others go on.
+
+        Example usage:
+
+            >>> bulkhead = Bulkhead('twitter', max_concurrent=4)
+            >>> bulkhead.call(api.friends_ids)
+
+        The calls rejected are counted in `metrics` (`bulkhead_rejected`).
+    """
+
+    def __init__(self, name, max_concurrent=4, max_wait=1.0, metrics=None):
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.max_wait = max_wait
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.in_use = 0
+        self._condition = Condition()
+
+    def call(self, function, *args, **kwargs):
+        """ Returns `function(*args, **kwargs)`, called holding a slot. """
+        self.acquire()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            self.release()
+
+    def acquire(self):
+        """ Takes a slot, raises `BulkheadFullError` if none gets free in
+            `max_wait` seconds.
+        """
+        with self._condition:
+            deadline = None
+            while self.in_use >= self.max_concurrent:
+                now = clock()
+                if deadline is None:
+                    deadline = now + self.max_wait
+                if now >= deadline:
+                    self.metrics.incr('bulkhead_rejected')
+                    raise BulkheadFullError(
+                        "Bulkhead %s is full (%d calls)" %
+                        (self.name, self.in_use))
+                self._condition.wait(deadline - now)
+            self.in_use += 1
+
+    def release(self):
+        """ Frees a slot taken with `acquire`. """
+        with self._condition:
+            self.in_use -= 1
+            self._condition.notify()
+
+
+class OutboundGuard(object):
+    """ The protection of the outbound calls of an endpoint: the circuit
+        breaker first, so a call to a service which is down doesn't even
+        wait for a slot, then the bulkhead.
+
+        Example usage:
+
+            >>> guard = OutboundGuard('twitter', metrics=endpoint.metrics)
+            >>> guard.call(api.create_friendship, user_id=42)
+
+        See `CircuitBreaker` and `Bulkhead` for the arguments.
+    """
+
+    def __init__(self, name, max_concurrent=4, max_wait=1.0,
+                 failure_threshold=5, reset_timeout=30.0, is_failure=None,
+                 metrics=None):
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.breaker = CircuitBreaker(name, failure_threshold, reset_timeout,
+                                      is_failure, self.metrics)
+        self.bulkhead = Bulkhead(name, max_concurrent, max_wait, self.metrics)
+
+    def call(self, function, *args, **kwargs):
+        """ Returns `function(*args, **kwargs)`, raises `CircuitOpenError`
+            or `BulkheadFullError` if the call is rejected.
+        """
+        return self.breaker.call(self.bulkhead.call, function, *args,
+                                 **kwargs)
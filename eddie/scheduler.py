@@ -0,0 +1,254 @@
+""" Proactive messages: reminders and digests sent by the bot at a given
+    time, once or periodically, through its endpoints.
+"""
+
+from __future__ import absolute_import, division
+import heapq
+import io
+import json
+import logging
+import os
+from itertools import count
+from threading import Condition, Thread
+from time import time
+
+from ._compat import json_text, replace, string_types
+from .metrics import Metrics
+from .pool import WorkerPool
+
+
+class Scheduler(object):
+    """ Sends messages at a given time through the endpoints of `bot`
+        (their `send_message(user_id, text)`), see `schedule`.
+
+        The timers are kept in a heap ordered by due time, the timer in
+        the dictionary of the pending ones being the authority: cancelling
+        a timer just removes it from the dictionary. A thread sleeps until
+        the first timer is due, then fires the due timers in batches of at
+        most `batch_size`, one batch per endpoint, sent by a pool of
+        `workers` threads.
+
+        Example usage:
+
+            >>> scheduler = bot.enable_scheduler('timers.jsonl')
+            >>> scheduler.schedule(telegram, chat_id, 'Stand-up time!',
+            ...                    at=next_morning, every=24 * 3600)
+            >>> scheduler.schedule(telegram, chat_id, '/digest',
+            ...                    delay=3600, process=True)
+
+        With a `filename` every change is appended to it as a JSON line, and
+        the timers are loaded from it at startup: the timers due while the
+        bot was down fire right away (the periodic ones once). The file is
+        compacted at load, at `stop` and when most of its lines are stale
+        (i.e. the firings of the periodic timers).
+
+        Sent messages and errors are counted in `scheduler.metrics`, with
+        the lag between the due time and the send (`schedule_lag`, seconds).
+    """
+
+    def __init__(self, bot, filename=None, batch_size=256, workers=4):
+        self.bot = bot
+        self.filename = filename
+        self.batch_size = batch_size
+        self.metrics = Metrics()
+        # timer id -> (due, endpoint name, user_id, text, every, process)
+        self._timers = {}
+        self._heap = []  # (due, timer id)
+        self._ids = count(1)
+        self._condition = Condition()
+        self._pool = WorkerPool(workers, name='eddie-scheduler')
+        self._journal = None
+        self._journal_lines = 0
+        self._thread = None
+        self._running = False
+        if filename is not None and os.path.exists(filename):
+            self._load()
+
+    def __len__(self):
+        return len(self._timers)
+
+    def schedule(self, endpoint, user_id, text, delay=0, at=None, every=None,
+                 process=False):
+        """ Sends `text` to `user_id` through `endpoint` in `delay` seconds
+            or `at` a timestamp, then every `every` seconds if given.
+
+            With `process` the bot's reply to `text` is sent (i.e. a command
+            building a digest), computed when the timer fires.
+
+            `endpoint` is an endpoint of the bot or the name of its class,
+            the name is what is persisted. Returns the id of the timer, for
+            `cancel`.
+        """
+        due = time() + delay if at is None else at
+        if not isinstance(endpoint, string_types):
+            endpoint = type(endpoint).__name__
+        with self._condition:
+            timer_id = next(self._ids)
+            self._add(timer_id, (due, endpoint, user_id, text, every,
+                                 process))
+            self._flush()
+            if self._heap[0][1] == timer_id:
+                self._condition.notify()
+        return timer_id
+
+    def cancel(self, timer_id):
+        """ Removes a timer, returns False if it was not pending. """
+        with self._condition:
+            if self._timers.pop(timer_id, None) is None:
+                return False
+            self._log(['del', timer_id])
+            self._flush()
+            # the heap holds the cancelled timers until they're due
+            if len(self._heap) > 2 * len(self._timers) + 1024:
+                self._heap = [(timer[0], key)
+                              for key, timer in self._timers.items()]
+                heapq.heapify(self._heap)
+        return True
+
+    def _add(self, timer_id, timer):
+        "adds or replaces a timer, with the lock held"
+        self._timers[timer_id] = timer
+        heapq.heappush(self._heap, (timer[0], timer_id))
+        self._log(['add', timer_id] + list(timer))
+
+    def run_pending(self, now=None):
+        """ Fires the timers due at `now` (default: now), at most
+            `batch_size` of them. Returns the number of timers fired.
+        """
+        now = time() if now is None else now
+        batches = {}  # endpoint name -> timers
+        fired = 0
+        with self._condition:
+            heap = self._heap
+            while heap and heap[0][0] <= now and fired < self.batch_size:
+                due, timer_id = heapq.heappop(heap)
+                timer = self._timers.get(timer_id)
+                if timer is None or timer[0] != due:
+                    continue  # cancelled
+                every = timer[4]
+                if every:
+                    # skipping the occurrences missed, i.e. while down
+                    self._add(timer_id, (
+                        due + every * ((now - due) // every + 1),
+                    ) + timer[1:])
+                else:
+                    del self._timers[timer_id]
+                    self._log(['del', timer_id])
+                batches.setdefault(timer[1], []).append(timer)
+                fired += 1
+            self._flush()
+        for name, timers in batches.items():
+            self._pool.submit(self._fire, name, timers)
+        return fired
+
+    def _fire(self, name, timers):
+        """ Sends the messages of `timers` through the endpoint `name`. """
+        endpoint = self.bot.get_endpoint(name)
+        if endpoint is None:
+            self.metrics.incr('scheduled_errors', len(timers))
+            logging.error("No endpoint %s for %d scheduled messages", name,
+                          len(timers))
+            return
+
+        for due, _, user_id, text, _, process in timers:
+            try:
+                if process:
+                    text = self.bot.process(text)
+                if text:
+                    endpoint.send_message(user_id, text)
+            except Exception:  # pylint: disable=broad-except
+                self.metrics.incr('scheduled_errors')
+                logging.exception("Error sending a scheduled message to %s",
+                                  user_id)
+                continue
+            self.metrics.incr('scheduled_sent')
+            self.metrics.observe('schedule_lag', time() - due)
+
+    def start(self):
+        """ Starts the thread firing the timers, if not running. """
+        with self._condition:
+            if self._running:
+                return
+            self._running = True
+            self._thread = Thread(target=self._run_loop,
+                                  name='eddie-scheduler')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run_loop(self):
+        """ Thread target: fires the timers when due, until `stop`. """
+        while True:
+            with self._condition:
+                if not self._running:
+                    return
+                delay = self._heap[0][0] - time() if self._heap else None
+                if delay is None or delay > 0:
+                    self._condition.wait(delay)
+                    continue
+            self.run_pending()
+
+    def stop(self):
+        """ Stops the thread, waits for the messages being sent and compacts
+            the file. The pending timers are kept.
+        """
+        with self._condition:
+            self._running = False
+            self._condition.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._pool.stop()
+        with self._condition:
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
+                self._compact()
+
+    def _log(self, record):
+        "appends a change to the file, with the lock held"
+        if self.filename is None:
+            return
+        if self._journal is None:
+            self._journal = io.open(self.filename, 'a', encoding='utf-8')
+        self._journal.write(json_text(json.dumps(record)) + u'\n')
+        self._journal_lines += 1
+
+    def _flush(self):
+        "writes the changes logged, with the lock held"
+        if self._journal is None:
+            return
+        if self._journal_lines > 2 * len(self._timers) + 1024:
+            self._journal.close()
+            self._journal = None
+            self._compact()
+        else:
+            self._journal.flush()
+
+    def _load(self):
+        """ Reads the timers from the file, then compacts it. """
+        with io.open(self.filename, encoding='utf-8') as journal:
+            for line in journal:
+                try:
+                    record = json.loads(line)
+                except ValueError:  # a line cut by a crash
+                    continue
+                if record[0] == 'add':
+                    self._timers[record[1]] = tuple(record[2:])
+                else:
+                    self._timers.pop(record[1], None)
+        self._heap = [(timer[0], timer_id)
+                      for timer_id, timer in self._timers.items()]
+        heapq.heapify(self._heap)
+        self._ids = count(max(self._timers or [0]) + 1)
+        self._compact()
+
+    def _compact(self):
+        """ Rewrites the file with only the pending timers. """
+        temporary = self.filename + '.tmp'
+        with io.open(temporary, 'w', encoding='utf-8') as journal:
+            for timer_id, timer in self._timers.items():
+                journal.write(
+                    json_text(json.dumps(['add', timer_id] + list(timer))) +
+                    u'\n')
+        replace(temporary, self.filename)
+        self._journal_lines = len(self._timers)
@@ -0,0 +1,77 @@
+""" Single-flight execution: concurrent identical calls run only once.
+"""
+
+from __future__ import absolute_import
+from threading import Event, Lock
+
+from .metrics import Metrics
+
+
+class _Flight(object):
+    """ A call in progress, `done` is set when its result is available. """
+
+    __slots__ = ('done', 'result', 'error', 'waiters')
+
+    def __init__(self):
+        self.done = Event()
+        self.result = self.error = None
+        self.waiters = 0
+
+
+class SingleFlight(object):
+    """ Collapses the concurrent calls with the same key into one execution:
+        the first call runs the function, the others arriving before it
+        returns wait and get the same result (or exception).
+
+        Nothing is cached: a call arriving after the function returned runs
+        it again.
+
+        Example usage:
+
+            >>> flight = SingleFlight()
+            >>> flight.do('/start', expensive_function, 'some argument')
+
+        Executions and saved executions are counted in `metrics`
+        (`single_flight_executions` and `single_flight_saved`).
+    """
+
+    def __init__(self, metrics=None):
+        self.metrics = metrics if metrics is not None else Metrics()
+        self._flights = {}
+        self._lock = Lock()
+
+    def waiters(self, key):
+        """ Number of calls waiting for the execution of `key`. """
+        flight = self._flights.get(key)
+        return 0 if flight is None else flight.waiters
+
+    def do(self, key, function, *args):
+        """ Returns `function(*args)`, sharing the execution with the calls
+            with the same `key` in progress.
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+            else:
+                flight.waiters += 1
+
+        if not leader:
+            flight.done.wait()
+            self.metrics.incr('single_flight_saved')
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        self.metrics.incr('single_flight_executions')
+        try:
+            flight.result = function(*args)
+        except Exception as error:
+            flight.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+        return flight.result
@@ -34,6 +34,12 @@ setup(
     keywords=['chat', 'chatbot', 'telegram', 'twitter'],
     tests_require=['pytest'],
     install_requires=get_requirements('requirements.txt'),
+    extras_require={
+        'faq': ['numpy'],
+    },
+    entry_points={
+        'console_scripts': ['eddie-replay = eddie.replay:main'],
+    },
     classifiers=[
         'Development Status :: 4 - Beta',
         "Programming Language :: Python :: 2",
@@ -0,0 +1,102 @@
+""" Tests for the async (`async def`) features of eddie.bot.Bot, they are not
+    collected on Python versions without `async def` (see conftest.py).
+"""
+
+from eddie.bot import Bot
+
+
+class EchoBot(Bot):
+    "Echo bot"
+
+    def default_response(self, in_message):
+        return in_message
+
+
+def test_async_middlewares():
+    """ Middlewares can be coroutine functions, mixed with the sync ones """
+
+    async def exclaim(bot, in_message, next_handler):
+        "async post processing"
+        return (await next_handler(in_message)) + "!"
+
+    async def lower(bot, in_message, next_handler):
+        "async pre processing"
+        return await next_handler(in_message.lower())
+
+    def strip(bot, in_message, next_handler):
+        "sync middleware between async ones"
+        return next_handler(in_message.strip())
+
+    async def short_circuit(bot, in_message, next_handler):
+        "answers by itself"
+        if in_message == 'ping':
+            return 'pong'
+        return await next_handler(in_message)
+
+    bot = EchoBot()
+    bot.add_middleware(exclaim)
+    bot.add_middleware(lower)
+    bot.add_middleware(strip)
+    bot.add_middleware(short_circuit)
+
+    assert bot.process(" HeLLo ") == "hello!"
+    assert bot.process("PING") == "pong!"
+
+
+def test_async_handlers_deadline():
+    """ Coroutine handlers are awaited, with their deadlines """
+
+    import asyncio
+    from eddie.bot import command
+
+    class AsyncBot(Bot):
+        "Bot with async handlers"
+
+        async def default_response(self, in_message):
+            await asyncio.sleep(0)
+            return in_message
+
+        @command(timeout=0.05)
+        async def slow(self):
+            "never answers in time"
+            await asyncio.sleep(1)
+            return "done"
+
+    bot = AsyncBot()
+    assert bot.process("hello") == "hello"
+    assert bot.process("/slow") == bot.timeout_response
+    assert bot.metrics.counters['timeouts'] == 1
+
+
+def test_async_middlewares_flows():
+    """ The flows know the sender even when an async middleware runs the
+        rest of the chain in another thread
+    """
+
+    from eddie.flow import Flow
+
+    async def outer(bot, in_message, next_handler):
+        "async middleware"
+        return await next_handler(in_message)
+
+    def strip(bot, in_message, next_handler):
+        "sync middleware, running the inner async one in another thread"
+        return next_handler(in_message.strip())
+
+    async def inner(bot, in_message, next_handler):
+        "async middleware, after a sync one"
+        return await next_handler(in_message)
+
+    survey = Flow('survey')
+    survey.state('rating', 'From 1 to 5?', otherwise='done')
+    survey.state('done', 'Thank you!')
+
+    bot = EchoBot()
+    bot.add_flow(survey)
+    bot.add_middleware(outer)
+    bot.add_middleware(strip)
+    bot.add_middleware(inner)
+
+    assert bot.process('/survey', user=42) == 'From 1 to 5?'
+    assert bot.process(' 5 ', user=42) == 'Thank you!'
+    assert bot.process(' 5 ') == '5'
@@ -74,3 +74,165 @@ def test_add_endpoint_start_stop(mocker):
     bot.stop()
 
     assert endpoint.stop.called
+
+
+def test_middlewares():
+    """ Middlewares are called in order around the bot's handlers, they can
+        change the message, the reply or answer by themselves.
+    """
+
+    from eddie.bot import command, Middleware
+
+    class MyBot(Bot):
+        "Echo bot"
+
+        def default_response(self, in_message):
+            return in_message
+
+        @command
+        def hello(self):
+            "hello command, call it with '/hello'"
+            return "hello!"
+
+    class Upper(Middleware):
+        "uppers the replies"
+
+        def after(self, bot, in_message, out_message):
+            return out_message.upper()
+
+    class Strip(Middleware):
+        "strips the messages"
+
+        def before(self, bot, in_message):
+            return in_message.strip()
+
+    def no_swearing(bot, in_message, next_handler):
+        "answers by itself to bad words"
+        if 'damn' in in_message:
+            return "language!"
+        return next_handler(in_message)
+
+    bot = MyBot()
+    bot.add_middleware(Upper())
+    bot.add_middleware(Strip())
+    bot.add_middleware(no_swearing)
+
+    assert bot.process("  hello ") == "HELLO"
+    assert bot.process(" /hello") == "HELLO!"
+    assert bot.process("damn it") == "LANGUAGE!"
+
+
+def test_middlewares_compiled_once(mocker):
+    """ The call chain is built when adding an endpoint and running the bot,
+        not for every message.
+    """
+
+    class MyBot(Bot):
+        "Echo bot"
+
+        def default_response(self, in_message):
+            return in_message
+
+    bot = MyBot()
+    calls = []
+    bot.add_middleware(lambda bot, in_message, next_handler: (
+        calls.append(in_message) or next_handler(in_message)
+    ))
+    bot.add_endpoint(mocker.Mock())
+
+    compile_spy = mocker.spy(bot, 'compile')
+    bot.run()
+    bot.process("one")
+    bot.process("two")
+
+    assert compile_spy.call_count == 1
+    assert calls == ["one", "two"]
+
+
+def test_deadlines():
+    """ Handlers not answering within their deadline are replaced by the
+        fallback reply, and counted.
+    """
+
+    from threading import Event
+    from eddie.bot import command
+
+    release = Event()
+
+    class MyBot(Bot):
+        "Bot with slow handlers"
+
+        timeout_response = "too slow"
+
+        def default_response(self, in_message):
+            if in_message == "wait":
+                release.wait(1)
+            return in_message
+
+        @command(timeout=0.05)
+        def slow(self):
+            "slow command with its own deadline"
+            release.wait(1)
+            return "done"
+
+        @command(timeout=5)
+        def patient(self):
+            "command with a longer deadline than the bot"
+            return "patient"
+
+        @command
+        def fail(self):
+            "errors are raised as usual"
+            raise ValueError("failing command")
+
+    bot = MyBot()
+    assert bot.process("/slow") == "too slow"
+    assert bot.process("hello") == "hello"  # no global deadline
+
+    bot.timeout = 0.05
+    assert bot.process("wait") == "too slow"
+    assert bot.process("/patient") == "patient"
+    try:
+        bot.process("/fail")
+        assert False, "the error should be raised"
+    except ValueError:
+        pass
+
+    assert bot.metrics.counters['timeouts'] == 2
+    release.set()
+
+
+def test_deadlines_hung_calls():
+    """ Calls hung past their deadline don't starve the following ones,
+        even outnumbering the threads of the pool.
+    """
+
+    from threading import Event
+    from eddie.bot import command
+
+    release = Event()
+
+    class MyBot(Bot):
+        "Bot with a handler hanging"
+
+        timeout_response = "too slow"
+
+        @command(timeout=0.02)
+        def hang(self):
+            "never answers in time"
+            release.wait(5)
+            return "done"
+
+        @command(timeout=1)
+        def quick(self):
+            "answers right away"
+            return "quick"
+
+    bot = MyBot()
+    try:
+        for _ in range(20):
+            assert bot.process("/hang") == "too slow"
+        assert bot.process("/quick") == "quick"
+        assert bot.metrics.counters['deadline_threads'] >= 4
+    finally:
+        release.set()
@@ -0,0 +1,57 @@
+""" Tests for the reporting part of the benchmark suite, and a smoke run of
+    every benchmark.
+"""
+
+import pytest
+
+from benchmarks.harness import compare, measure, percentile
+from benchmarks.suite import BENCHMARKS
+
+
+def test_percentile():
+    """ Nearest-rank percentiles over sorted samples """
+
+    samples = list(range(101))
+    assert percentile(samples, 0.5) == 50
+    assert percentile(samples, 0.99) == 99
+    assert percentile([], 0.5) == 0.0
+
+
+def test_measure_reports_all_metrics():
+    """ Measuring an operation returns latency, throughput and memory """
+
+    result = measure(lambda: None, iterations=10, warmup=0)
+
+    assert result['iterations'] == 10
+    assert result['p50_ms'] <= result['p99_ms']
+    assert result['throughput'] > 0
+    assert 'peak_memory_kb' in result
+
+
+def test_compare_flags_regressions():
+    """ Only the metrics worse than the baseline beyond the tolerance are
+        reported.
+    """
+
+    baseline = {'bench': {'p50_ms': 1.0, 'p99_ms': 2.0, 'throughput': 100.0}}
+    same = {'bench': {'p50_ms': 1.1, 'p99_ms': 2.1, 'throughput': 95.0}}
+    slower = {'bench': {'p50_ms': 1.5, 'p99_ms': 2.0, 'throughput': 60.0}}
+
+    assert compare(same, baseline, tolerance=0.2) == []
+    regressions = compare(slower, baseline, tolerance=0.2)
+    assert len(regressions) == 2
+    assert all(line.startswith('bench: ') for line in regressions)
+    assert compare(slower, {}, tolerance=0.2) == []
+
+
+@pytest.mark.parametrize('function', BENCHMARKS,
+                         ids=[function.__name__ for function in BENCHMARKS])
+def test_benchmark_runs(function):
+    """ Every registered benchmark runs (with a couple of iterations) and
+        reports its latencies.
+    """
+
+    result = function(2)
+
+    assert result['iterations'] >= 1  # some scale the iterations down
+    assert result['p50_ms'] <= result['p99_ms']
@@ -0,0 +1,211 @@
+""" Tests for eddie.broadcast and Bot.broadcast
+"""
+
+import json
+import threading
+from time import sleep
+
+import pytest
+
+from eddie.bot import Bot
+from eddie.broadcast import Broadcast
+
+
+class FakeEndpoint(object):
+    "Endpoint recording the messages sent, failing for the negative ids"
+
+    def __init__(self, delay=0):
+        self.sent = []
+        self.delay = delay
+        self.running = 0
+        self.max_running = 0
+        self.lock = threading.Lock()
+
+    def set_bot(self, bot):
+        "nothing to register"
+        pass
+
+    def send_message(self, user_id, text):
+        "records the message"
+        with self.lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        sleep(self.delay)
+        with self.lock:
+            self.running -= 1
+        if user_id < 0:
+            raise ValueError('blocked by the user')
+        with self.lock:
+            self.sent.append((user_id, text))
+
+
+class OtherEndpoint(FakeEndpoint):
+    "A second endpoint"
+    pass
+
+
+def test_broadcast():
+    """ Test that the message reaches the audience of every endpoint, with
+        the errors counted.
+    """
+
+    bot = Bot()
+    first, second = FakeEndpoint(delay=0.01), OtherEndpoint()
+    bot.add_endpoint(first)
+    bot.add_endpoint(second)
+    audience = [(first, 1), ('OtherEndpoint', 2), (first, -3),
+                ('MissingEndpoint', 4)] + [(first, i) for i in range(10, 30)]
+
+    report = bot.broadcast('News!', iter(audience), parallelism=4)
+
+    assert sorted(first.sent) == [(i, 'News!') for i in [1] + list(
+        range(10, 30))]
+    assert second.sent == [(2, 'News!')]
+    assert 1 < first.max_running <= 4
+    assert report['delivered'] == 22
+    assert report['failed'] == 2
+    assert report['skipped'] == 0
+    assert report['delivered_per_second'] > 0
+    assert bot.metrics.counters['broadcast_delivered'] == 22
+    assert bot.metrics.counters['broadcast_failed'] == 2
+
+
+def test_broadcast_streams_the_audience():
+    """ Test that the audience is read only as fast as it's sent """
+
+    bot = Bot()
+    endpoint = FakeEndpoint(delay=0.01)
+    bot.add_endpoint(endpoint)
+    read = []
+
+    def audience():
+        "records the recipients read"
+        for user_id in range(50):
+            read.append(user_id)
+            yield user_id
+            # recipients read, but not sent yet: queued or being sent
+            assert len(read) - len(endpoint.sent) <= 3 * 2 + 1
+
+    report = Broadcast(bot, 'News!', audience(), endpoint=endpoint,
+                       parallelism=2).run()
+    assert report['delivered'] == 50
+
+
+def test_broadcast_rate():
+    """ Test that the messages per second are limited """
+
+    bot = Bot()
+    endpoint = FakeEndpoint()
+    bot.add_endpoint(endpoint)
+
+    report = bot.broadcast('News!', range(6), endpoint, rate=20)
+    assert report['delivered'] == 6
+    assert report['seconds'] >= 5 / 20.0
+
+
+def test_broadcast_checkpoint(tmpdir):
+    """ Test that a broadcast interrupted resumes after the recipients
+        done.
+    """
+
+    checkpoint = str(tmpdir.join('broadcast.json'))
+    bot = Bot()
+    endpoint = FakeEndpoint()
+    bot.add_endpoint(endpoint)
+
+    failing = [True]
+
+    def audience():
+        "an audience whose source fails half way the first time"
+        for user_id in range(20):
+            if user_id == 10 and failing[0]:
+                raise IOError('database gone')
+            yield user_id
+
+    with pytest.raises(IOError):
+        bot.broadcast('News!', audience(), endpoint, checkpoint=checkpoint)
+    with open(checkpoint) as state:
+        assert json.load(state)['offset'] == 10
+
+    failing[0] = False
+    report = bot.broadcast('News!', audience(), endpoint,
+                           checkpoint=checkpoint)
+    assert report['skipped'] == 10
+    assert report['delivered'] == 10
+    assert sorted(user for user, _ in endpoint.sent) == list(range(20))
+
+
+def test_broadcast_bulkhead():
+    """ Test that the sends rejected by the bulkhead of the endpoint, with
+        fewer slots than the threads of the broadcast, are tried again
+    """
+
+    from eddie.resilience import Bulkhead
+
+    class GuardedEndpoint(FakeEndpoint):
+        "Endpoint sending through a bulkhead"
+
+        def __init__(self):
+            super(GuardedEndpoint, self).__init__(delay=0.02)
+            self.bulkhead = Bulkhead('fake', max_concurrent=2, max_wait=0.01)
+
+        def send_message(self, user_id, text):
+            "sends holding a slot"
+            self.bulkhead.call(
+                super(GuardedEndpoint, self).send_message, user_id, text)
+
+    bot = Bot()
+    endpoint = GuardedEndpoint()
+    bot.add_endpoint(endpoint)
+
+    report = bot.broadcast('News!', range(20), endpoint=endpoint,
+                           parallelism=8)
+
+    assert report['delivered'] == 20
+    assert report['failed'] == 0
+    assert sorted(user for user, _ in endpoint.sent) == list(range(20))
+    assert endpoint.max_running <= 2
+    assert bot.metrics.counters['broadcast_retried'] > 0
+
+
+def test_broadcast_circuit_open():
+    """ Test that the sends rejected by the open circuit of the endpoint
+        wait for it, instead of failing the rest of the audience
+    """
+
+    from eddie.resilience import OutboundGuard
+
+    class FlakyEndpoint(FakeEndpoint):
+        "Endpoint down for its first calls, behind a circuit breaker"
+
+        def __init__(self, down_calls):
+            super(FlakyEndpoint, self).__init__()
+            self.calls = 0
+            self.down_calls = down_calls
+            self.guard = OutboundGuard('fake', failure_threshold=2,
+                                       reset_timeout=0.05)
+
+        def send_message(self, user_id, text):
+            "fails while down"
+            self.guard.call(self._send, user_id, text)
+
+        def _send(self, user_id, text):
+            "the call to the service"
+            self.calls += 1
+            if self.calls <= self.down_calls:
+                raise IOError('service down')
+            super(FlakyEndpoint, self).send_message(user_id, text)
+
+    bot = Bot()
+    endpoint = FlakyEndpoint(down_calls=3)
+    bot.add_endpoint(endpoint)
+
+    report = bot.broadcast('News!', range(20), endpoint=endpoint,
+                           parallelism=1)
+
+    # two failures open the circuit, the first trial fails too
+    assert report['failed'] == 3
+    assert report['delivered'] == 17
+    assert endpoint.calls == 20
+    assert [user for user, _ in endpoint.sent] == list(range(3, 20))
+    assert bot.metrics.counters['broadcast_retried'] > 0
@@ -0,0 +1,208 @@
+""" Tests for eddie.connection.HttpClient
+"""
+
+import socket
+from threading import Event, Lock, Thread
+from time import sleep
+
+import pytest
+
+try:
+    from http.client import HTTPException
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from httplib import HTTPException
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+
+from eddie.connection import HttpClient, PoolTimeout, default_client
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _Handler(BaseHTTPRequestHandler, object):
+    """ Replies with the client port, after `delay` seconds """
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.running += 1
+            server.max_running = max(server.max_running, server.running)
+        sleep(server.delay)
+        with server.lock:
+            server.running -= 1
+        body = str(self.client_address[1]).encode('ascii')
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        """ Counts the requests, then answers after `post_delay` seconds or
+            closes the connection: without answering if `drop`, right after
+            answering (not announcing it) if `close`.
+        """
+        server = self.server
+        self.rfile.read(int(self.headers['Content-Length']))
+        with server.lock:
+            server.posts += 1
+        if server.drop:
+            self.close_connection = True
+            return
+        sleep(server.post_delay)
+        self.send_response(200)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'ok')
+        self.close_connection = server.close
+
+    def log_message(self, format_, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    """ Fixture: a keep-alive http server on a free port """
+    httpd = _Server(('localhost', 0), _Handler)
+    httpd.lock = Lock()
+    httpd.running = httpd.max_running = 0
+    httpd.delay = 0
+    httpd.posts = 0
+    httpd.post_delay = 0
+    httpd.drop = httpd.close = False
+    httpd.url = 'http://localhost:%d/' % httpd.server_address[1]
+    thread = Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_connections_are_reused(server):
+    """ Consecutive requests to the same host use the same connection """
+
+    client = HttpClient()
+    first = client.request('GET', server.url)
+    second = client.request('GET', server.url + 'other?x=1')
+
+    assert first.status == second.status == 200
+    assert first.body == second.body
+    assert client.stats() == {
+        'http://localhost:%d' % server.server_address[1]:
+            {'in_use': 0, 'idle': 1}
+    }
+
+    client.close()
+
+
+def test_connections_per_host_are_bounded(server):
+    """ No more than `max_per_host` requests run at the same time """
+
+    server.delay = 0.05
+    client = HttpClient(max_per_host=2)
+    threads = [
+        Thread(target=client.request, args=('GET', server.url))
+        for _ in range(6)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert server.max_running == 2
+    assert len(client._pools[('http', server.url[7:-1])].idle) == 2
+
+    client.close()
+
+
+def test_closed_connection_is_replaced(server):
+    """ A kept-alive connection closed meanwhile is replaced transparently """
+
+    client = HttpClient()
+    first = client.request('GET', server.url)
+    client._pools[('http', server.url[7:-1])].idle[0].sock.close()
+    second = client.request('GET', server.url)
+
+    assert second.status == 200
+    assert first.body != second.body
+
+    client.close()
+
+
+def test_default_client_is_shared():
+    """ All the endpoints use the same client by default """
+
+    assert default_client() is default_client()
+
+
+def test_timeout_is_not_retried(server):
+    """ A request timing out on a reused connection is not sent again """
+
+    client = HttpClient(timeout=0.2)
+    assert client.request('POST', server.url, body=b'1').status == 200
+
+    server.post_delay = 0.5
+    with pytest.raises(socket.timeout):
+        client.request('POST', server.url, body=b'2')
+    assert server.posts == 2
+
+    client.close()
+
+
+def test_post_sent_is_not_retried(server):
+    """ A POST which reached the server is not repeated when the reused
+        connection is closed without an answer
+    """
+
+    client = HttpClient()
+    assert client.request('POST', server.url, body=b'1').status == 200
+
+    server.drop = True
+    with pytest.raises((socket.error, HTTPException)):
+        client.request('POST', server.url, body=b'2')
+    assert server.posts == 2
+
+    client.close()
+
+
+def test_dropped_idle_connection_is_discarded(server):
+    """ An idle connection closed by the server isn't used for a POST """
+
+    server.close = True
+    client = HttpClient()
+    assert client.request('POST', server.url, body=b'1').status == 200
+    sleep(0.1)  # the end of the stream arrives
+
+    assert client.request('POST', server.url, body=b'2').status == 200
+    assert server.posts == 2
+
+    client.close()
+
+
+def test_slot_wait_is_bounded():
+    """ Waiting for a connection slot raises after `slot_timeout` """
+
+    client = HttpClient(max_per_host=1, slot_timeout=0.1)
+    taken, release = Event(), Event()
+
+    def hold():
+        with client.slot('localhost'):
+            taken.set()
+            release.wait(5)
+
+    thread = Thread(target=hold)
+    thread.start()
+    taken.wait(5)
+    with pytest.raises(PoolTimeout):
+        with client.slot('localhost'):
+            pass
+    release.set()
+    thread.join()
+    with client.slot('localhost'):  # free again
+        pass
@@ -0,0 +1,102 @@
+""" Tests for eddie.conversation_log
+"""
+
+from __future__ import absolute_import
+import io
+import json
+import sqlite3
+
+import pytest
+
+from eddie.bot import Bot
+from eddie.conversation_log import ConversationLog, JsonlWriter, SqliteWriter
+
+
+class EchoBot(Bot):
+    "Echo bot, failing on 'fail'"
+
+    def default_response(self, in_message):
+        if in_message == 'fail':
+            raise ValueError('failing message')
+        return in_message
+
+
+def _send(log, messages):
+    bot = EchoBot()
+    bot.add_middleware(log)
+    for message in messages:
+        try:
+            bot.process(message)
+        except ValueError:
+            pass
+    log.close()
+
+
+def test_jsonl(tmpdir):
+    """ Test that every message is logged with its reply, in order """
+    filename = str(tmpdir.join('log.jsonl'))
+    log = ConversationLog(JsonlWriter(filename), batch_size=7)
+    messages = ['message %d' % i for i in range(50)] + ['fail']
+    _send(log, messages)
+
+    with io.open(filename, encoding='utf-8') as log_file:
+        events = [json.loads(line) for line in log_file]
+    assert [e['in_message'] for e in events] == messages
+    assert events[0]['out_message'] == 'message 0'
+    assert events[0]['bot'] == 'EchoBot'
+    assert events[0]['latency'] >= 0
+    assert 'failing message' in events[-1]['error']
+    assert log.metrics.counters['written'] == len(messages)
+
+
+def test_jsonl_rotation(tmpdir):
+    """ Test that the files are rotated keeping `backup_count` of them """
+    filename = str(tmpdir.join('log.jsonl'))
+    log = ConversationLog(
+        JsonlWriter(filename, max_bytes=200, backup_count=2), batch_size=1)
+    _send(log, ['message %d' % i for i in range(20)])
+
+    assert sorted(path.basename for path in tmpdir.listdir()) == [
+        'log.jsonl', 'log.jsonl.1', 'log.jsonl.2']
+
+
+def test_sqlite(tmpdir):
+    """ Test the SQLite writer """
+    filename = str(tmpdir.join('log.db'))
+    _send(ConversationLog(SqliteWriter(filename)), ['hello', 'fail'])
+
+    connection = sqlite3.connect(filename)
+    rows = connection.execute(
+        'SELECT in_message, out_message, error FROM events').fetchall()
+    connection.close()
+    assert rows[0] == ('hello', 'hello', None)
+    assert rows[1][0] == 'fail' and 'failing message' in rows[1][2]
+
+
+def test_full_queue_drops(tmpdir):
+    """ Test that events are dropped, not waited for, when the queue is full
+    """
+    class SlowWriter(object):
+        "writer blocking until released"
+        def __init__(self):
+            from threading import Event
+            self.release = Event()
+            self.events = []
+
+        def write(self, events):
+            self.release.wait()
+            self.events.extend(events)
+
+        def close(self):
+            pass
+
+    writer = SlowWriter()
+    log = ConversationLog(writer, batch_size=1, max_queue=2)
+    bot = EchoBot()
+    bot.add_middleware(log)
+    for i in range(10):
+        bot.process('message %d' % i)
+    assert log.metrics.counters['dropped'] >= 1
+    writer.release.set()
+    log.close()
+    assert len(writer.events) + log.metrics.counters['dropped'] == 10
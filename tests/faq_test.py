@@ -0,0 +1,98 @@
+""" Tests for eddie.faq, skipped if numpy is not installed
+"""
+
+import pytest
+
+from eddie.bot import Bot
+
+numpy = pytest.importorskip('numpy')
+
+from eddie.faq import FaqResponder  # noqa: E402
+
+
+ENTRIES = [
+    ('How do I reset my password?', 'password'),
+    ('What are your opening hours?', 'hours'),
+    ('Where is the shop?', 'address'),
+    ('Do you ship abroad?', 'shipping'),
+]
+
+
+def test_answer():
+    """ Test that the most similar question is found """
+    faq = FaqResponder(threshold=0.4)
+    faq.extend(ENTRIES)
+
+    assert faq.answer('opening hours?') == 'hours'
+    assert faq.answer('I forgot my PASSWORD, how can I reset it') == \
+        'password'
+    assert faq.answer('something completely different') is None
+
+    results = faq.search('where is your shop', k=2)
+    assert [answer for _, _, answer in results][0] == 'address'
+    assert results[0][0] >= results[1][0]
+
+
+def test_incremental_updates():
+    """ Test that the entries added after the first search are found, also
+        after merging them in the main index.
+    """
+    faq = FaqResponder(threshold=0.4)
+    assert faq.search('anything') == []
+    faq.extend(ENTRIES)
+    assert faq.answer('ship abroad') == 'shipping'
+
+    faq.extend(('question number %d' % i, i) for i in range(2000))
+    faq.add('Can I pay with a credit card?', 'card')
+    assert faq.answer('question number 1234') == 1234
+    assert faq.answer('pay with credit card') == 'card'
+    assert faq.answer('opening hours?') == 'hours'
+    assert len(faq) == len(ENTRIES) + 2001
+
+
+def test_snapshot(tmpdir):
+    """ Test that a saved index is loaded (memory mapped) and updated """
+    faq = FaqResponder(threshold=0.4)
+    faq.extend(ENTRIES)
+    faq.answer('warm up')
+    faq.add(u'Caff\xe8 o t\xe8?', 'drinks')
+    faq.save(str(tmpdir))
+
+    loaded = FaqResponder.load(str(tmpdir))
+    assert isinstance(loaded._matrix.data, numpy.memmap)
+    assert loaded.answer('opening hours?') == 'hours'
+    assert loaded.answer(u'caff\xe8') == 'drinks'
+
+    loaded.add('Do you have gift cards?', 'gifts')
+    assert loaded.answer('gift cards') == 'gifts'
+
+
+def test_snapshot_ascii(tmpdir):
+    """ Test the round trip of an index of plain `str` entries (bytes on
+        Python 2)
+    """
+    faq = FaqResponder(threshold=0.4)
+    faq.extend(ENTRIES)
+    faq.save(str(tmpdir))
+
+    loaded = FaqResponder.load(str(tmpdir), mmap=False)
+    assert loaded.questions == [question for question, _ in ENTRIES]
+    assert loaded.answer('ship abroad') == 'shipping'
+
+
+def test_middleware():
+    """ Test that the messages matching a question don't reach the bot """
+
+    class MyBot(Bot):
+        "Echo bot"
+
+        def default_response(self, in_message):
+            return in_message
+
+    faq = FaqResponder(threshold=0.4)
+    faq.extend(ENTRIES)
+    bot = MyBot()
+    bot.add_middleware(faq)
+
+    assert bot.process('opening hours?') == 'hours'
+    assert bot.process('hello') == 'hello'
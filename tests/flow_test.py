@@ -0,0 +1,106 @@
+""" Tests for eddie.flow and the flows of eddie.bot.Bot
+"""
+
+import pytest
+
+from eddie.bot import Bot, command
+from eddie.flow import Flow, SessionStore
+from eddie.message import Message
+
+
+class MyBot(Bot):
+    "Echo bot with a command"
+
+    def default_response(self, in_message):
+        return in_message
+
+    @command
+    def start(self):
+        "start command"
+        return 'Welcome!'
+
+
+def signup_flow(names):
+    """ A flow asking a name (not empty) and a confirmation. """
+
+    def save_name(bot, user, in_message):
+        "saves the name, asks again if empty"
+        if not in_message.strip():
+            return 'name'
+        names[user] = in_message
+        return None
+
+    signup = Flow('signup', anywhere={'/cancel': 'cancelled'})
+    signup.state('name', 'Name?', action=save_name, otherwise='confirm')
+    signup.state('confirm', lambda bot, user: 'Are you %s?' % names[user],
+                 transitions={'yes': 'done', 'no': 'name'})
+    signup.state('done', 'Welcome aboard!')
+    signup.state('cancelled', 'Ok, maybe later.')
+    return signup
+
+
+def test_flow():
+    """ Test the transitions, the actions and the end of a flow """
+
+    names = {}
+    bot = MyBot()
+    bot.add_flow(signup_flow(names))
+
+    assert bot.process('/signup', user=1) == 'Name?'
+    assert bot.process(' ', user=1) == 'Name?'
+    assert bot.process('Bob', user=1) == 'Are you Bob?'
+    assert bot.process('maybe', user=1) == 'Are you Bob?'
+    assert bot.process('No', user=1) == 'Name?'
+    assert bot.process('Alice', user=1) == 'Are you Alice?'
+    assert len(bot.sessions) == 1
+    assert bot.process(' YES ', user=1) == 'Welcome aboard!'
+    assert len(bot.sessions) == 0
+
+    # out of the flow: commands and default_response
+    assert bot.process('yes', user=1) == 'yes'
+    assert bot.process('/start', user=1) == 'Welcome!'
+
+
+def test_flow_users():
+    """ Test that every user (on every endpoint) has its own state """
+
+    bot = MyBot()
+    bot.add_flow(signup_flow({}))
+
+    assert bot.process(Message('/signup', user=1, endpoint='a')) == 'Name?'
+    assert bot.process(Message('Bob', user=1, endpoint='a')) == 'Are you Bob?'
+    assert bot.process(Message('Bob', user=1, endpoint='b')) == 'Bob'
+    assert bot.process(Message('Bob', user=2, endpoint='a')) == 'Bob'
+    assert bot.process('Bob') == 'Bob'  # no sender, no flow
+    assert bot.process(Message('/cancel', user=1, endpoint='a')) == \
+        'Ok, maybe later.'
+    assert bot.sessions.get(1, 'a') is None
+
+
+def test_flow_errors():
+    """ Test that the flows are checked when the bot is compiled """
+
+    bot = MyBot()
+    bot.add_flow(Flow('empty'))
+    with pytest.raises(ValueError):
+        bot.compile()
+
+    bot = MyBot()
+    bot.add_flow(Flow('broken').state('first', 'Hi', otherwise='missing'))
+    with pytest.raises(ValueError):
+        bot.compile()
+
+
+def test_session_store():
+    """ Test the states of the users in the session store """
+
+    sessions = SessionStore()
+    sessions.set(1, None, 3)
+    sessions.set(1, 'telegram', 4)
+    assert sessions.get(1) == 3
+    assert sessions.get(1, 'telegram') == 4
+    assert sessions.get(2, 'telegram') is None
+    assert len(sessions) == 2
+    sessions.delete(1, 'telegram')
+    sessions.delete(1, 'twitter')
+    assert len(sessions) == 1
@@ -148,3 +148,166 @@ def test_expose_html_page(create_bot):
     response = requests.get(address)
 
     assert 'html' in response.text.lower()
+
+
+def test_debug_slow(create_bot):
+    """ The traces of the slowest messages are served at /debug/slow, when
+        profiling is enabled.
+    """
+
+    class MyBot(Bot):
+        "Echo bot"
+
+        def default_response(self, in_message):
+            return in_message
+
+    bot = MyBot()
+    endpoint = HttpEndpoint(port=randint(8000, 9000))
+    create_bot(bot, endpoint)
+    address = "http://%s:%d/debug/slow" % (endpoint.host, endpoint.port)
+
+    assert requests.get(address).status_code == 404
+
+    bot.enable_profiling(threshold=0, sample_rate=1)
+    send_to_http_bot(bot, "hello")
+
+    response = requests.get(address)
+    assert response.status_code == 200
+    traces = json.loads(response.text)
+    assert [trace["in_message"] for trace in traces] == ["hello"]
+    assert "default_response" in traces[0]["profile"]
+
+
+def test_health_routes(create_bot):
+    """ /healthz, /readyz and /stats report the status of the endpoints
+        without calling the bot.
+    """
+
+    class MyBot(Bot):
+        "Bot that must not be called"
+
+        def default_response(self, in_message):
+            raise AssertionError("the bot has been called")
+
+    class StoppedEndpoint(object):
+        "endpoint not running"
+
+        def set_bot(self, bot):
+            pass
+
+        def run(self):
+            pass
+
+        def stop(self):
+            pass
+
+        def health(self):
+            return {"alive": False, "queue_depth": 3}
+
+    bot = MyBot()
+    endpoint = HttpEndpoint(port=randint(8000, 9000))
+    create_bot(bot, endpoint)
+    address = "http://%s:%d" % (endpoint.host, endpoint.port)
+
+    response = requests.get(address + "/healthz")
+    assert response.status_code == 200
+    assert json.loads(response.text) == {"status": "ok"}
+
+    response = requests.get(address + "/readyz")
+    assert response.status_code == 200
+    assert json.loads(response.text) == {
+        "ready": True,
+        "endpoints": {"HttpEndpoint": {"alive": True, "queue_depth": 0}},
+    }
+
+    bot.add_endpoint(StoppedEndpoint())
+    response = requests.get(address + "/readyz")
+    assert response.status_code == 503
+    assert json.loads(response.text)["endpoints"]["StoppedEndpoint"] == {
+        "alive": False, "queue_depth": 3}
+
+    stats = json.loads(requests.get(address + "/stats").text)
+    assert stats["uptime"] > 0
+    assert set(stats["endpoints"]) == {"HttpEndpoint", "StoppedEndpoint"}
+    assert "counters" in stats["metrics"]
+
+
+def test_routes(create_bot):
+    """ Commands have their own route, unknown paths get 404 and methods not
+        allowed 405.
+    """
+
+    class MyBot(Bot):
+        "Echo bot, welcoming"
+
+        def default_response(self, in_message):
+            return in_message
+
+        @command
+        def start(self):
+            "Welcome the user as first thing!"
+            return "Welcome!"
+
+    endpoint = HttpEndpoint(port=randint(8000, 9000))
+    create_bot(MyBot(), endpoint)
+    address = "http://%s:%d" % (endpoint.host, endpoint.port)
+
+    response = requests.get(address + "/start")
+    assert json.loads(response.text)["out_message"] == "Welcome!"
+
+    response = requests.post(address + "/process",
+                             data={"in_message": "hello"})
+    assert json.loads(response.text)["out_message"] == "hello"
+
+    assert requests.get(address + "/process").status_code == 400
+    assert requests.get(address + "/unknown?in_message=a").status_code == 404
+
+    response = requests.post(address + "/start")
+    assert response.status_code == 405
+    assert response.headers["Allow"] == "GET"
+
+    response = requests.get(address + "/index.html")
+    assert response.headers["Content-Type"] == "text/html"
+
+
+def test_post_bodies(create_bot):
+    """ Messages can be sent with POST as JSON, form or plain text, bodies
+        over the limit are rejected.
+    """
+
+    class MyBot(Bot):
+        "Echo bot"
+
+        def default_response(self, in_message):
+            return in_message
+
+    endpoint = HttpEndpoint(port=randint(8000, 9000), max_body_size=1024)
+    create_bot(MyBot(), endpoint)
+    address = "http://%s:%d/process" % (endpoint.host, endpoint.port)
+
+    response = requests.post(address, json={"in_message": "json body"})
+    assert json.loads(response.text)["out_message"] == "json body"
+
+    response = requests.post(address, data={"in_message": "form body"})
+    assert json.loads(response.text)["out_message"] == "form body"
+
+    response = requests.post(address, data="text body".encode("UTF-8"),
+                             headers={"Content-Type": "text/plain"})
+    assert json.loads(response.text)["out_message"] == "text body"
+
+    assert requests.post(address, json={"other": 1}).status_code == 400
+    assert requests.post(address, json={"in_message": 1}).status_code == 400
+    assert requests.post(address, data="{",
+                         headers={"Content-Type": "application/json"}
+                         ).status_code == 400
+
+    response = requests.post(address, data={"in_message": "x" * 2000})
+    assert response.status_code == 413
+
+    # rejected as soon as the headers are read, without waiting the body
+    import socket
+    sock = socket.create_connection((endpoint.host, endpoint.port), timeout=2)
+    sock.sendall(b"POST /process HTTP/1.1\r\nHost: localhost\r\n"
+                 b"Content-Length: 1000000000\r\n\r\n")
+    assert sock.recv(1024).startswith(b"HTTP/1.0 413")
+    sock.close()
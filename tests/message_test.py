@@ -0,0 +1,46 @@
+""" Tests for eddie.message and the messages processed by eddie.bot.Bot
+"""
+
+from eddie.bot import Bot, command
+from eddie.message import Message
+
+
+def test_message():
+    """ Test the fields of the message and their defaults """
+
+    message = Message('hi', user=1, endpoint='telegram', timestamp=10.0)
+    assert message == ('hi', 1, 1, 'telegram', 10.0)
+    assert message.chat == 1  # private chat: the user itself
+    assert message.sender == (1, 'telegram')
+    assert not hasattr(message, '__dict__')
+
+    assert Message('hi', user=1, chat=2).chat == 2
+    assert Message('hi').timestamp > 0
+    assert message._replace(text='bye').text == 'bye'
+
+
+def test_bot_process_message():
+    """ Test that the handlers receive the text and the rate limits use the
+        sender of the message.
+    """
+
+    class MyBot(Bot):
+        "Echo bot"
+
+        def default_response(self, in_message):
+            return in_message
+
+        @command
+        def start(self):
+            "start command"
+            return 'Welcome!'
+
+    bot = MyBot()
+    bot.set_rate_limit(1, burst=1)
+
+    assert bot.process(Message('hi', user=1, endpoint='a')) == 'hi'
+    assert bot.process(Message('hi', user=1, endpoint='a')) == \
+        bot.rate_limited_response
+    assert bot.process(Message('/start', user=1, endpoint='b')) == 'Welcome!'
+    assert bot.process(Message('/start', user=2, endpoint='a')) == 'Welcome!'
+    assert bot.process(Message('hi')) == 'hi'
@@ -0,0 +1,19 @@
+""" Tests for eddie.metrics.Metrics
+"""
+
+from eddie.metrics import Metrics
+
+
+def test_counters_and_timings():
+    """ Counters are summed, timings keep only the last samples """
+
+    metrics = Metrics(samples=100)
+    metrics.incr('messages')
+    metrics.incr('messages', 2)
+    for value in range(1000):
+        metrics.observe('latency', value)
+
+    snapshot = metrics.snapshot()
+    assert snapshot['counters'] == {'messages': 3, 'latency': 1000}
+    assert snapshot['timings']['latency'] == {'p50': 950, 'p99': 998}
+    assert metrics.percentile('unknown', 0.5) is None
@@ -0,0 +1,77 @@
+""" Tests for eddie.outbound.Outbox
+"""
+
+from eddie.outbound import Outbox
+
+
+def test_coalesce_messages_to_same_user():
+    """ Messages to the same user within the window are sent together, the
+        other users get their own messages.
+    """
+
+    sent = []
+    outbox = Outbox(lambda user_id, text: sent.append((user_id, text)),
+                    coalesce_window=0.2)
+
+    outbox.deliver(1, "hello")
+    outbox.deliver(2, "hi")
+    outbox.deliver(1, "how are you?")
+    outbox.join()
+
+    assert sorted(sent) == [(1, "hello\nhow are you?"), (2, "hi")]
+    assert outbox.metrics.counters['delivered'] == 2
+    assert outbox.metrics.counters['coalesced'] == 1
+    assert outbox.metrics.percentile('delivery_latency', 0.5) >= 0.2
+
+    outbox.stop()
+
+
+def test_without_window_messages_are_sent_in_order():
+    """ With no window every message is sent, keeping the order per user """
+
+    sent = []
+    outbox = Outbox(lambda user_id, text: sent.append((user_id, text)),
+                    coalesce_window=None)
+
+    for number in range(20):
+        outbox.deliver(number % 2, str(number))
+    outbox.join()
+
+    assert [text for user_id, text in sent if user_id == 0] == \
+        [str(number) for number in range(0, 20, 2)]
+    assert outbox.metrics.counters['delivered'] == 20
+
+    outbox.stop()
+
+
+def test_stop_sends_pending_messages():
+    """ Stopping the outbox doesn't wait for the window to send what's left
+    """
+
+    sent = []
+    outbox = Outbox(lambda user_id, text: sent.append((user_id, text)),
+                    coalesce_window=60)
+
+    outbox.deliver(1, "bye")
+    outbox.stop()
+
+    assert sent == [(1, "bye")]
+
+
+def test_errors_are_counted():
+    """ Failed sends are counted, the next ones are sent anyway """
+
+    def send(user_id, text):
+        "fails for user 1"
+        if user_id == 1:
+            raise IOError("network down")
+
+    outbox = Outbox(send, coalesce_window=None)
+    outbox.deliver(1, "lost")
+    outbox.deliver(2, "delivered")
+    outbox.join()
+
+    assert outbox.metrics.counters == {
+        'delivery_errors': 1, 'delivered': 1, 'delivery_latency': 1}
+
+    outbox.stop()
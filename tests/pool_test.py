@@ -0,0 +1,76 @@
+""" Tests for eddie.pool.WorkerPool
+"""
+
+from threading import current_thread, Event
+from time import sleep
+
+from eddie.pool import WorkerPool
+
+
+def test_executes_in_workers():
+    """ Submitted functions run in the pool's threads, `join` waits for them
+    """
+
+    threads = []
+    pool = WorkerPool(workers=2, name='test-pool')
+    for _ in range(10):
+        pool.submit(lambda: threads.append(current_thread().name))
+    pool.join()
+
+    assert len(threads) == 10
+    assert all(name.startswith('test-pool-') for name in threads)
+
+    pool.stop()
+
+
+def test_keyed_functions_keep_order():
+    """ Functions with the same key run one at a time in submission order,
+        while the other keys are not blocked.
+    """
+
+    release = Event()
+    done = []
+
+    def slow(value):
+        "blocks the first key"
+        release.wait(5)
+        done.append(value)
+
+    pool = WorkerPool(workers=4)
+    pool.submit_keyed('slow', slow, 'slow-1')
+    for value in range(5):
+        pool.submit_keyed('slow', done.append, 'slow-%d' % (value + 2))
+    pool.submit_keyed('fast', done.append, 'fast')
+
+    while 'fast' not in done:
+        sleep(0.01)
+    assert done == ['fast']
+
+    release.set()
+    pool.join()
+    assert done[1:] == ['slow-%d' % value for value in range(1, 7)]
+
+    pool.stop()
+
+
+def test_no_workers_runs_inline():
+    """ With no workers the functions run right away in the calling thread
+    """
+
+    threads = []
+    pool = WorkerPool(workers=0)
+    pool.submit_keyed('key', lambda: threads.append(current_thread()))
+
+    assert threads == [current_thread()]
+
+
+def test_errors_dont_stop_the_workers():
+    """ An exception in a function is logged, the next ones run anyway """
+
+    done = []
+    pool = WorkerPool(workers=1)
+    pool.submit(lambda: 1 / 0)
+    pool.submit(done.append, 'ok')
+    pool.stop()
+
+    assert done == ['ok']
@@ -0,0 +1,52 @@
+""" Tests for eddie.profiling
+"""
+
+from eddie.bot import Bot
+from eddie.profiling import SlowMessageProfiler
+
+
+class SleepyBot(Bot):
+    "Bot answering slowly to messages containing a number"
+
+    def default_response(self, in_message):
+        from time import sleep
+        if in_message.isdigit():
+            sleep(int(in_message) / 1000.0)
+        return in_message
+
+
+def test_keeps_the_slowest():
+    """ Test that only the `keep` slowest messages over the threshold are
+        kept, slowest first.
+    """
+    bot = SleepyBot()
+    profiler = bot.enable_profiling(threshold=0.005, keep=3, sample_rate=0)
+
+    for message in ['1', '30', '10', 'fast', '40', '20', '2']:
+        bot.process(message)
+
+    traces = profiler.traces()
+    assert [trace['in_message'] for trace in traces] == ['40', '30', '20']
+    assert traces[0]['duration'] >= 0.04
+    assert traces[0]['profile'] is None  # not sampled
+
+    profiler.clear()
+    assert profiler.traces() == []
+
+
+def test_sampled_profile():
+    """ Test that the sampled messages are kept with their profile """
+    bot = SleepyBot()
+    bot.add_middleware(lambda bot, in_message, next_handler:
+                       next_handler(in_message))
+    bot.add_middleware(SlowMessageProfiler(threshold=0, sample_rate=1))
+    profiler = bot.enable_profiling(threshold=0.005, sample_rate=1)
+
+    assert bot.middlewares[0] is profiler
+    assert bot.process('10') == '10'
+    assert bot.process('fast') == 'fast'
+
+    traces = profiler.traces()
+    assert len(traces) == 1
+    assert 'default_response' in traces[0]['profile']
+    assert 'sleep' in traces[0]['profile']
@@ -0,0 +1,114 @@
+""" Tests for eddie.ratelimit and the rate limits of eddie.bot.Bot
+"""
+
+from eddie.bot import Bot, command
+from eddie.ratelimit import RateLimiter
+
+
+def test_token_bucket(mocker):
+    """ Test bursts and refill of the buckets """
+    now = [100.0]
+    mocker.patch('eddie.ratelimit.clock', lambda: now[0])
+
+    limiter = RateLimiter(rate=2, burst=3)
+    assert [limiter.allow('a') for _ in range(4)] == [True] * 3 + [False]
+    assert limiter.allow('b')
+
+    now[0] += 0.5  # one token every 0.5 seconds
+    assert limiter.allow('a')
+    assert not limiter.allow('a')
+
+    now[0] += 10  # the bucket doesn't grow beyond the burst
+    assert [limiter.allow('a') for _ in range(4)] == [True] * 3 + [False]
+
+
+def test_full_burst_rounding(mocker):
+    """ Test that a full burst is admitted when the interval isn't exactly
+        representable as a float, at any time
+    """
+    now = [0.0]
+    mocker.patch('eddie.ratelimit.clock', lambda: now[0])
+
+    for start in (0.0, 1234.5678, 987654.321, 12345678.9):
+        now[0] = start
+        limiter = RateLimiter(rate=3, burst=3)
+        assert [limiter.allow('a') for _ in range(4)] == [True] * 3 + [False]
+        now[0] += 1.0 / 3  # one token back
+        assert limiter.allow('a')
+        assert not limiter.allow('a')
+
+
+def test_memory_bound():
+    """ Test that only the most recent `max_keys` keys are kept """
+    limiter = RateLimiter(rate=1, burst=1, max_keys=10)
+    for user in range(100):
+        assert limiter.allow(user)
+    assert len(limiter) == 10
+    assert not limiter.allow(99)
+    assert limiter.allow(0)  # forgotten: full bucket again
+
+
+def test_bot_rate_limits():
+    """ Test that the messages over the limits don't reach the handlers """
+
+    calls = []
+
+    class MyBot(Bot):
+        "Echo bot"
+
+        def default_response(self, in_message):
+            calls.append(in_message)
+            return in_message
+
+        @command
+        def report(self):
+            "expensive command"
+            calls.append('report')
+            return 'report'
+
+    bot = MyBot()
+    bot.set_rate_limit(1, burst=3)
+    bot.set_rate_limit(0.01, burst=1, command='report')
+
+    assert bot.process('/report', user=1) == 'report'
+    assert bot.process('/report', user=1) == bot.rate_limited_response
+    assert bot.process('hi', user=1) == 'hi'
+    assert bot.process('hi', user=1) == 'hi'
+    assert bot.process('hi', user=1) == bot.rate_limited_response
+
+    # other users, endpoints and messages without sender are not limited
+    assert bot.process('/report', user=2) == 'report'
+    assert bot.process('hi', user=1, endpoint='other') == 'hi'
+    assert bot.process('hi') == 'hi'
+
+    assert calls == ['report', 'hi', 'hi', 'report', 'hi', 'hi']
+    assert bot.metrics.counters['rate_limited'] == 2
+
+
+def test_bot_rate_limits_refund(mocker):
+    """ Test that a command rejected by the limit for all the messages
+        doesn't use a token of the command limit
+    """
+    now = [100.0]
+    mocker.patch('eddie.ratelimit.clock', lambda: now[0])
+
+    class MyBot(Bot):
+        "Echo bot"
+
+        def default_response(self, in_message):
+            return in_message
+
+        @command
+        def report(self):
+            "expensive command"
+            return 'report'
+
+    bot = MyBot()
+    bot.set_rate_limit(1, burst=1)
+    bot.set_rate_limit(0.01, burst=1, command='report')
+
+    assert bot.process('hi', user=1) == 'hi'
+    assert bot.process('/report', user=1) == bot.rate_limited_response
+    now[0] += 1  # the limit for all the messages is refilled
+    assert bot.process('/report', user=1) == 'report'
+    assert bot.process('/report', user=1) == bot.rate_limited_response
@@ -0,0 +1,204 @@
+""" Tests for eddie.bot.Bot.reload
+"""
+
+from __future__ import absolute_import
+import json
+import sys
+import threading
+from random import randint
+
+import requests
+from telegram.ext import CommandHandler
+
+from eddie.bot import Bot, command
+from eddie.endpoints import HttpEndpoint, TelegramEndpoint
+
+
+class OldBot(Bot):
+    "Echo bot, version 1"
+
+    def default_response(self, in_message):
+        return in_message
+
+    @command
+    def version(self):
+        "version command"
+        return '1'
+
+
+class NewBot(Bot):
+    "Reverse bot, version 2"
+
+    def default_response(self, in_message):
+        return in_message[::-1]
+
+    @command
+    def version(self):
+        "version command"
+        return '2'
+
+    @command
+    def news(self):
+        "news command"
+        return 'Reloading works'
+
+
+def test_reload_class():
+    """ Test that an instance of the new class takes the place of the bot,
+        keeping its state
+    """
+
+    old_bot = OldBot()
+    old_bot.set_rate_limit(100)
+    old_bot.enable_scheduler()
+    sessions = old_bot.sessions
+    assert old_bot.process('hello') == 'hello'
+
+    bot = old_bot.reload(NewBot)
+    assert isinstance(bot, NewBot)
+    assert type(old_bot) is OldBot
+    assert bot.scheduler.bot is bot
+    assert old_bot.scheduler is None
+    assert bot.process('hello') == 'olleh'
+    assert bot.process('/version') == '2'
+    assert bot.process('/news') == 'Reloading works'
+    assert bot.sessions is sessions
+    assert None in bot._rate_limits
+    assert bot.metrics.counters['reloads'] == 1
+
+
+def test_reload_instance():
+    """ Test that the endpoints move to the new instance """
+
+    class FakeEndpoint(object):
+        "Keeps the bot it's given"
+
+        bot = None
+
+        def set_bot(self, bot):
+            "sets the bot"
+            self.bot = bot
+
+    old_bot = OldBot()
+    endpoint = FakeEndpoint()
+    old_bot.add_endpoint(endpoint)
+    old_bot.enable_scheduler()
+
+    new_bot = NewBot()
+    assert old_bot.reload(new_bot) is new_bot
+    assert new_bot.endpoints == [endpoint]
+    assert old_bot.endpoints == []
+    assert endpoint.bot is new_bot
+    assert new_bot.scheduler.bot is new_bot
+    assert old_bot.scheduler is None
+
+
+def test_reload_module(tmpdir, monkeypatch):
+    """ Test that the module of the bot class is imported again """
+
+    source = tmpdir.join('reloaded_bot.py')
+    template = '\n'.join([
+        'from eddie.bot import Bot, command',
+        'class MyBot(Bot):',
+        '    @command',
+        '    def version(self):',
+        '        return %r',
+        '',
+    ])
+    source.write(template % '1')
+    monkeypatch.syspath_prepend(str(tmpdir))
+    monkeypatch.setattr(sys, 'dont_write_bytecode', True)
+    import reloaded_bot  # pylint: disable=import-error
+
+    try:
+        bot = reloaded_bot.MyBot()
+        assert bot.process('/version') == '1'
+
+        source.write(template % '2')
+        bot = bot.reload()
+        assert bot.process('/version') == '2'
+        assert type(bot) is sys.modules['reloaded_bot'].MyBot
+    finally:
+        del sys.modules['reloaded_bot']
+
+
+def test_reload_in_flight():
+    """ Test that a message being processed finishes on the old code """
+
+    started = threading.Event()
+    release = threading.Event()
+
+    class SlowBot(OldBot):
+        "Echo bot, waiting to answer"
+
+        def default_response(self, in_message):
+            started.set()
+            release.wait(5)
+            return self.tag(in_message)
+
+        def tag(self, in_message):
+            "helper called by the handler"
+            return 'v1:' + in_message
+
+    class NewSlowBot(NewBot):
+        "Reverse bot, with a new helper"
+
+        def tag(self, in_message):
+            "helper called by the handler"
+            return 'NEW:' + in_message
+
+    bot = SlowBot()
+    bot.compile()
+    replies = []
+    thread = threading.Thread(
+        target=lambda: replies.append(bot.process('hello')))
+    thread.start()
+    assert started.wait(5)
+
+    new_bot = bot.reload(NewSlowBot)
+    assert new_bot.process('hello') == 'olleh'
+    release.set()
+    thread.join()
+    assert replies == ['v1:hello']
+
+
+def test_reload_http(create_bot):
+    """ Test that the routes of a running http endpoint are rebuilt """
+
+    endpoint = HttpEndpoint(port=randint(8000, 9000))
+    bot = create_bot(OldBot(), endpoint)
+    address = 'http://%s:%d/' % (endpoint.host, endpoint.port)
+    assert requests.get(address + 'news').status_code == 404
+
+    new_bot = bot.reload(NewBot)
+
+    try:
+        resp = requests.get(address + 'news')
+        assert resp.status_code == 200
+        assert json.loads(resp.text)['out_message'] == 'Reloading works'
+        resp = requests.get(address + 'process',
+                            params={'in_message': 'hello'})
+        assert json.loads(resp.text)['out_message'] == 'olleh'
+    finally:
+        new_bot.stop()  # the endpoints moved to the new bot
+
+
+def test_reload_telegram():
+    """ Test that the command handlers of the dispatcher are replaced, not
+        added
+    """
+
+    endpoint = TelegramEndpoint(token='123:ABC')
+    bot = OldBot()
+    bot.add_endpoint(endpoint)
+    dispatcher = endpoint._telegram.dispatcher
+    group = len(dispatcher.handlers[0])
+
+    bot.reload(NewBot)
+
+    assert list(dispatcher.handlers) == [0]
+    assert len(dispatcher.handlers[0]) == group + 1
+    assert sorted(handler.command[0] for handler in dispatcher.handlers[0]
+                  if isinstance(handler, CommandHandler)) == \
+        ['news', 'version']
+    endpoint.stop()
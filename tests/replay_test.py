@@ -0,0 +1,87 @@
+""" Tests for eddie.replay
+"""
+
+from __future__ import absolute_import
+import io
+import json
+
+import pytest
+
+from eddie.bot import Bot, command
+from eddie.replay import main, read_messages, resume_offset
+
+
+class ReplayBot(Bot):
+    "Reverse bot, loaded by the replay tool"
+
+    def default_response(self, in_message):
+        if in_message == 'fail':
+            raise ValueError('failing message')
+        return in_message[::-1]
+
+    @command
+    def start(self):
+        "start command"
+        return 'welcome'
+
+
+def _write(path, text):
+    with io.open(str(path), 'w', encoding='utf-8') as log_file:
+        log_file.write(text)
+
+
+def _read_output(path):
+    with io.open(str(path), encoding='utf-8') as output_file:
+        return [json.loads(line) for line in output_file]
+
+
+@pytest.mark.parametrize('processes', [0, 2])
+def test_replay_jsonl(tmpdir, processes):
+    """ Test that every message is processed, in order """
+    log = tmpdir.join('log.jsonl')
+    output = tmpdir.join('out.jsonl')
+    messages = ['message %d' % i for i in range(100)] + ['/start', 'fail']
+    _write(log, u''.join(
+        json.dumps({'in_message': message}) + u'\n' for message in messages))
+
+    assert main([__name__ + ':ReplayBot', str(log), '-o', str(output),
+                 '-p', str(processes), '--batch-size', '7', '-q']) == 0
+
+    results = _read_output(output)
+    assert [r['offset'] for r in results] == list(range(len(messages)))
+    assert [r['in_message'] for r in results] == messages
+    assert results[0]['out_message'] == '0 egassem'
+    assert results[-2]['out_message'] == 'welcome'
+    assert 'failing message' in results[-1]['error']
+
+
+def test_replay_csv_resume(tmpdir):
+    """ Test the CSV input and resuming an interrupted replay """
+    log = tmpdir.join('log.csv')
+    output = tmpdir.join('out.jsonl')
+    _write(log, u'user,in_message\n1,abc\n2,"d,e"\n3,f\n')
+    _write(output, u'{"offset": 0, "in_message": "abc", "out_message": "?"}\n')
+
+    assert list(read_messages(str(log), 'csv')) == ['abc', 'd,e', 'f']
+
+    main([__name__ + ':ReplayBot', str(log), '-o', str(output), '-p', '0',
+          '--resume', '-q'])
+
+    results = _read_output(output)
+    assert [r['out_message'] for r in results] == ['?', 'e,d', 'f']
+
+
+def test_replay_resume_cut_line(tmpdir):
+    """ Test resuming a replay interrupted in the middle of a line """
+    log = tmpdir.join('log.csv')
+    output = tmpdir.join('out.jsonl')
+    _write(log, u'user,in_message\n1,abc\n2,de\n3,f\n')
+    _write(output, u'{"offset": 0, "in_message": "abc", "out_message": "?"}\n'
+                   u'{"offset": 1, "in_mess')
+
+    assert resume_offset(str(output)) == 1
+    main([__name__ + ':ReplayBot', str(log), '-o', str(output), '-p', '0',
+          '--resume', '-q'])
+
+    results = _read_output(output)
+    assert [r['out_message'] for r in results] == ['?', 'ed', 'f']
@@ -0,0 +1,160 @@
+""" Tests for eddie.resilience and the guarded calls of the endpoints
+"""
+
+from threading import Event, Thread
+from time import sleep, time
+
+import pytest
+import tweepy
+
+from eddie.endpoints import TwitterEndpoint
+from eddie.resilience import (
+    Bulkhead, BulkheadFullError, CircuitBreaker, CircuitOpenError,
+    OutboundGuard
+)
+
+
+class Service(object):
+    "A service failing while `down`"
+
+    def __init__(self):
+        self.down = False
+        self.calls = 0
+
+    def __call__(self, value):
+        self.calls += 1
+        if self.down:
+            raise IOError('service down')
+        return value
+
+
+def test_circuit_breaker():
+    """ Test that the circuit opens after the failures, rejects the calls,
+        then closes after a successful trial
+    """
+    service = Service()
+    breaker = CircuitBreaker('service', failure_threshold=3,
+                             reset_timeout=0.1)
+    assert breaker.call(service, 1) == 1
+
+    service.down = True
+    for _ in range(3):
+        with pytest.raises(IOError):
+            breaker.call(service, 1)
+    assert breaker.state == 'open'
+    with pytest.raises(CircuitOpenError) as error:
+        breaker.call(service, 1)
+    assert 0 < error.value.retry_after <= 0.1
+    assert service.calls == 4
+
+    sleep(0.15)
+    with pytest.raises(IOError):
+        breaker.call(service, 1)  # the trial fails: open again
+    assert breaker.state == 'open'
+    assert service.calls == 5
+
+    sleep(0.15)
+    service.down = False
+    assert breaker.call(service, 2) == 2
+    assert breaker.state == 'closed'
+    assert breaker.metrics.counters == {
+        'circuit_open': 2, 'circuit_half_open': 2, 'circuit_closed': 1,
+        'circuit_rejected': 1}
+
+
+def test_circuit_breaker_errors():
+    """ Test that the errors of a single call don't open the circuit, and
+        that a success resets the failures
+    """
+    breaker = CircuitBreaker('service', failure_threshold=2,
+                             is_failure=lambda error: error.args[0] != 404)
+
+    def fail(code):
+        raise IOError(code)
+
+    for _ in range(5):
+        with pytest.raises(IOError):
+            breaker.call(fail, 404)
+    assert breaker.state == 'closed'
+
+    with pytest.raises(IOError):
+        breaker.call(fail, 500)
+    breaker.call(lambda: None)
+    with pytest.raises(IOError):
+        breaker.call(fail, 500)
+    assert breaker.state == 'closed'
+    with pytest.raises(IOError):
+        breaker.call(fail, 500)
+    assert breaker.state == 'open'
+
+
+def test_bulkhead():
+    """ Test that the calls over the limit wait, then are rejected """
+    bulkhead = Bulkhead('service', max_concurrent=2, max_wait=0.1)
+    release = Event()
+    threads = [Thread(target=bulkhead.call, args=(release.wait, 5))
+               for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    while bulkhead.in_use < 2:
+        sleep(0.01)
+
+    start = time()
+    with pytest.raises(BulkheadFullError):
+        bulkhead.call(lambda: None)
+    assert 0.1 <= time() - start < 1
+
+    waiting = Thread(target=bulkhead.call, args=(lambda: None,))
+    waiting.start()
+    release.set()
+    for thread in threads + [waiting]:
+        thread.join()
+    assert bulkhead.in_use == 0
+    assert bulkhead.metrics.counters == {'bulkhead_rejected': 1}
+
+
+def test_outbound_guard():
+    """ Test that a call rejected by the bulkhead doesn't count as a
+        failure of the service
+    """
+    guard = OutboundGuard('service', max_concurrent=1, max_wait=0,
+                          failure_threshold=1)
+    release = Event()
+    thread = Thread(target=guard.call, args=(release.wait, 5))
+    thread.start()
+    while guard.bulkhead.in_use < 1:
+        sleep(0.01)
+
+    with pytest.raises(BulkheadFullError):
+        guard.call(lambda: None)
+    assert guard.breaker.state == 'closed'
+    release.set()
+    thread.join()
+
+
+def test_twitter_circuit(mocker):
+    """ Test that the calls to a Twitter in trouble are rejected without
+        waiting, and the errors of the single call don't count
+    """
+    mocker.patch('tweepy.OAuthHandler')
+    mock_api = mocker.patch('tweepy.API')
+    endpoint = TwitterEndpoint('key', 'secret', 'token', 'token_secret',
+                               failure_threshold=2)
+    send = mock_api().send_direct_message
+
+    forbidden = mocker.Mock(status_code=403)
+    send.side_effect = tweepy.TweepError('Not following', forbidden)
+    for _ in range(3):
+        with pytest.raises(tweepy.TweepError):
+            endpoint.send_message(1, 'Hi')
+    assert endpoint.health()['circuit'] == 'closed'
+
+    send.side_effect = tweepy.TweepError('Read timed out')
+    for _ in range(2):
+        with pytest.raises(tweepy.TweepError):
+            endpoint.send_message(1, 'Hi')
+    with pytest.raises(CircuitOpenError):
+        endpoint.send_message(1, 'Hi')
+    assert send.call_count == 5
+    assert endpoint.health()['circuit'] == 'open'
+    assert endpoint.metrics.counters['circuit_open'] == 1
@@ -0,0 +1,145 @@
+""" Not-so-unit tests for eddie.endpoints.RouterEndpoint
+"""
+
+from __future__ import absolute_import
+import json
+import requests
+import pytest
+
+from eddie.bot import Bot, command
+from eddie.endpoints import RouterEndpoint
+
+
+class EchoBot(Bot):
+    "Echo bot with a prefix"
+
+    def __init__(self, prefix):
+        super(EchoBot, self).__init__()
+        self.prefix = prefix
+
+    def default_response(self, in_message):
+        return self.prefix + in_message
+
+    @command
+    def start(self):
+        "start command"
+        return self.prefix + 'welcome'
+
+
+@pytest.fixture
+def router():
+    """ Fixture: a running router on a free port """
+    router = RouterEndpoint(port=0, workers=2)
+    router.run()
+    yield router
+    router.stop()
+
+
+def _url(router, path):
+    return 'http://%s:%d%s' % (router.host, router.port, path)
+
+
+def test_routes_by_path(router):
+    """ Test that every bot answers on its own path """
+    router.add_bot('one', EchoBot('1:'))
+    router.add_bot('two', EchoBot('2:'))
+
+    for name, prefix in (('one', '1:'), ('two', '2:')):
+        resp = requests.get(_url(router, '/%s/process' % name),
+                            params={'in_message': 'hello'})
+        assert resp.status_code == 200
+        assert json.loads(resp.text)['out_message'] == prefix + 'hello'
+
+    resp = requests.get(_url(router, '/two/process'),
+                        params={'in_message': '/start'})
+    assert json.loads(resp.text)['out_message'] == '2:welcome'
+
+    # the same routes as HttpEndpoint
+    resp = requests.post(_url(router, '/one/process'),
+                         json={'in_message': 'hello'})
+    assert json.loads(resp.text)['out_message'] == '1:hello'
+    resp = requests.get(_url(router, '/two/start'))
+    assert json.loads(resp.text)['out_message'] == '2:welcome'
+    assert requests.get(_url(router, '/two/healthz')).status_code == 200
+    assert requests.get(_url(router, '/two/process')).status_code == 400
+    assert requests.post(_url(router, '/two/process'),
+                         json={'other': 'hello'}).status_code == 400
+    assert requests.post(_url(router, '/two/healthz')).status_code == 405
+
+    assert requests.get(_url(router, '/two/')).status_code == 200
+    assert requests.get(_url(router, '/three/process')).status_code == 404
+    assert requests.get(_url(router, '/two/other')).status_code == 404
+
+    router.remove_bot('two')
+    assert requests.get(_url(router, '/two/process')).status_code == 404
+
+
+def test_telegram_webhook(router):
+    """ Test that the webhook updates are answered in the response """
+    router.add_telegram_bot('123:ABC', EchoBot('tg:'))
+
+    update = {
+        'update_id': 1,
+        'message': {'message_id': 1, 'chat': {'id': 42}, 'text': 'hi'},
+    }
+    resp = requests.post(_url(router, '/telegram/123:ABC'), json=update)
+    assert resp.status_code == 200
+    assert json.loads(resp.text) == {
+        'method': 'sendMessage', 'chat_id': 42, 'text': 'tg:hi'
+    }
+
+    # updates without text are acknowledged with an empty response
+    resp = requests.post(_url(router, '/telegram/123:ABC'),
+                         json={'update_id': 2})
+    assert resp.status_code == 200
+    assert resp.text == ''
+
+    resp = requests.post(_url(router, '/telegram/456:DEF'), json=update)
+    assert resp.status_code == 404
+    resp = requests.get(_url(router, '/telegram/123:ABC'))
+    assert resp.status_code == 405
+
+
+def test_telegram_webhook_invalid(router):
+    """ Test that the bodies that aren't Telegram updates are rejected """
+    router.add_telegram_bot('123:ABC', EchoBot('tg:'))
+
+    for body in ([1, 2], 'hi', {'message': 'hi'},
+                 {'message': {'text': 'hi'}},
+                 {'message': {'text': 'hi', 'chat': 42}},
+                 {'message': {'text': 42, 'chat': {'id': 42}}},
+                 {'message': {'text': 'hi', 'chat': {'id': 42},
+                              'from': 'me'}}):
+        resp = requests.post(_url(router, '/telegram/123:ABC'), json=body)
+        assert resp.status_code == 400, body
+    resp = requests.post(_url(router, '/telegram/123:ABC'), data=b'{',
+                         headers={'Content-Type': 'application/json'})
+    assert resp.status_code == 400
+
+    # the server is still answering
+    resp = requests.post(_url(router, '/telegram/123:ABC'), json={
+        'update_id': 1,
+        'message': {'message_id': 1, 'chat': {'id': 42}, 'text': 'hi'},
+    })
+    assert json.loads(resp.text)['text'] == 'tg:hi'
+
+
+def test_telegram_webhook_body_size():
+    """ Test that the webhook bodies over `max_body_size` are rejected """
+    router = RouterEndpoint(port=0, workers=2, max_body_size=100)
+    router.add_telegram_bot('123:ABC', EchoBot('tg:'))
+    router.run()
+    try:
+        update = {
+            'update_id': 1,
+            'message': {'message_id': 1, 'chat': {'id': 42},
+                        'text': 'x' * 200},
+        }
+        resp = requests.post(_url(router, '/telegram/123:ABC'), json=update)
+        assert resp.status_code == 413
+
+        update['message']['text'] = 'hi'
+        resp = requests.post(_url(router, '/telegram/123:ABC'), json=update)
+        assert resp.status_code == 200
+    finally:
+        router.stop()
@@ -0,0 +1,161 @@
+""" Tests for eddie.scheduler and the scheduler of eddie.bot.Bot
+"""
+
+import os
+import threading
+
+from eddie.bot import Bot, command
+from eddie.scheduler import Scheduler
+
+
+class FakeEndpoint(object):
+    "Endpoint recording the messages sent"
+
+    def __init__(self):
+        self.sent = []
+        self.event = threading.Event()
+
+    def set_bot(self, bot):
+        "nothing to register"
+        pass
+
+    def run(self):
+        "nothing to start"
+        pass
+
+    def stop(self):
+        "nothing to stop"
+        pass
+
+    def send_message(self, user_id, text):
+        "records the message"
+        self.sent.append((user_id, text))
+        self.event.set()
+
+
+class MyBot(Bot):
+    "Bot with a digest command"
+
+    @command
+    def digest(self):
+        "digest command"
+        return 'Your digest'
+
+
+def test_scheduler():
+    """ Test that the timers fire in order, once or periodically, and can be
+        cancelled.
+    """
+
+    bot = MyBot()
+    endpoint = FakeEndpoint()
+    bot.add_endpoint(endpoint)
+    scheduler = Scheduler(bot, workers=0)
+
+    scheduler.schedule(endpoint, 1, 'second', at=20)
+    scheduler.schedule(endpoint, 1, 'first', at=10)
+    scheduler.schedule('FakeEndpoint', 2, '/digest', at=10, every=100,
+                       process=True)
+    cancelled = scheduler.schedule(endpoint, 3, 'cancelled', at=10)
+    assert scheduler.cancel(cancelled)
+    assert not scheduler.cancel(cancelled)
+    assert len(scheduler) == 3
+
+    assert scheduler.run_pending(now=5) == 0
+    assert scheduler.run_pending(now=15) == 2
+    assert scheduler.run_pending(now=20) == 1
+    assert scheduler.run_pending(now=30) == 0
+    # the occurrences missed fire once
+    assert scheduler.run_pending(now=400) == 1
+    assert endpoint.sent == [(1, 'first'), (2, 'Your digest'),
+                             (1, 'second'), (2, 'Your digest')]
+    assert len(scheduler) == 1  # the periodic timer, due at 410
+    assert scheduler.run_pending(now=409) == 0
+
+    scheduler.schedule('MissingEndpoint', 1, 'lost', at=0)
+    scheduler.run_pending(now=1)
+    assert scheduler.metrics.counters['scheduled_sent'] == 4
+    assert scheduler.metrics.counters['scheduled_errors'] == 1
+
+
+def test_scheduler_batches():
+    """ Test that at most `batch_size` timers fire at once """
+
+    bot = MyBot()
+    endpoint = FakeEndpoint()
+    bot.add_endpoint(endpoint)
+    scheduler = Scheduler(bot, batch_size=10, workers=0)
+    for index in range(25):
+        scheduler.schedule(endpoint, index, 'hi', at=index)
+
+    assert [scheduler.run_pending(now=100) for _ in range(4)] == \
+        [10, 10, 5, 0]
+    assert [user for user, _ in endpoint.sent] == list(range(25))
+
+
+def test_scheduler_persistence(tmpdir):
+    """ Test that the pending timers survive a restart """
+
+    filename = str(tmpdir.join('timers.jsonl'))
+    bot = MyBot()
+    endpoint = FakeEndpoint()
+    bot.add_endpoint(endpoint)
+    scheduler = Scheduler(bot, filename, workers=0)
+    scheduler.schedule(endpoint, 1, 'fired', at=10)
+    scheduler.schedule(endpoint, 2, 'cancelled', at=10)
+    scheduler.schedule(endpoint, 3, 'pending', at=30)
+    scheduler.schedule(endpoint, 4, 'periodic', at=10, every=100)
+    scheduler.cancel(2)
+    scheduler.run_pending(now=20)
+    scheduler.stop()
+    with open(filename) as journal:
+        assert len(journal.readlines()) == 2  # compacted
+
+    restarted = Scheduler(bot, filename, workers=0)
+    assert len(restarted) == 2
+    assert restarted.run_pending(now=110) == 2
+    assert endpoint.sent[-2:] == [(3, 'pending'), (4, 'periodic')]
+    timer_id = restarted.schedule(endpoint, 5, 'new', at=200)
+    assert timer_id == 5
+    restarted.stop()
+    assert not os.path.exists(filename + '.tmp')
+
+
+def test_bot_scheduler(tmpdir):
+    """ Test that the scheduler runs with the bot """
+
+    bot = MyBot()
+    endpoint = FakeEndpoint()
+    bot.add_endpoint(endpoint)
+    scheduler = bot.enable_scheduler(str(tmpdir.join('timers.jsonl')))
+    scheduler.schedule(endpoint, 1, 'later', delay=60)
+    scheduler.schedule(endpoint, 1, 'now')
+    bot.run()
+    try:
+        assert endpoint.event.wait(5)
+        assert endpoint.sent == [(1, 'now')]
+    finally:
+        bot.stop()
+    assert len(scheduler) == 1
+
+
+def test_scheduler_journal_compaction(tmpdir):
+    """ Test that the firings of a periodic timer don't grow the file
+        without bound
+    """
+
+    filename = str(tmpdir.join('timers.jsonl'))
+    bot = MyBot()
+    endpoint = FakeEndpoint()
+    bot.add_endpoint(endpoint)
+    scheduler = Scheduler(bot, filename, workers=0)
+    scheduler.schedule(endpoint, 1, 'tick', at=0, every=1)
+    for now in range(3000):
+        assert scheduler.run_pending(now=now) == 1
+    with open(filename) as journal:
+        assert len(journal.readlines()) <= 2 * 1 + 1024 + 1
+
+    restarted = Scheduler(bot, filename, workers=0)
+    assert len(restarted) == 1
+    assert restarted.run_pending(now=2999) == 0
+    assert restarted.run_pending(now=3000) == 1
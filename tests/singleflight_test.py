@@ -0,0 +1,127 @@
+""" Tests for eddie.singleflight and the cacheable handlers of eddie.bot.Bot
+"""
+
+from threading import Event, Thread
+from time import sleep
+
+
+from eddie.bot import Bot, cacheable, command
+from eddie.singleflight import SingleFlight
+
+
+def _wait_waiters(flight, key, count):
+    for _ in range(200):
+        if flight.waiters(key) == count:
+            return
+        sleep(0.01)
+    assert False, "waiters didn't arrive"
+
+
+def test_single_flight():
+    """ Test that concurrent calls with the same key run once, and the
+        calls after it ends run again.
+    """
+    flight = SingleFlight()
+    release = Event()
+    calls = []
+
+    def slow(value):
+        calls.append(value)
+        release.wait(2)
+        return value * 2
+
+    results = []
+    threads = [Thread(target=lambda: results.append(flight.do('k', slow, 21)))
+               for _ in range(5)]
+    threads[0].start()
+    while not calls:
+        sleep(0.01)
+    for thread in threads[1:]:
+        thread.start()
+    _wait_waiters(flight, 'k', 4)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert results == [42] * 5
+    assert calls == [21]
+    assert flight.do('k', slow, 1) == 2  # nothing is cached
+    assert flight.metrics.counters == {
+        'single_flight_executions': 2, 'single_flight_saved': 4}
+
+
+def test_single_flight_error():
+    """ Test that the exception is raised to all the callers """
+    flight = SingleFlight()
+    release = Event()
+    errors = []
+
+    def failing():
+        release.wait(2)
+        raise ValueError('failing')
+
+    def call():
+        try:
+            flight.do('k', failing)
+        except ValueError as error:
+            errors.append(error)
+
+    threads = [Thread(target=call) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    _wait_waiters(flight, 'k', 2)
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert len(errors) == 3
+
+
+def test_cacheable_handlers():
+    """ Test that only the cacheable handlers share their executions """
+    release = Event()
+    calls = []
+
+    class MyBot(Bot):
+        "Bot with slow handlers"
+
+        @cacheable
+        def default_response(self, in_message):
+            calls.append(in_message)
+            release.wait(2)
+            return in_message
+
+        @command
+        @cacheable
+        def start(self):
+            "cacheable command"
+            calls.append('/start')
+            release.wait(2)
+            return 'welcome'
+
+        @command
+        def other(self):
+            "not cacheable"
+            calls.append('/other')
+            release.wait(2)
+            return 'other'
+
+    bot = MyBot()
+    messages = ['/start'] * 3 + ['/other'] * 2 + ['hi'] * 3 + ['hello']
+    replies = {}
+    threads = [
+        Thread(target=lambda m=m, i=i: replies.__setitem__(i, bot.process(m)))
+        for i, m in enumerate(messages)
+    ]
+    for thread in threads:
+        thread.start()
+    _wait_waiters(bot._single_flight, ('command', 'start'), 2)
+    _wait_waiters(bot._single_flight, ('default', 'hi'), 2)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert [replies[i] for i in range(len(messages))] == \
+        ['welcome'] * 3 + ['other'] * 2 + ['hi'] * 3 + ['hello']
+    assert sorted(calls) == sorted(['/start', '/other', '/other', 'hi',
+                                    'hello'])
+    assert bot.metrics.counters['single_flight_saved'] == 4
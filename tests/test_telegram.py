@@ -1,11 +1,16 @@
 """ Unit tests for eddie.endpoints.TelegramEndpoint
 """
 
+import json
+import threading
+
 import telegram
 
 from eddie.bot import Bot, command
 from eddie.endpoints import TelegramEndpoint
 
+from .conftest import wait_for
+
 
 def create_telegram_update(message_text):
     """ Helper function: create an "Update" to simulate a message sent to the
@@ -30,7 +35,7 @@ def test_telegram_interface(mocker):
     """ Test that the Telegram API is called when using the endpoint.
     """
 
-    mock_updater = mocker.patch('eddie.endpoints.telegram.Updater')
+    mock_updater = mocker.patch('eddie.endpoints.telegram._Updater')
 
     class MyBot(Bot):
         "Lowering bot"
@@ -46,7 +51,8 @@ def test_telegram_interface(mocker):
     bot.add_endpoint(endpoint)
     bot.run()
 
-    mock_updater.assert_called_once_with('123:ABC')
+    mock_updater.assert_called_once()
+    assert mock_updater.call_args[1]['bot'].token == '123:ABC'
     assert mock_updater().start_polling.called
 
     bot.stop()
@@ -56,7 +62,7 @@ def test_telegram_default_response(mocker):
     """ Test that the Telegram bot correctly reply with the default response.
     """
 
-    mocker.patch('eddie.endpoints.telegram.Updater')
+    mocker.patch('eddie.endpoints.telegram._Updater')
     mock_messagehandler = mocker.patch(
         'eddie.endpoints.telegram.MessageHandler')
     reply_text_m = mocker.patch('telegram.Message.reply_text')
@@ -81,6 +87,7 @@ def test_telegram_default_response(mocker):
 
     message = 'this is the message'
     generic_handler(bot, create_telegram_update(message))
+    endpoint._workers.join()  # replies are sent by the workers
     reply_text_m.assert_called_with(
         bot.default_response(message))
 
@@ -92,7 +99,7 @@ def test_telegram_command(mocker):
         and that the Telegram bot uses them to reply to messages.
     """
 
-    mocker.patch('eddie.endpoints.telegram.Updater')
+    mocker.patch('eddie.endpoints.telegram._Updater')
     mock_commandhandler = mocker.patch(
         'eddie.endpoints.telegram.CommandHandler')
     reply_text_m = mocker.patch('telegram.Message.reply_text')
@@ -128,9 +135,247 @@ def test_telegram_command(mocker):
     assert 'other' in commands_added
 
     commands_added['start'](bot, create_telegram_update('/start'))
+    endpoint._workers.join()  # replies are sent by the workers
     reply_text_m.assert_called_with(bot.start())
 
     commands_added['other'](bot, create_telegram_update('/other'))
+    endpoint._workers.join()
     reply_text_m.assert_called_with(bot.other())
 
     bot.stop()
+
+
+def test_telegram_custom_base_url(mocker):
+    """ The endpoint can connect to a different Bot API server, i.e. a local
+        one used for testing.
+    """
+
+    mock_updater = mocker.patch('eddie.endpoints.telegram._Updater')
+
+    TelegramEndpoint(token='123:ABC', base_url='http://localhost:8081/bot')
+
+    telegram_bot = mock_updater.call_args[1]['bot']
+    assert telegram_bot.base_url == 'http://localhost:8081/bot123:ABC'
+
+
+def test_telegram_long_poll_connection(mocker):
+    """ Test that the long polls don't take the connections of the shared
+        client, the other calls do
+    """
+    from eddie.connection import HttpClient, Response
+    from eddie.endpoints.telegram import _PooledRequest
+
+    shared = HttpClient(max_per_host=1)
+    request = _PooledRequest(shared)
+    ok = Response(200, {}, b'{"ok": true, "result": []}')
+    mocker.patch.object(shared, 'request', return_value=ok)
+    mocker.patch.object(request._poll_client, 'request', return_value=ok)
+
+    request.post('https://api.telegram.org/bot123:ABC/getUpdates', {})
+    assert request._poll_client.request.call_count == 1
+    assert shared.request.call_count == 0
+
+    request.post('https://api.telegram.org/bot123:ABC/sendMessage', {})
+    assert request._poll_client.request.call_count == 1
+    assert shared.request.call_count == 1
+
+
+def test_telegram_health():
+    """ Test that the health reports whether the polling is running and the
+        updates waiting.
+    """
+    endpoint = TelegramEndpoint(token='123:ABC')
+    assert endpoint.health() == {'alive': False, 'queue_depth': 0,
+                                 'circuit': 'closed'}
+
+    endpoint._telegram.update_queue.put(create_telegram_update('hello'))
+    assert endpoint.health()['queue_depth'] == 1
+
+
+def create_chat_update(update_id, chat_id, text):
+    """ Helper function: create an "Update" with the given id, in the chat
+        `chat_id`.
+    """
+    from datetime import datetime
+    return telegram.Update(
+        update_id=update_id,
+        message=telegram.Message(
+            message_id=update_id,
+            from_user=telegram.User(chat_id, 'user%d' % chat_id),
+            date=datetime.now(),
+            chat=telegram.Chat(chat_id, 'private'),
+            text=text
+        )
+    )
+
+
+def dispatch(endpoint, update):
+    """ Helper function: the update fetched by the polling, then dispatched.
+    """
+    endpoint._offsets.fetched([update])
+    endpoint._telegram.dispatcher.process_update(update)
+
+
+def test_telegram_chat_order(mocker):
+    """ Test that the messages of a chat are answered in order, while the
+        other chats don't wait for them.
+    """
+    replies = []
+    mocker.patch('telegram.Message.reply_text', autospec=True,
+                 side_effect=lambda message, text: replies.append(
+                     (message.chat_id, text)))
+    release = threading.Event()
+
+    class MyBot(Bot):
+        "Echo bot, slow in chat 1"
+
+        def default_response(self, in_message):
+            if in_message.startswith('slow'):
+                release.wait(5)
+            return in_message
+
+    endpoint = TelegramEndpoint(token='123:ABC', workers=4)
+    MyBot().add_endpoint(endpoint)
+    try:
+        dispatch(endpoint, create_chat_update(1, 1, 'slow 1'))
+        dispatch(endpoint, create_chat_update(2, 1, 'slow 2'))
+        dispatch(endpoint, create_chat_update(3, 2, 'fast'))
+        wait_for(lambda: replies == [(2, 'fast')])
+        # the first update is still being processed
+        assert endpoint._offsets.offset == 0
+
+        release.set()
+        endpoint._workers.join()
+        assert replies == [(2, 'fast'), (1, 'slow 1'), (1, 'slow 2')]
+        assert endpoint._offsets.offset == 4
+    finally:
+        release.set()
+        endpoint._workers.stop()
+
+
+def test_telegram_offset_file(mocker, tmpdir):
+    """ Test that the offsets and the updates not processed are persisted
+        and used by a new endpoint.
+    """
+    mocker.patch('telegram.Message.reply_text')
+    offset_file = str(tmpdir.join('offset'))
+
+    class MyBot(Bot):
+        "Echo bot"
+
+        def default_response(self, in_message):
+            return in_message
+
+    endpoint = TelegramEndpoint(token='123:ABC', offset_file=offset_file)
+    bot = MyBot()
+    bot.add_endpoint(endpoint)
+    dispatch(endpoint, create_chat_update(10, 1, 'hello'))
+    dispatch(endpoint, create_chat_update(11, 1, None))  # not text
+    dispatch(endpoint, create_chat_update(12, 2, '/unknown'))
+    dispatch(endpoint, create_chat_update(13, 2, 'hello'))
+    endpoint.stop()  # writes the offsets
+
+    with open(offset_file) as offset:
+        assert json.load(offset) == {'offset': 14, 'fetch_offset': 14,
+                                     'updates': []}
+    restarted = TelegramEndpoint(token='123:ABC', offset_file=offset_file)
+    assert restarted._telegram.last_update_id == 14
+
+    # a crash: the updates fetched and not processed are restored
+    restarted._offsets.fetched([create_chat_update(14, 1, 'lost'),
+                                create_chat_update(15, 2, 'done')])
+    restarted._offsets.finish(15)
+    recovered = TelegramEndpoint(token='123:ABC', offset_file=offset_file)
+    assert recovered._telegram.last_update_id == 16
+    updates = recovered._offsets.restore(recovered._telegram.bot)
+    assert [(update.update_id, update.effective_message.text)
+            for update in updates] == [(14, 'lost')]
+
+    # an offset file of an older version
+    with open(offset_file, 'w') as offset:
+        offset.write('20')
+    upgraded = TelegramEndpoint(token='123:ABC', offset_file=offset_file)
+    assert upgraded._telegram.last_update_id == 20
+
+
+def test_telegram_channel_posts(mocker):
+    """ Test that the channel posts are answered and the edited messages
+        ignored, both processed
+    """
+    replies = []
+    mocker.patch('telegram.Message.reply_text', autospec=True,
+                 side_effect=lambda message, text: replies.append(
+                     (message.chat_id, text)))
+    from datetime import datetime
+
+    class MyBot(Bot):
+        "Echo bot"
+
+        def default_response(self, in_message):
+            return in_message
+
+    endpoint = TelegramEndpoint(token='123:ABC')
+    MyBot().add_endpoint(endpoint)
+    edited = create_chat_update(1, 1, 'edited')
+    dispatch(endpoint, telegram.Update(
+        update_id=1, edited_message=edited.message))
+    dispatch(endpoint, telegram.Update(
+        update_id=2, channel_post=telegram.Message(
+            message_id=2, from_user=None, date=datetime.now(),
+            chat=telegram.Chat(-100, 'channel'), text='post')))
+    endpoint._workers.stop()
+
+    assert replies == [(-100, 'post')]
+    assert endpoint._offsets.offset == 3
+
+
+def test_telegram_hung_chat(mocker):
+    """ Test that a chat whose reply hangs doesn't stop the polling, the
+        other chats are answered
+    """
+    replies = []
+    mocker.patch('telegram.Message.reply_text', autospec=True,
+                 side_effect=lambda message, text: replies.append(text))
+    release = threading.Event()
+
+    class MyBot(Bot):
+        "Echo bot, hanging for some messages"
+
+        def default_response(self, in_message):
+            if in_message == 'hang':
+                release.wait(5)
+            return in_message
+
+    updates = [create_chat_update(1, 1, 'hang')] + [
+        create_chat_update(update_id, 2 + update_id % 5, 'fast')
+        for update_id in range(2, 301)]
+    offsets = []
+
+    def get_updates(offset, **kwargs):
+        "at most 100 updates from `offset`, then a long poll"
+        offsets.append(offset)
+        fetched = [update for update in updates
+                   if update.update_id >= offset][:100]
+        if not fetched:
+            release.wait(0.05)
+        return fetched
+
+    endpoint = TelegramEndpoint(token='123:ABC')
+    MyBot().add_endpoint(endpoint)
+    mocker.patch.object(endpoint._telegram, '_bootstrap')
+    mocker.patch.object(endpoint._telegram.bot, 'getUpdates',
+                        side_effect=get_updates)
+    try:
+        endpoint.run()
+        wait_for(lambda: len(replies) == 299)
+        assert offsets[:4] == [0, 101, 201, 301]
+        # the hung update keeps the offset for a restart
+        assert endpoint._offsets.offset <= 1
+        assert endpoint._offsets.fetch_offset == 301
+
+        release.set()
+        wait_for(lambda: endpoint._offsets.offset == 301)
+        assert replies[-1] == 'hang'
+    finally:
+        release.set()
+        endpoint.stop()
@@ -3,11 +3,14 @@
 
 import pytest
 import json
+import threading
 from tweepy.models import ModelFactory
 
 from eddie.bot import Bot, command
 from eddie.endpoints import TwitterEndpoint
 
+from .conftest import wait_for
+
 
 class TweepyMocker:
     """ Fixture to create fake DirectMessages
@@ -56,6 +59,8 @@ class TweepyMocker:
             self.tweepy_endpoint._stream.listener.on_data(
                 json.dumps(data)
             )
+            # wait for the endpoint's workers to process the event
+            self.tweepy_endpoint._workers.join()
         except AttributeError:
             # if the endoipoint doesn't have the _stream or the listener yet
             # it means it's not listening
@@ -161,7 +166,7 @@ def test_twitter_interface(mocker, create_bot):
     mOAuthHandler().set_access_token.assert_called_once_with(
         access_token, access_token_secret
     )
-    mAPI.assert_called_once_with(mOAuthHandler())
+    mAPI.assert_called_once_with(mOAuthHandler(), timeout=10.0)
 
 
 def test_twitter_default_response(mocker, twit_mock, create_bot):
@@ -347,3 +352,190 @@ def test_dont_send_message_if_already_following(mocker, twit_mock, create_bot):
 
     mAPI().create_friendship.assert_not_called()
     mAPI().send_direct_message.assert_not_called()
+
+
+def test_custom_hosts(mocker):
+    ''' The endpoint can connect to different API and stream servers, i.e.
+        local ones used for testing.
+    '''
+
+    mAPI = mocker.patch('tweepy.API')
+
+    tep = TwitterEndpoint(
+        consumer_key='', consumer_secret='',
+        access_token='', access_token_secret='',
+        api_host='localhost:8443', stream_host='localhost:8444'
+    )
+
+    mAPI.assert_called_once_with(tep._auth, host='localhost:8443',
+                                 timeout=10.0)
+
+    mocker.patch('tweepy.Stream._start')
+    tep.start_polling()
+    assert tep._stream.host == 'localhost:8444'
+
+
+def test_ignore_other_stream_events(mocker, twit_mock, create_bot):
+    ''' Events that are not DMs or follows are discarded.
+    '''
+
+    mAPI = mocker.patch('tweepy.API')
+    twit_mock.set_API(mAPI)
+
+    class MyBot(Bot):
+        'Echo bot'
+
+        def default_response(self, in_message):
+            return in_message
+
+    tep = TwitterEndpoint(
+        consumer_key='', consumer_secret='',
+        access_token='', access_token_secret=''
+    )
+    twit_mock.set_endpoint(tep)
+    create_bot(MyBot(), tep)
+
+    twit_mock.add_to_stream({'id': 1, 'text': 'a tweet', 'user': {'id': 2}})
+    twit_mock.add_to_stream({'event': 'favorite', 'source': {'id': 2}})
+
+    mAPI().create_friendship.assert_not_called()
+    mAPI().send_direct_message.assert_not_called()
+
+
+def test_coalesce_replies(mocker, twit_mock, create_bot):
+    ''' With a coalesce window the replies to the same user are joined.
+    '''
+
+    mAPI = mocker.patch('tweepy.API')
+
+    class MyBot(Bot):
+        'Echo bot'
+
+        def default_response(self, in_message):
+            return in_message
+
+    tep = TwitterEndpoint(
+        consumer_key='', consumer_secret='',
+        access_token='', access_token_secret='',
+        coalesce_window=0.2
+    )
+    twit_mock.set_endpoint(tep)
+    create_bot(MyBot(), tep)
+
+    message = twit_mock.add_direct_message('first')
+    twit_mock.add_direct_message('second')
+    tep._outbox.join()
+
+    mAPI().send_direct_message.assert_called_once_with(
+        text='first\nsecond', user_id=message['sender']['id']
+    )
+
+
+def test_stream_supervisor(mocker, twit_mock, create_bot):
+    ''' A stalled stream is reconnected, then the DMs missed are recovered.
+    '''
+
+    mAPI = mocker.patch('tweepy.API')
+    twit_mock.set_API(mAPI)
+    streams = []
+    release = threading.Event()
+
+    def start(stream, async):
+        'a stream connecting, then receiving nothing'
+        stream.running = True
+        stream._thread = threading.Thread(target=release.wait)
+        stream._thread.start()
+        streams.append(stream)
+    mocker.patch('tweepy.Stream._start', start)
+
+    class MyBot(Bot):
+        'Echo bot'
+
+        def default_response(self, in_message):
+            return in_message
+
+    tep = TwitterEndpoint(
+        consumer_key='', consumer_secret='',
+        access_token='', access_token_secret='',
+        stall_timeout=0.2, min_backoff=0.01, max_backoff=0.05
+    )
+    twit_mock.set_endpoint(tep)
+    try:
+        create_bot(MyBot(), tep)
+        tep._stream.listener.on_connect()
+        twit_mock.add_direct_message('before the stall')
+        assert tep.health()['alive']
+
+        wait_for(lambda: len(streams) >= 3)
+        assert tep.metrics.counters['stream_stalls'] >= 2
+        assert tep.metrics.counters['stream_reconnects'] >= 2
+        assert not streams[0].running
+
+        # reconnected: the DMs after the last processed one are answered
+        mAPI().direct_messages.return_value = [
+            dict(twit_mock.direct_messages_created[0], id=3, text='third'),
+            dict(twit_mock.direct_messages_created[0], id=2, text='second'),
+        ]
+        tep._stream.listener.on_connect()
+        wait_for(lambda: mAPI().send_direct_message.call_count == 3)
+        tep._workers.join()
+        mAPI().direct_messages.assert_called_once_with(
+            since_id=1, count=50, full_text=True)
+        assert [call[1]['text'] for call in
+                mAPI().send_direct_message.call_args_list] == \
+            ['before the stall', 'second', 'third']
+        assert tep.metrics.counters['backfilled_messages'] == 2
+
+        # already processed: nothing to do
+        tep.backfill_direct_messages()
+        tep._workers.join()
+        assert mAPI().send_direct_message.call_count == 3
+    finally:
+        release.set()
+
+
+def test_backfill_after_live_dm(mocker, monkeypatch, twit_mock, create_bot):
+    ''' A DM arrived on the stream before the backfill doesn't hide the DMs
+        missed before it.
+    '''
+
+    mAPI = mocker.patch('tweepy.API')
+    twit_mock.set_API(mAPI)
+
+    class MyBot(Bot):
+        'Echo bot'
+
+        def default_response(self, in_message):
+            return in_message
+
+    tep = TwitterEndpoint(
+        consumer_key='', consumer_secret='',
+        access_token='', access_token_secret=''
+    )
+    twit_mock.set_endpoint(tep)
+    create_bot(MyBot(), tep)
+    first = twit_mock.add_direct_message('first')
+
+    # reconnected: the backfill is queued behind a DM of the new stream
+    tep._connections = 1
+    submitted = []
+    monkeypatch.setattr(tep._workers, 'submit',
+                        lambda *args: submitted.append(args))
+    tep.on_stream_connected()
+    assert submitted == [(tep.backfill_direct_messages, 1)]
+    monkeypatch.undo()
+    tep.process_new_direct_message(dict(first, id=3, text='third'))
+    tep._workers.join()
+
+    mAPI().direct_messages.return_value = [
+        dict(first, id=3, text='third'),
+        dict(first, id=2, text='second'),
+    ]
+    tep.backfill_direct_messages(1)
+    tep._workers.join()
+    mAPI().direct_messages.assert_called_once_with(
+        since_id=1, count=50, full_text=True)
+    assert [call[1]['text'] for call in
+            mAPI().send_direct_message.call_args_list] == \
+        ['first', 'third', 'second']
+    assert tep.metrics.counters['backfilled_messages'] == 1